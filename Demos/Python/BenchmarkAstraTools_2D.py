@@ -0,0 +1,48 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+GPLv3 license (ASTRA toolbox)
+
+Micro-benchmark to estimate the per-iteration overhead of the ASTRA object
+management for small 2D problems. A pair of forward/backward projections is
+performed many times using:
+    * per-call creation and deletion of the ASTRA data objects (old approach)
+    * the persistent objects of the AstraTools class (data2d.store/get)
+
+Dependencies:
+    * astra-toolkit, install conda install -c astra-toolbox astra-toolbox
+
+@author: Daniil Kazantsev
+"""
+import timeit
+import numpy as np
+import astra
+from tomobar.supp.astraOP import AstraTools
+
+N_size = 64 # set dimension of the object
+iterations = 1000 # the number of forward/backward projection pairs
+angles_num = int(0.5*np.pi*N_size); # angles number
+angles_rad = np.linspace(0.0,179.9,angles_num,dtype='float32')*(np.pi/180.0)
+P = int(np.sqrt(2)*N_size) #detectors
+image = np.float32(np.random.rand(N_size,N_size))
+
+Atools = AstraTools(P, angles_rad, 0.0, N_size, 'cpu') # initiate 2D ASTRA class object
+
+def percall_FPBP():
+    sinogram_id, sinogram = astra.create_sino(image, Atools.proj_id)
+    astra.data2d.delete(sinogram_id)
+    rec_id, rec = astra.create_backprojection(sinogram, Atools.proj_id)
+    astra.data2d.delete(rec_id)
+
+def pooled_FPBP():
+    Atools.backproj(Atools.forwproj(image))
+
+time_percall = timeit.timeit(percall_FPBP, number=iterations)
+time_pooled = timeit.timeit(pooled_FPBP, number=iterations)
+Atools.close()
+
+print ("%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%")
+print("Object size", N_size, "x", N_size, ",", angles_num, "angles,", iterations, "FP/BP pairs")
+print("Per-call ASTRA objects: %.1f us per iteration" % (1e6*time_percall/iterations))
+print("Persistent ASTRA objects: %.1f us per iteration" % (1e6*time_pooled/iterations))
+print("Speed-up: %.2f" % (time_percall/time_pooled))
@@ -0,0 +1,45 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Benchmark of the RING_WEIGHTS C-module (sliding-window median kernels) against
+the previous bubble-sort kernels.
+
+The reference kernel is loaded with ctypes from a libtomobar.so built from an
+earlier version of ToMoBAR (before the sliding-window median), e.g.:
+    python BenchmarkRingWeights.py --reference /path/to/old/libtomobar.so
+
+The default residual size is 2160 x 1801 x 2560 [DetectorsDimV, Angles, DetectorsDimH]
+which requires about 80 GB of memory (160 GB with the reference kernel), use
+--shape to run it on a smaller residual.
+
+@author: Daniil Kazantsev
+"""
+import argparse
+import ctypes
+import timeit
+import numpy as np
+from tomobar.supp.addmodules import RING_WEIGHTS
+
+parser = argparse.ArgumentParser(description='RING_WEIGHTS benchmark')
+parser.add_argument('--shape', type=int, nargs=3, default=[2160, 1801, 2560], help='residual size [DetectorsDimV, Angles, DetectorsDimH]')
+parser.add_argument('--halfsizes', type=int, nargs=3, default=[9, 7, 9], help='half window sizes [detector, angles, projections]')
+parser.add_argument('--reference', type=str, default=None, help='path to libtomobar.so with the previous kernels')
+args = parser.parse_args()
+
+residual = np.float32(np.random.randn(*args.shape))
+(halfsize_det, halfsize_ang, halfsize_proj) = args.halfsizes
+
+time_new = timeit.timeit(lambda: RING_WEIGHTS(residual, halfsize_det, halfsize_ang, halfsize_proj), number=1)
+print("Residual", args.shape, "half window sizes", args.halfsizes)
+print("Sliding-window median kernel: %.2f s" % time_new)
+
+if args.reference is not None:
+    lib = ctypes.CDLL(args.reference)
+    lib.RingWeights_main.argtypes = [ctypes.c_void_p, ctypes.c_void_p, ctypes.c_int, ctypes.c_int, ctypes.c_int, ctypes.c_long, ctypes.c_long, ctypes.c_long]
+    weights_ref = np.zeros(np.shape(residual), dtype='float32')
+    def reference_kernel():
+        lib.RingWeights_main(residual.ctypes.data, weights_ref.ctypes.data, halfsize_det, halfsize_ang, halfsize_proj, residual.shape[1], residual.shape[2], residual.shape[0])
+    time_ref = timeit.timeit(reference_kernel, number=1)
+    weights_new = RING_WEIGHTS(residual, halfsize_det, halfsize_ang, halfsize_proj)
+    print("Reference bubble-sort kernel: %.2f s" % time_ref)
+    print("Speed-up: %.2f, max abs difference: %e" % (time_ref/time_new, np.max(np.abs(weights_new - weights_ref))))
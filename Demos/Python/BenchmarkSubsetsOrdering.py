@@ -0,0 +1,79 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+GPLv3 license (ASTRA toolbox)
+
+Benchmark of the ordered subsets orderings (OS_ordering in _algorithm_) of the
+OS-FISTA algorithm: the number of projections (of single angles) needed to
+reach the target relative data residual |Ax - b|/|b| for every ordering.
+One FISTA run per ordering, the residual of every epoch is assembled from the
+subsets residuals computed by FISTA itself (at the points of the updates), the
+Lipschitz constant is estimated once for all orderings.
+
+The phantom is a set of discs generated with numpy, e.g.:
+    python BenchmarkSubsetsOrdering.py --size 256 --subsets 12 --target 0.02
+
+Dependencies:
+    * astra-toolkit, install conda install -c astra-toolbox astra-toolbox
+
+@author: Daniil Kazantsev
+"""
+import argparse
+import numpy as np
+from tomobar.methodsIR import RecToolsIR
+from tomobar.supp.subsets import SUBSETS_ORDERINGS
+
+parser = argparse.ArgumentParser(description='OS ordering benchmark')
+parser.add_argument('--size', type=int, default=128, help='the size of the phantom')
+parser.add_argument('--subsets', type=int, default=12, help='the number of subsets')
+parser.add_argument('--target', type=float, default=0.02, help='the target relative data residual')
+parser.add_argument('--epochs', type=int, default=20, help='the maximum number of the outer iterations')
+parser.add_argument('--device', type=str, default='cpu', help="'cpu', 'cpu_matrix' or 'gpu'")
+args = parser.parse_args()
+
+N_size = args.size
+angles_num = int(0.5*np.pi*N_size); # angles number
+angles_rad = np.linspace(0.0,179.9,angles_num,dtype='float32')*(np.pi/180.0)
+P = int(np.sqrt(2)*N_size) #detectors
+
+# the phantom of a few discs
+(yy, xx) = np.mgrid[-1.0:1.0:N_size*1j, -1.0:1.0:N_size*1j]
+phantom_2D = np.zeros((N_size,N_size), dtype='float32')
+for (y0, x0, radius, value) in [(0.0, 0.0, 0.8, 0.5), (0.3, -0.2, 0.25, 0.5), (-0.35, 0.25, 0.15, -0.3), (-0.1, -0.45, 0.1, 0.4)]:
+    phantom_2D[(yy - y0)**2 + (xx - x0)**2 < radius**2] += value
+
+Rectools = RecToolsIR(DetectorsDimH = P, DetectorsDimV = None, CenterRotOffset = 0.0, AnglesVec = angles_rad,
+                      ObjSize = N_size, datafidelity = 'LS', device_projector = args.device)
+sinogram = Rectools.Atools.forwproj(phantom_2D)
+sinogram_norm = np.linalg.norm(sinogram)
+
+# the Lipschitz constant of the (first) subset operator with a fixed power method seed
+_data_ = {'projection_norm_data' : sinogram, 'OS_number' : args.subsets}
+lipschitz = Rectools.powermethod(_data_, seed=0)
+
+# the squared data residuals of the subsets projected by FISTA
+subsets_residuals = []
+forwprojOS = Rectools.AtoolsOS.forwprojOS
+def forwprojOS_recorded(image, no_os):
+    projection = forwprojOS(image, no_os)
+    subsets_residuals.append(np.sum((projection - sinogram[Rectools.AtoolsOS.subsets[no_os],:])**2))
+    return projection
+Rectools.AtoolsOS.forwprojOS = forwprojOS_recorded
+
+print("Phantom", N_size, "x", N_size, ",", angles_num, "angles,", args.subsets, "subsets, target residual", args.target)
+for ordering in SUBSETS_ORDERINGS:
+    del subsets_residuals[:]
+    _data_ = {'projection_norm_data' : sinogram, 'OS_number' : args.subsets}
+    _algorithm_ = {'iterations' : args.epochs, 'OS_ordering' : ordering, 'OS_seed' : 0, 'lipschitz_const' : lipschitz,
+                   'tolerance' : 0.0, 'verbose' : 'off'}
+    RecFISTA = Rectools.FISTA(_data_, _algorithm_, {})
+    # every epoch projects all subsets once
+    residuals = np.sqrt(np.reshape(subsets_residuals, (-1, args.subsets)).sum(axis=1))/sinogram_norm
+    reached = np.flatnonzero(residuals < args.target)
+    if (np.size(reached) == 0):
+        print("%-14s residual %.4f after %d epochs (target not reached)" % (ordering, residuals[-1], np.size(residuals)))
+    else:
+        epochs = reached[0] + 1
+        print("%-14s residual %.4f after %d epochs, %d projections" % (ordering, residuals[epochs-1], epochs, epochs*angles_num))
+Rectools.AtoolsOS.forwprojOS = forwprojOS
+Rectools.close()
@@ -31,317 +31,193 @@
 */
 
 
-void swap(float *xp, float *yp)
+/* insert a value into the sorted buffer holding n values */
+static void sorted_insert(float *sorted, int n, float value)
 {
-    float temp = *xp;
-    *xp = *yp;
-    *yp = temp;
+    int lo = 0, hi = n, mid;
+    while (lo < hi) {
+        mid = (lo + hi)/2;
+        if (sorted[mid] <= value) lo = mid + 1;
+        else hi = mid;
+    }
+    memmove(sorted + lo + 1, sorted + lo, (n - lo)*sizeof(float));
+    sorted[lo] = value;
 }
 
+/* remove a value from the sorted buffer holding n values. The values must be
+ * finite (NaNs break the ordering, RING_WEIGHTS rejects the non-finite residuals),
+ * hence the value is always found; the buffer is left unchanged otherwise */
+static void sorted_remove(float *sorted, int n, float value)
+{
+    int lo = 0, hi = n, mid;
+    while (lo < hi) {
+        mid = (lo + hi)/2;
+        if (sorted[mid] < value) lo = mid + 1;
+        else hi = mid;
+    }
+    if ((lo >= n) || (sorted[lo] != value)) return;
+    memmove(sorted + lo, sorted + lo + 1, (n - lo - 1)*sizeof(float));
+}
 
 float RingWeights_main(float *residual, float *weights, int window_halfsize_detectors, int window_halfsize_angles, int window_halfsize_projections, long anglesDim, long detectorsDim, long slices)
 {
-    long i, j, k;
-    int detectors_full_window, angles_full_window, projections_full_window;
-    detectors_full_window = (int)(2*window_halfsize_detectors+1);
-    angles_full_window = (int)(2*window_halfsize_angles+1);
-    projections_full_window = (int)(2*window_halfsize_projections+1);
-    float *weights_temp;
+    float *weights_temp, *weights_temp2 = NULL;
     weights_temp = (float*) calloc (anglesDim*detectorsDim*slices, sizeof(float));
-    
+    if (slices > 1) weights_temp2 = (float*) calloc (anglesDim*detectorsDim*slices, sizeof(float));
+    RingWeights_core(residual, weights, weights_temp, weights_temp2, window_halfsize_detectors, window_halfsize_angles, window_halfsize_projections, anglesDim, detectorsDim, slices);
+    free(weights_temp);
+    free(weights_temp2);
+    return *weights;
+}
+
+/* The same as RingWeights_main but the temporary arrays of the residual size are
+ * provided by the caller and can be reused between calls: weights_temp always and
+ * weights_temp2 for 3D input only (can be NULL for 2D). No memory is allocated
+ * apart from the small per-thread window buffers. */
+float RingWeights_core(float *residual, float *weights, float *weights_temp, float *weights_temp2, int window_halfsize_detectors, int window_halfsize_angles, int window_halfsize_projections, long anglesDim, long detectorsDim, long slices)
+{
+    long i, DimTotal;
+    DimTotal = anglesDim*detectorsDim*slices;
+
     if (slices == 1) {
     /****************2D INPUT ***************/
     /* 1 case is when window_halfsize_angles = 0, meaning that we work solely
     with detectors dimensionality of the sinogram 
     2 case - get median across angles dimension as well */
     if (window_halfsize_angles == 0) {
-    #pragma omp parallel for shared(residual, weights_temp) private(j, i)
-    for(i=0; i<anglesDim; i++) {
-        for(j=0; j<detectorsDim; j++) {
-          RingWeights_det2D(residual, weights_temp, window_halfsize_detectors, detectors_full_window, anglesDim, detectorsDim, j, i);
-        }}
-    for(i=0; i<anglesDim*detectorsDim; i++) weights[i] = residual[i] - weights_temp[i];
+    RingWeights_det(residual, weights_temp, window_halfsize_detectors, anglesDim, detectorsDim, 1l);
+    for(i=0; i<DimTotal; i++) weights[i] = residual[i] - weights_temp[i];
     }
     else {
     /* take the median value of the residual in angles dimmension */
-    #pragma omp parallel for shared(weights_temp, residual) private(j, i)
-    for(i=0; i<anglesDim; i++) {
-        for(j=0; j<detectorsDim; j++) {
-          RingWeights_angles2D(residual, weights_temp, window_halfsize_angles, angles_full_window, anglesDim, detectorsDim, j, i);
-        }}
-    #pragma omp parallel for shared(weights, residual) private(j, i)
-    for(i=0; i<anglesDim; i++) {
-        for(j=0; j<detectorsDim; j++) {
-          RingWeights_det2D(residual, weights, window_halfsize_detectors, detectors_full_window, anglesDim, detectorsDim, j, i);
-        }}
-    for(i=0; i<anglesDim*detectorsDim; i++) weights[i] = weights_temp[i] - weights[i];
+    RingWeights_angles(residual, weights_temp, window_halfsize_angles, anglesDim, detectorsDim, 1l);
+    RingWeights_det(residual, weights, window_halfsize_detectors, anglesDim, detectorsDim, 1l);
+    for(i=0; i<DimTotal; i++) weights[i] = weights_temp[i] - weights[i];
         }
     }
     else {
     /****************3D INPUT ***************/
-    float *weights_temp2;
-    weights_temp2 = (float*) calloc (anglesDim*detectorsDim*slices, sizeof(float));
+    if ((window_halfsize_angles != 0) && (window_halfsize_projections == 0) && (window_halfsize_detectors == 0)) {
+    /* no model for the angles window alone */
+    memset(weights, 0, DimTotal*sizeof(float));
+    }
     if ((window_halfsize_angles == 0) && (window_halfsize_detectors == 0)) {
     /* working with slices (projections) only */
-    #pragma omp parallel for shared(residual, weights_temp) private(k, j, i)
-    for(k = 0; k<slices; k++) {
-        for(i=0; i<anglesDim; i++) {
-          for(j=0; j<detectorsDim; j++) {
-          RingWeights_proj3D(residual, weights_temp, window_halfsize_projections, projections_full_window, anglesDim, detectorsDim, slices, j, i, k);
-        }}}
-    for(i=0; i<anglesDim*detectorsDim*slices; i++) weights[i] = residual[i] - weights_temp[i];
+    RingWeights_proj(residual, weights_temp, window_halfsize_projections, anglesDim, detectorsDim, slices);
+    for(i=0; i<DimTotal; i++) weights[i] = residual[i] - weights_temp[i];
     }
     if ((window_halfsize_angles == 0) && (window_halfsize_projections == 0)) {
     /* working with detectors dimension */
-    #pragma omp parallel for shared(residual, weights_temp) private(k, j, i)
-    for(k = 0; k<slices; k++) {
-        for(i=0; i<anglesDim; i++) {
-          for(j=0; j<detectorsDim; j++) {
-          RingWeights_det3D(residual, weights_temp, window_halfsize_detectors, detectors_full_window, anglesDim, detectorsDim, slices, j, i, k);
-        }}}
-    for(i=0; i<anglesDim*detectorsDim*slices; i++) weights[i] = residual[i] - weights_temp[i];
+    RingWeights_det(residual, weights_temp, window_halfsize_detectors, anglesDim, detectorsDim, slices);
+    for(i=0; i<DimTotal; i++) weights[i] = residual[i] - weights_temp[i];
     }
     /*all windows not equal to zero*/    
      if ((window_halfsize_angles != 0) && (window_halfsize_projections != 0) && (window_halfsize_detectors != 0)) {
-    #pragma omp parallel for shared(weights_temp, residual) private(k, j, i)
-    for(k = 0; k<slices; k++) {
-        for(i=0; i<anglesDim; i++) {
-          for(j=0; j<detectorsDim; j++) {
-          RingWeights_angles3D(residual, weights_temp, window_halfsize_angles, angles_full_window, anglesDim, detectorsDim, slices, j, i, k);
-        }}}
-    #pragma omp parallel for shared(residual, weights_temp2) private(k, j, i)
-    for(k = 0; k<slices; k++) {
-        for(i=0; i<anglesDim; i++) {
-          for(j=0; j<detectorsDim; j++) {
-          RingWeights_proj3D(residual, weights_temp2, window_halfsize_projections, projections_full_window, anglesDim, detectorsDim, slices, j, i, k);
-        }}}
-    #pragma omp parallel for shared(residual, weights) private(k, j, i)
-    for(k = 0; k<slices; k++) {
-        for(i=0; i<anglesDim; i++) {
-          for(j=0; j<detectorsDim; j++) {
-          RingWeights_det3D(residual, weights, window_halfsize_detectors, detectors_full_window, anglesDim, detectorsDim, slices, j, i, k);
-        }}}
-     for(i=0; i<anglesDim*detectorsDim*slices; i++) weights[i] = weights_temp[i] - 0.5f*(weights_temp2[i] + weights[i]);
+    RingWeights_angles(residual, weights_temp, window_halfsize_angles, anglesDim, detectorsDim, slices);
+    RingWeights_proj(residual, weights_temp2, window_halfsize_projections, anglesDim, detectorsDim, slices);
+    RingWeights_det(residual, weights, window_halfsize_detectors, anglesDim, detectorsDim, slices);
+     for(i=0; i<DimTotal; i++) weights[i] = weights_temp[i] - 0.5f*(weights_temp2[i] + weights[i]);
      }
 
     if ((window_halfsize_angles != 0) && (window_halfsize_projections != 0) && (window_halfsize_detectors == 0)) {
-    #pragma omp parallel for shared(weights_temp, residual) private(k, j, i)
-    for(k = 0; k<slices; k++) {
-        for(i=0; i<anglesDim; i++) {
-          for(j=0; j<detectorsDim; j++) {
-          RingWeights_angles3D(residual, weights_temp, window_halfsize_angles, angles_full_window, anglesDim, detectorsDim, slices, j, i, k);
-        }}}
-    #pragma omp parallel for shared(residual, weights_temp2) private(k, j, i)
-    for(k = 0; k<slices; k++) {
-        for(i=0; i<anglesDim; i++) {
-          for(j=0; j<detectorsDim; j++) {
-          RingWeights_proj3D(residual, weights_temp2, window_halfsize_projections, projections_full_window, anglesDim, detectorsDim, slices, j, i, k);
-        }}}
-     for(i=0; i<anglesDim*detectorsDim*slices; i++) weights[i] = weights_temp[i] - weights_temp2[i];
+    RingWeights_angles(residual, weights_temp, window_halfsize_angles, anglesDim, detectorsDim, slices);
+    RingWeights_proj(residual, weights_temp2, window_halfsize_projections, anglesDim, detectorsDim, slices);
+     for(i=0; i<DimTotal; i++) weights[i] = weights_temp[i] - weights_temp2[i];
      }
     
     if ((window_halfsize_angles != 0) && (window_halfsize_projections == 0) && (window_halfsize_detectors != 0)) {
-    #pragma omp parallel for shared(weights_temp, residual) private(k, j, i)
-    for(k = 0; k<slices; k++) {
-        for(i=0; i<anglesDim; i++) {
-          for(j=0; j<detectorsDim; j++) {
-          RingWeights_angles3D(residual, weights_temp, window_halfsize_angles, angles_full_window, anglesDim, detectorsDim, slices, j, i, k);
-        }}}
-    #pragma omp parallel for shared(residual, weights_temp2) private(k, j, i)
-    for(k = 0; k<slices; k++) {
-        for(i=0; i<anglesDim; i++) {
-          for(j=0; j<detectorsDim; j++) {
-          RingWeights_det3D(residual, weights_temp2, window_halfsize_detectors, detectors_full_window, anglesDim, detectorsDim, slices, j, i, k);
-        }}}
-     for(i=0; i<anglesDim*detectorsDim*slices; i++) weights[i] = weights_temp[i] - weights_temp2[i];
+    RingWeights_angles(residual, weights_temp, window_halfsize_angles, anglesDim, detectorsDim, slices);
+    RingWeights_det(residual, weights_temp2, window_halfsize_detectors, anglesDim, detectorsDim, slices);
+     for(i=0; i<DimTotal; i++) weights[i] = weights_temp[i] - weights_temp2[i];
      }
      if ((window_halfsize_angles == 0) && (window_halfsize_projections != 0) && (window_halfsize_detectors != 0)) {
-     #pragma omp parallel for shared(residual, weights_temp) private(k, j, i)
-    for(k = 0; k<slices; k++) {
-        for(i=0; i<anglesDim; i++) {
-          for(j=0; j<detectorsDim; j++) {
-          RingWeights_proj3D(residual, weights_temp, window_halfsize_projections, projections_full_window, anglesDim, detectorsDim, slices, j, i, k);
-        }}}
-    #pragma omp parallel for shared(residual, weights_temp2) private(k, j, i)
-    for(k = 0; k<slices; k++) {
-        for(i=0; i<anglesDim; i++) {
-          for(j=0; j<detectorsDim; j++) {
-          RingWeights_det3D(residual, weights_temp2, window_halfsize_detectors, detectors_full_window, anglesDim, detectorsDim, slices, j, i, k);
-        }}}
-     for(i=0; i<anglesDim*detectorsDim*slices; i++) weights[i] = residual[i] - 0.5f*(weights_temp[i] + weights_temp2[i]);
+    RingWeights_proj(residual, weights_temp, window_halfsize_projections, anglesDim, detectorsDim, slices);
+    RingWeights_det(residual, weights_temp2, window_halfsize_detectors, anglesDim, detectorsDim, slices);
+     for(i=0; i<DimTotal; i++) weights[i] = residual[i] - 0.5f*(weights_temp[i] + weights_temp2[i]);
      }
-      free(weights_temp2);
    }
-  free(weights_temp);
   return *weights;
 }
 /********************************************************************/
-/***************************2D Functions*****************************/
+/*********************Sliding-window median**************************/
 /********************************************************************/
-float RingWeights_det2D(float *residual, float *weights_temp, int window_halfsize_detectors, int detectors_full_window, long anglesDim, long detectorsDim, long j, long i)
+/* The running median along a 1D line of the given length and stride. The window
+ * is kept sorted, moving it by one element costs a deletion and an insertion
+ * instead of sorting the whole window. Near the ends of the line the neighbours
+ * outside the line are replaced by the central value and the window is sorted anew.
+ * As in the original kernels the (window_halfsize-1)-th element of the sorted
+ * window is taken. The sorted buffer must hold 2*window_halfsize+1 values. */
+float RingWeights_median1D(float *input, float *output, int window_halfsize, long length, long stride, float *sorted)
 {
-        float *Values_Vec;
-        long k, j1, index;
-        int counter, x, y, midval;
+    long i, m, i1;
+    int counter, full_window, midval;
+    float value;
 
-        index = i*detectorsDim+j;
-       
-        Values_Vec = (float*) calloc (detectors_full_window, sizeof(float));
-        midval = (int)(0.5f*detectors_full_window) - 1;
-        
-        /* intiate the estimation of the backround using strictly horizontal values (detectors dimension) */
-        counter = 0;
-        for (k=-window_halfsize_detectors; k <= window_halfsize_detectors; k++) {
-            j1 = j + k;
-            if ((j1 >= 0) && (j1 < detectorsDim)) {
-              Values_Vec[counter] = residual[i*detectorsDim+j1]; }
-            else Values_Vec[counter] = residual[index];
-            counter++;
-        }
-        /* perform sorting of the vector array */
-        for (x = 0; x < counter-1; x++)  {
-            for (y = 0; y < counter-x-1; y++)  {
-                if (Values_Vec[y] > Values_Vec[y+1]) {
-                    swap(&Values_Vec[y], &Values_Vec[y+1]);
-                }
+    if (window_halfsize <= 0) {
+        for (i=0; i<length; i++) output[i*stride] = input[i*stride];
+        return *output;
+    }
+    full_window = 2*window_halfsize+1;
+    midval = window_halfsize - 1;
+
+    for (i=0; i<length; i++) {
+        if ((i < window_halfsize) || (i >= length - window_halfsize)) {
+            /* boundary: sort the window anew */
+            counter = 0;
+            for (m=-window_halfsize; m <= window_halfsize; m++) {
+                i1 = i + m;
+                if ((i1 >= 0) && (i1 < length)) value = input[i1*stride];
+                else value = input[i*stride];
+                sorted_insert(sorted, counter, value);
+                counter++;
             }
         }
-        weights_temp[index] = Values_Vec[midval];
-
-      free(Values_Vec);
-      return *weights_temp;
+        else if (i == window_halfsize) {
+            /* the first window which lies fully inside the line */
+            for (m=0; m < full_window; m++) sorted_insert(sorted, (int)m, input[m*stride]);
+        }
+        else {
+            /* slide the window by one element */
+            sorted_remove(sorted, full_window, input[(i-window_halfsize-1)*stride]);
+            sorted_insert(sorted, full_window-1, input[(i+window_halfsize)*stride]);
+        }
+        output[i*stride] = sorted[midval];
+    }
+    return *output;
 }
 
-float RingWeights_angles2D(float *weights_temp, float *weights, int window_halfsize_angles, int angles_full_window, long anglesDim, long detectorsDim, long j, long i)
+/* running medians over nlines lines, the l-th line starts at
+ * (l/inner_count)*outer_step + (l%inner_count)*inner_step.
+ * Every thread owns its sorted window buffer. */
+static void RingWeights_lines(float *input, float *output, int window_halfsize, long nlines, long inner_count, long outer_step, long inner_step, long length, long stride)
 {
-    long k, i1, index;
-    int counter, x, y, midval;
-    float *Values_Vec;
-    
-    index = i*detectorsDim+j;
-    Values_Vec = (float*) calloc (angles_full_window, sizeof(float));
-    midval = (int)(0.5f*angles_full_window) - 1;
-    
-    counter = 0;
-    for (k=-window_halfsize_angles; k <= window_halfsize_angles; k++) {
-        i1 = i + k;
-        if ((i1 >= 0) && (i1 < anglesDim)) {
-            Values_Vec[counter] = weights_temp[i1*detectorsDim+j]; }
-        else Values_Vec[counter] = weights_temp[index];
-        counter++;
+#pragma omp parallel
+    {
+    long l, start;
+    float *sorted = (float*) malloc ((2*window_halfsize+1)*sizeof(float));
+#pragma omp for
+    for(l=0; l<nlines; l++) {
+        start = (l/inner_count)*outer_step + (l%inner_count)*inner_step;
+        RingWeights_median1D(input + start, output + start, window_halfsize, length, stride, sorted);
     }
-    /* perform sorting of the vector array */
-    for (x = 0; x < counter-1; x++)  {
-        for (y = 0; y < counter-x-1; y++)  {
-            if (Values_Vec[y] > Values_Vec[y+1]) {
-                swap(&Values_Vec[y], &Values_Vec[y+1]);
-            }
-        }
+    free(sorted);
     }
-    weights[index] = Values_Vec[midval];
-    
-    free(Values_Vec);
-    return *weights;
 }
-/********************************************************************/
-/***************************3D Functions*****************************/
-/********************************************************************/
-float RingWeights_proj3D(float *residual, float *weights_temp, int window_halfsize_projections, int projections_full_window, long anglesDim, long detectorsDim, long slices, long j, long i, long k)
+/* median along the detectors dimension */
+float RingWeights_det(float *residual, float *weights_temp, int window_halfsize_detectors, long anglesDim, long detectorsDim, long slices)
 {
-        float *Values_Vec;
-        long z, k1, index;
-        int counter, x, y, midval;
-
-        index = detectorsDim*anglesDim*k + i*detectorsDim+j;
-       
-        Values_Vec = (float*) calloc (projections_full_window, sizeof(float));
-        midval = (int)(0.5f*projections_full_window) - 1;
-        
-        /* intiate the estimation of the backround using strictly slice values */
-        counter = 0;
-        for (z=-window_halfsize_projections; z <= window_halfsize_projections; z++) {
-            k1 = z + k;
-            if ((k1 >= 0) && (k1 < slices)) {
-              Values_Vec[counter] = residual[detectorsDim*anglesDim*k1 + i*detectorsDim+j]; }
-            else Values_Vec[counter] = residual[index];
-            counter++;
-        }
-        
-        /* perform sorting of the vector array */
-        for (x = 0; x < counter-1; x++)  {
-            for (y = 0; y < counter-x-1; y++)  {
-                if (Values_Vec[y] > Values_Vec[y+1]) {
-                    swap(&Values_Vec[y], &Values_Vec[y+1]);
-                }
-            }
-        }        
-      weights_temp[index] = Values_Vec[midval];
-      free(Values_Vec); 
-      return *weights_temp;
+    RingWeights_lines(residual, weights_temp, window_halfsize_detectors, anglesDim*slices, 1l, detectorsDim, 0l, detectorsDim, 1l);
+    return *weights_temp;
 }
-
-float RingWeights_det3D(float *residual, float *weights_temp, int window_halfsize_detectors, int detectors_full_window, long anglesDim, long detectorsDim, long slices, long j, long i, long k)
+/* median along the angles dimension */
+float RingWeights_angles(float *residual, float *weights_temp, int window_halfsize_angles, long anglesDim, long detectorsDim, long slices)
 {
-        float *Values_Vec;
-        long m, j1, index;
-        int counter, x, y, midval;
-
-        index = detectorsDim*anglesDim*k + i*detectorsDim+j;
-       
-        Values_Vec = (float*) calloc (detectors_full_window, sizeof(float));
-        midval = (int)(0.5f*detectors_full_window) - 1;
-        
-        /* intiate the estimation of the backround using strictly horizontal values (detectors dimension) */
-        counter = 0;
-        for (m=-window_halfsize_detectors; m <= window_halfsize_detectors; m++) {
-            j1 = j + m;
-            if ((j1 >= 0) && (j1 < detectorsDim)) {
-              Values_Vec[counter] = residual[detectorsDim*anglesDim*k + i*detectorsDim+j1]; }
-            else Values_Vec[counter] = residual[index];
-            counter++;
-        }
-        /* perform sorting of the vector array */
-        for (x = 0; x < counter-1; x++)  {
-            for (y = 0; y < counter-x-1; y++)  {
-                if (Values_Vec[y] > Values_Vec[y+1]) {
-                    swap(&Values_Vec[y], &Values_Vec[y+1]);
-                }
-            }
-        }
-        weights_temp[index] = Values_Vec[midval];
-
-      free(Values_Vec);
-      return *weights_temp;
+    RingWeights_lines(residual, weights_temp, window_halfsize_angles, detectorsDim*slices, detectorsDim, anglesDim*detectorsDim, 1l, anglesDim, detectorsDim);
+    return *weights_temp;
 }
-
-float RingWeights_angles3D(float *weights_temp, float *weights, int window_halfsize_angles, int angles_full_window, long anglesDim, long detectorsDim, long slices, long j, long i, long k)
+/* median along the slices (projections) dimension */
+float RingWeights_proj(float *residual, float *weights_temp, int window_halfsize_projections, long anglesDim, long detectorsDim, long slices)
 {
-    long m, i1, index;
-    int counter, x, y, midval;
-    float *Values_Vec;
-    
-    index = detectorsDim*anglesDim*k + i*detectorsDim+j;
-    Values_Vec = (float*) calloc (angles_full_window, sizeof(float));
-    midval = (int)(0.5f*angles_full_window) - 1;
-    
-    counter = 0;
-    for (m=-window_halfsize_angles; m <= window_halfsize_angles; m++) {
-        i1 = i + m;
-        if ((i1 >= 0) && (i1 < anglesDim)) {
-            Values_Vec[counter] = weights_temp[detectorsDim*anglesDim*k + i1*detectorsDim+j];}
-        else Values_Vec[counter] = weights_temp[index];
-        counter++;
-    }
-    /* perform sorting of the vector array */
-    for (x = 0; x < counter-1; x++)  {
-        for (y = 0; y < counter-x-1; y++)  {
-            if (Values_Vec[y] > Values_Vec[y+1]) {
-                swap(&Values_Vec[y], &Values_Vec[y+1]);
-            }
-        }
-    }
-    weights[index] = Values_Vec[midval];
-    
-    free(Values_Vec);
-    return *weights;
+    RingWeights_lines(residual, weights_temp, window_halfsize_projections, anglesDim*detectorsDim, anglesDim*detectorsDim, 0l, 1l, slices, anglesDim*detectorsDim);
+    return *weights_temp;
 }
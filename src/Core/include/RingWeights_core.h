@@ -40,13 +40,12 @@
 extern "C" {
 #endif
 DLL_EXPORT float RingWeights_main(float *residual, float *weights, int window_halfsize_detectors, int window_halfsize_angles, int window_halfsize_projections, long anglesDim, long detectorsDim, long slices);
-/************2D functions ***********/
-DLL_EXPORT float RingWeights_det2D(float *residual, float *weights_temp, int window_halfsize_detectors, int detectors_full_window, long anglesDim, long detectorsDim, long i, long j);
-DLL_EXPORT float RingWeights_angles2D(float *weights_temp, float *weights, int window_halfsize_angles, int angles_full_window, long anglesDim, long detectorsDim, long i, long j);
-/************3D functions ***********/
-DLL_EXPORT float RingWeights_proj3D(float *residual, float *weights_temp, int window_halfsize_projections, int projections_full_window, long anglesDim, long detectorsDim, long slices, long j, long i, long k);
-DLL_EXPORT float RingWeights_det3D(float *residual, float *weights_temp, int window_halfsize_detectors, int detectors_full_window, long anglesDim, long detectorsDim, long slices, long j, long i, long k);
-DLL_EXPORT float RingWeights_angles3D(float *weights_temp, float *weights, int window_halfsize_angles, int angles_full_window, long anglesDim, long detectorsDim, long slices, long j, long i, long k);
+DLL_EXPORT float RingWeights_core(float *residual, float *weights, float *weights_temp, float *weights_temp2, int window_halfsize_detectors, int window_halfsize_angles, int window_halfsize_projections, long anglesDim, long detectorsDim, long slices);
+/************sliding-window median functions ***********/
+DLL_EXPORT float RingWeights_median1D(float *input, float *output, int window_halfsize, long length, long stride, float *sorted);
+DLL_EXPORT float RingWeights_det(float *residual, float *weights_temp, int window_halfsize_detectors, long anglesDim, long detectorsDim, long slices);
+DLL_EXPORT float RingWeights_angles(float *residual, float *weights_temp, int window_halfsize_angles, long anglesDim, long detectorsDim, long slices);
+DLL_EXPORT float RingWeights_proj(float *residual, float *weights_temp, int window_halfsize_projections, long anglesDim, long detectorsDim, long slices);
 #ifdef __cplusplus
 }
 #endif
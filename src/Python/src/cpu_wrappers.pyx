@@ -15,41 +15,87 @@ import cython
 import numpy as np
 cimport numpy as np
 
-cdef extern float RingWeights_main(float *residual, float *weights, int window_halfsize_detectors, int window_halfsize_angles, int window_halfsize_projections, long anglesDim, long detectorsDim, long slices);
+cdef extern float RingWeights_core(float *residual, float *weights, float *weights_temp, float *weights_temp2, int window_halfsize_detectors, int window_halfsize_angles, int window_halfsize_projections, long anglesDim, long detectorsDim, long slices) nogil;
 
 ##############################################################################
-def RING_WEIGHTS(residual, window_halfsize_detectors, window_halfsize_angles, window_halfsize_projections):
+def RING_WEIGHTS(residual, window_halfsize_detectors, window_halfsize_angles, window_halfsize_projections, out=None, scratch=None):
+    """
+    Ring weights of the residual (2D sinogram or 3D [DetectorsDimV, Angles, DetectorsDimH]).
+    The GIL is released while the C-module runs. Optional buffers (float32, C-ordered)
+    to avoid memory allocation in repeated calls:
+      out - the output weights of the residual size
+      scratch - temporary arrays of the shape [1, *residual.shape] for 2D and
+      [2, *residual.shape] for 3D input
+    The residual must be finite (ValueError otherwise) since the sliding-window
+    medians rely on the ordered values
+    """
+    if not np.isfinite(np.sum(residual, dtype=np.float64)):
+        raise ValueError("The residual of RING_WEIGHTS contains non-finite (NaN or Inf) values")
     if residual.ndim == 2:
-        return RING_WEIGHTS_2D(residual,  window_halfsize_detectors, window_halfsize_angles)
+        return RING_WEIGHTS_2D(residual,  window_halfsize_detectors, window_halfsize_angles, out, scratch)
     elif residual.ndim == 3:
-        return RING_WEIGHTS_3D(residual, window_halfsize_detectors, window_halfsize_angles, window_halfsize_projections)
+        return RING_WEIGHTS_3D(residual, window_halfsize_detectors, window_halfsize_angles, window_halfsize_projections, out, scratch)
+
+def _check_buffer(buffer, shape, name):
+    if (buffer.dtype != np.float32) or (not buffer.flags['C_CONTIGUOUS']) or (tuple(buffer.shape) != tuple(shape)):
+        raise ValueError("'%s' must be a C-contiguous float32 array of the shape %s" % (name, tuple(shape)))
+    return buffer
 
 def RING_WEIGHTS_2D(np.ndarray[np.float32_t, ndim=2, mode="c"] residual,
                      int window_halfsize_detectors,
-                     int window_halfsize_angles):
+                     int window_halfsize_angles,
+                     out=None,
+                     scratch=None):
 
     cdef long dims[2]
     dims[0] = residual.shape[0]
     dims[1] = residual.shape[1]
 
-    cdef np.ndarray[np.float32_t, ndim=2, mode="c"] weights = \
-            np.zeros([dims[0],dims[1]], dtype='float32')
+    cdef np.ndarray[np.float32_t, ndim=2, mode="c"] weights
+    cdef np.ndarray[np.float32_t, ndim=3, mode="c"] weights_temp
+    if out is None:
+        weights = np.zeros([dims[0],dims[1]], dtype='float32')
+    else:
+        weights = _check_buffer(out, (dims[0],dims[1]), 'out')
+    if scratch is None:
+        weights_temp = np.empty([1,dims[0],dims[1]], dtype='float32')
+    else:
+        weights_temp = _check_buffer(scratch, (1,dims[0],dims[1]), 'scratch')
 
-    RingWeights_main(&residual[0,0], &weights[0,0], window_halfsize_detectors, window_halfsize_angles, 0, dims[0], dims[1], 1);
+    cdef float *residual_ptr = &residual[0,0]
+    cdef float *weights_ptr = &weights[0,0]
+    cdef float *weights_temp_ptr = &weights_temp[0,0,0]
+    with nogil:
+        RingWeights_core(residual_ptr, weights_ptr, weights_temp_ptr, NULL, window_halfsize_detectors, window_halfsize_angles, 0, dims[0], dims[1], 1)
     return weights
 
 def RING_WEIGHTS_3D(np.ndarray[np.float32_t, ndim=3, mode="c"] residual,
                      int window_halfsize_detectors, 
                      int window_halfsize_angles, 
-                     int window_halfsize_projections):
+                     int window_halfsize_projections,
+                     out=None,
+                     scratch=None):
 
     cdef long dims[3]
     dims[0] = residual.shape[0]
     dims[1] = residual.shape[1]
     dims[2] = residual.shape[2]
 
-    cdef np.ndarray[np.float32_t, ndim=3, mode="c"] weights = \
-            np.zeros([dims[0],dims[1],dims[2]], dtype='float32')
+    cdef np.ndarray[np.float32_t, ndim=3, mode="c"] weights
+    cdef np.ndarray[np.float32_t, ndim=4, mode="c"] weights_temp
+    if out is None:
+        weights = np.zeros([dims[0],dims[1],dims[2]], dtype='float32')
+    else:
+        weights = _check_buffer(out, (dims[0],dims[1],dims[2]), 'out')
+    if scratch is None:
+        weights_temp = np.empty([2,dims[0],dims[1],dims[2]], dtype='float32')
+    else:
+        weights_temp = _check_buffer(scratch, (2,dims[0],dims[1],dims[2]), 'scratch')
 
-    RingWeights_main(&residual[0,0,0], &weights[0,0,0], window_halfsize_detectors, window_halfsize_angles, window_halfsize_projections, dims[1], dims[2], dims[0]);
+    cdef float *residual_ptr = &residual[0,0,0]
+    cdef float *weights_ptr = &weights[0,0,0]
+    cdef float *weights_temp_ptr = &weights_temp[0,0,0,0]
+    cdef float *weights_temp2_ptr = &weights_temp[1,0,0,0]
+    with nogil:
+        RingWeights_core(residual_ptr, weights_ptr, weights_temp_ptr, weights_temp2_ptr, window_halfsize_detectors, window_halfsize_angles, window_halfsize_projections, dims[1], dims[2], dims[0])
     return weights
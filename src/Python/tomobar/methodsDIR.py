@@ -11,8 +11,50 @@ A reconstruction class for direct reconstructon methods (parallel beam geometry)
 
 import numpy as np
 
-def filtersinc3D(projection3D):
-    import scipy.fftpack
+from functools import lru_cache
+
+@lru_cache(maxsize=32)
+def filtersinc_kernel(DetectorsLengthH, a):
+    # the frequency response of the sinc filter for the real-valued FFT (rfft),
+    # memoized by the detector width and the filter parameter "a"
+    # adopted from Matlabs code by  Waqas Akram
+    w =  np.linspace(-np.pi,np.pi-(2*np.pi)/DetectorsLengthH, DetectorsLengthH,dtype='float32')
+    rn1 = np.abs(2.0/a*np.sin(a*w/2.0))
+    rn2 = np.sin(a*w/2.0)
+    rd = (a*w)/2.0
+    # the dot product with pinv of the 1xN matrix rd equals (rn2.rd)/(rd.rd)
+    r = rn1*(np.dot(rn2, rd)/np.dot(rd, rd))**2
+    f = np.fft.fftshift(r)
+    # only the even part of the filter contributes to the real-valued output
+    f = 0.5*(f + np.roll(f[::-1], 1))
+    kernel = np.float32(f[0:DetectorsLengthH//2+1])
+    kernel.setflags(write=False)
+    return kernel
+
+def filtersinc(projections, a=1.1, workers=-1, block_elements=2**26):
+    """
+    applies the sinc filter along the last (horizontal detector) axis of the
+    projection data using batched real-valued FFTs in float32, the data is
+    processed in blocks of the first dimension to bound the memory of the
+    Fourier transformed temporaries
+    """
+    import scipy.fft
+    projections = np.asarray(projections, dtype='float32')
+    projectionsNum = np.shape(projections)[-2]
+    DetectorsLengthH = np.shape(projections)[-1]
+    kernel = filtersinc_kernel(DetectorsLengthH, a)*np.float32(1.0/projectionsNum)
+    filtered = np.empty(np.shape(projections), dtype='float32')
+    if projections.ndim == 2:
+        filtered[:] = scipy.fft.irfft(scipy.fft.rfft(projections, axis=-1, workers=workers)*kernel, n=DetectorsLengthH, axis=-1, workers=workers)
+        return filtered
+    block = max(1, block_elements//(projectionsNum*DetectorsLengthH))
+    for j in range(0, np.shape(projections)[0], block):
+        IMG = scipy.fft.rfft(projections[j:j+block], axis=-1, workers=workers)
+        IMG *= kernel
+        filtered[j:j+block] = scipy.fft.irfft(IMG, n=DetectorsLengthH, axis=-1, workers=workers)
+    return filtered
+
+def filtersinc3D(projection3D, workers=-1):
     # applies filters to __3D projection data__ in order to achieve FBP
     # Data format [DetectorVert, Projections, DetectorHoriz]
     # adopted from Matlabs code by  Waqas Akram
@@ -20,29 +62,9 @@ def filtersinc3D(projection3D):
     #When "a" is very small (a<<1), the response approximates |w|
     #As "a" is increased, the filter response starts to 
     #roll off at high frequencies.
-    a = 1.1
-    [DetectorsLengthV, projectionsNum, DetectorsLengthH] = np.shape(projection3D)
-    w =  np.linspace(-np.pi,np.pi-(2*np.pi)/DetectorsLengthH, DetectorsLengthH,dtype='float32')
-    
-    rn1 = np.abs(2.0/a*np.sin(a*w/2.0))
-    rn2 = np.sin(a*w/2.0)
-    rd = (a*w)/2.0
-    rd_c = np.zeros([1,DetectorsLengthH])
-    rd_c[0,:] = rd
-    r = rn1*(np.dot(rn2, np.linalg.pinv(rd_c)))**2
-    multiplier = (1.0/projectionsNum)
-    f = scipy.fftpack.fftshift(r)
-    filtered = np.zeros(np.shape(projection3D))
-    
-    for j in range(0,DetectorsLengthV):
-        for i in range(0,projectionsNum):
-            IMG = scipy.fftpack.fft(projection3D[j,i,:])
-            fimg = IMG*f
-            filtered[j,i,:] = multiplier*np.real(scipy.fftpack.ifft(fimg))
-    return np.float32(filtered)
+    return filtersinc(projection3D, a=1.1, workers=workers)
 
-def filtersinc2D(sinogram):
-    import scipy.fftpack
+def filtersinc2D(sinogram, workers=-1):
     # applies filters toa sinogram in order to achieve FBP
     # Data format [Projections, DetectorHoriz]
     # adopted from Matlabs code by  Waqas Akram
@@ -50,28 +72,45 @@ def filtersinc2D(sinogram):
     #When "a" is very small (a<<1), the response approximates |w|
     #As "a" is increased, the filter response starts to 
     #roll off at high frequencies.
-    a = 1.1
-    [projectionsNum, DetectorsLengthH] = np.shape(sinogram)
-    w =  np.linspace(-np.pi,np.pi-(2*np.pi)/DetectorsLengthH, DetectorsLengthH,dtype='float32')
-    
-    rn1 = np.abs(2.0/a*np.sin(a*w/2.0))
-    rn2 = np.sin(a*w/2.0)
-    rd = (a*w)/2.0
-    rd_c = np.zeros([1,DetectorsLengthH])
-    rd_c[0,:] = rd
-    r = rn1*(np.dot(rn2, np.linalg.pinv(rd_c)))**2
-    multiplier = (1.0/projectionsNum)
-    f = scipy.fftpack.fftshift(r)
-    filtered = np.zeros(np.shape(sinogram))
-    
-    for i in range(0,projectionsNum):
-        IMG = scipy.fftpack.fft(sinogram[i,:])
-        fimg = IMG*f
-        filtered[i,:] = multiplier*np.real(scipy.fftpack.ifft(fimg))
-    return np.float32(filtered)
+    return filtersinc(sinogram, a=1.1, workers=workers)
+
+def slab_workers(slices, slice_elements, workers=None, memory_budget_mb=None):
+    # the number of workers to process the slices concurrently, each worker
+    # needs float32 memory for about twice the elements of one slice
+    import os
+    if workers is None:
+        workers = os.cpu_count() or 1
+    if memory_budget_mb is not None:
+        worker_mb = 2.0*4.0*slice_elements/1024**2
+        workers = min(workers, int(memory_budget_mb/worker_mb))
+    return int(max(1, min(workers, slices)))
+
+def dir_tools_init(self):
+    # the ASTRA projection class of the instance geometry, created on the first use
+    if self.Atools is None:
+        if (self.geom == '2D'):
+            from tomobar.supp.astraOP import AstraTools
+            self.Atools = AstraTools(self.DetectorsDimH, self.AnglesVec, self.CenterRotOffset, self.ObjSize, self.device_projector) # initiate 2D ASTRA class object
+        else:
+            from tomobar.supp.astraOP import AstraTools3D
+            self.Atools = AstraTools3D(self.DetectorsDimH, self.DetectorsDimV, self.AnglesVec, self.CenterRotOffset, self.ObjSize, self.device_projector) # initiate 3D ASTRA class object
+    return self.Atools
+
+def fbp_slab_tools_init(self, workers):
+    # the 2D ASTRA projection classes of the slab-wise 3D FBP (one per worker), created on the first use
+    from tomobar.supp.astraOP import AstraTools
+    while (len(self.Atools_FBP_slabs) < workers):
+        self.Atools_FBP_slabs.append(AstraTools(self.DetectorsDimH, self.AnglesVec-np.pi, self.CenterRotOffset, self.ObjSize, self.device_projector))
+    return self.Atools_FBP_slabs[:workers]
 
 class RecToolsDIR:
-    """ Class for reconstruction using DIRect methods (FBP and Fourier)"""
+    """
+    Class for reconstruction using DIRect methods (FBP and Fourier)
+
+    The ASTRA projection objects are created on the first use and reused by the
+    following calls, release them with release() or use the class as a context manager
+    (otherwise they are released when the instance is garbage collected)
+    """
     def __init__(self, 
               DetectorsDimH,  # DetectorsDimH # detector dimension (horizontal)
               DetectorsDimV,  # DetectorsDimV # detector dimension (vertical) for 3D case only
@@ -98,26 +137,27 @@ class RecToolsDIR:
             self.geom = '2D'
         else:
             self.geom = '3D'
+        self.Atools = None
+        self.Atools_FBP_slabs = []
+
+    def __enter__(self):
+        return self
+    def __exit__(self, *args):
+        self.release()
+    def release(self):
+        # release ASTRA objects held by the projection classes (the projection
+        # classes also release them when the instance is garbage collected)
+        if self.Atools is not None:
+            self.Atools.close()
+            self.Atools = None
+        for Atools in self.Atools_FBP_slabs:
+            Atools.close()
+        self.Atools_FBP_slabs = []
+
     def FORWPROJ(self, image):
-        if (self.geom == '2D'):
-            from tomobar.supp.astraOP import AstraTools
-            Atools = AstraTools(self.DetectorsDimH, self.AnglesVec, self.CenterRotOffset, self.ObjSize, self.device_projector) # initiate 2D ASTRA class object
-            sinogram = Atools.forwproj(image)
-        if (self.geom == '3D'):
-            from tomobar.supp.astraOP import AstraTools3D
-            Atools = AstraTools3D(self.DetectorsDimH, self.DetectorsDimV, self.AnglesVec, self.CenterRotOffset, self.ObjSize) # initiate 3D ASTRA class object
-            sinogram = Atools.forwproj(image)
-        return sinogram
+        return dir_tools_init(self).forwproj(image)
     def BACKPROJ(self, sinogram):
-        if (self.geom == '2D'):
-            from tomobar.supp.astraOP import AstraTools
-            Atools = AstraTools(self.DetectorsDimH, self.AnglesVec, self.CenterRotOffset, self.ObjSize, self.device_projector) # initiate 2D ASTRA class object
-            image = Atools.backproj(sinogram)
-        if (self.geom == '3D'):
-            from tomobar.supp.astraOP import AstraTools3D
-            Atools = AstraTools3D(self.DetectorsDimH, self.DetectorsDimV, self.AnglesVec, self.CenterRotOffset, self.ObjSize) # initiate 3D ASTRA class object
-            image = Atools.backproj(sinogram)
-        return image
+        return dir_tools_init(self).backproj(sinogram)
     def FOURIER(self, sinogram, method='linear'):
         """ 
         2D Reconstruction using Fourier slice theorem (scipy required) 
@@ -199,10 +239,16 @@ class RecToolsDIR:
         # Cropping reconstruction to size of the original image
         image = recon[int(((self.DetectorsDimH-self.ObjSize)/2)+1):self.DetectorsDimH-int(((self.DetectorsDimH-self.ObjSize)/2)-1),int(((self.DetectorsDimH-self.ObjSize)/2)):self.DetectorsDimH-int(((self.DetectorsDimH-self.ObjSize)/2))]
         return image
-    def FBP(self, sinogram):
-        from tomobar.supp.astraOP import AstraTools
+    def FBP(self, sinogram, workers=None, memory_budget_mb=None):
+        """
+        Filtered Backprojection reconstruction. For 3D data and CenterRotOffset = None
+        the volume is split into slabs of sinograms which are reconstructed
+        concurrently on the CPU:
+            workers - the number of concurrent slabs (all cores if None)
+            memory_budget_mb - the limit of the working memory of the workers in MB
+        """
         if (self.geom == '2D'):
-            Atools = AstraTools(self.DetectorsDimH, self.AnglesVec, self.CenterRotOffset, self.ObjSize, self.device_projector) # initiate 2D ASTRA class object
+            Atools = dir_tools_init(self)
             'dealing with FBP 2D not working for parallel_vec geometry and CPU'
             if (self.device_projector == 'gpu'):
                 FBP_rec = Atools.fbp2D(sinogram) # GPU reconstruction
@@ -211,13 +257,24 @@ class RecToolsDIR:
                 FBP_rec = Atools.backproj(filtered_sino) # backproject
         if ((self.geom == '3D') and (self.CenterRotOffset is None)):
             FBP_rec = np.zeros((self.DetectorsDimV, self.ObjSize, self.ObjSize), dtype='float32')
-            Atools = AstraTools(self.DetectorsDimH, self.AnglesVec-np.pi, self.CenterRotOffset, self.ObjSize, self.device_projector) # initiate 2D ASTRA class object
-            for i in range(0, self.DetectorsDimV):
-                FBP_rec[i,:,:] = Atools.fbp2D(np.flipud(sinogram[i,:,:]))
+            if (self.device_projector == 'gpu'):
+                workers = 1
+            workers = slab_workers(self.DetectorsDimV, len(self.AnglesVec)*self.DetectorsDimH + self.ObjSize**2, workers, memory_budget_mb)
+            def fbp_slab(Atools, slab):
+                # each worker owns its 2D ASTRA projector
+                for i in slab:
+                    FBP_rec[i,:,:] = Atools.fbp2D(np.flipud(sinogram[i,:,:]))
+            slabs = np.array_split(np.arange(self.DetectorsDimV), workers)
+            Atools_slabs = fbp_slab_tools_init(self, workers)
+            if (workers == 1):
+                fbp_slab(Atools_slabs[0], slabs[0])
+            else:
+                from concurrent.futures import ThreadPoolExecutor
+                # ASTRA releases the GIL while running its algorithms
+                with ThreadPoolExecutor(max_workers=workers) as executor:
+                    list(executor.map(fbp_slab, Atools_slabs, slabs))
         if ((self.geom == '3D') and (self.CenterRotOffset is not None)):
             # perform FBP using custom filtration
-            from tomobar.supp.astraOP import AstraTools3D
-            Atools = AstraTools3D(self.DetectorsDimH, self.DetectorsDimV, self.AnglesVec, self.CenterRotOffset, self.ObjSize) # initiate 3D ASTRA class object
             filtered_sino = filtersinc3D(sinogram) # filtering sinogram
-            FBP_rec = Atools.backproj(filtered_sino) # backproject
+            FBP_rec = dir_tools_init(self).backproj(filtered_sino) # backproject
         return FBP_rec
\ No newline at end of file
@@ -8,6 +8,8 @@ A reconstruction class for regularised iterative methods:
 -- Regularised ADMM algorithm (Boyd, N. Parikh, E. Chu, B. Peleato, J. Eckstein, "Distributed optimization and
                                statistical learning via the alternating direction method of multipliers", Found. Trends Mach. Learn.,
                                vol. 3, no. 1, pp. 1-122, Jan. 2011)
+-- Regularised PDHG algorithm (A. Chambolle, T. Pock, "A first-order primal-dual algorithm for convex problems with
+                               applications to imaging", Journal of Mathematical Imaging and Vision, vol. 40, pp. 120-145, 2011)
 -- SIRT, CGLS algorithms wrapped directly from ASTRA package
 
 Dependencies:
@@ -29,12 +31,7 @@ except:
     print('____! CCPi-regularisation package is missing, please install !____')
 
 try:
-    import astra
-except:
-    print('____! Astra-toolbox package is missing, please install !____')
-
-try:
-    import scipy.sparse.linalg
+    import scipy.fft
 except:
     print('____! Scipy toolbox package is missing, please install !____')
 
@@ -43,6 +40,9 @@ try:
 except:
     print('____! RING_WEIGHTS C-module failed on import !____')
 
+from tomobar.supp.cacheTools import DiskCache, geometry_hash
+from tomobar.supp.subsets import subsets_order, subsets_data
+
 
 
 def smooth(y, box_pts):
@@ -57,26 +57,207 @@ def merge_3_dicts(x, y, z):
     merg.update(z)
     return merg
 
+def circ_mask_init(objsize, diameter):
+    # a 2D float32 circular mask for the object of the size objsize
+    # Make the 'diameter' smaller than 1.0 in order to shrink it
+    c = np.linspace(-(objsize*(1.0/diameter))/2.0, (objsize*(1.0/diameter))/2.0, objsize)
+    x, y = np.meshgrid(c, c)
+    return np.float32(np.array((x**2 + y**2 < (objsize/2.0)**2)))
+
 def circ_mask(X, diameter):
     # applying a circular mask to the reconstructed image/volume
     # Make the 'diameter' smaller than 1.0 in order to shrink it
-    obj_shape = np.shape(X)
-    X_masked = np.float32(np.zeros(obj_shape))
     if np.ndim(X) == 2:
-        objsize = obj_shape[0]
+        objsize = np.shape(X)[0]
     elif np.ndim(X) == 3:
-        objsize = obj_shape[1]
+        objsize = np.shape(X)[1]
     else:
         print("Object input size is wrong for the mask to apply to")
-    c = np.linspace(-(objsize*(1.0/diameter))/2.0, (objsize*(1.0/diameter))/2.0, objsize)
-    x, y = np.meshgrid(c, c)
-    mask = np.float32(np.array((x**2 + y**2 < (objsize/2.0)**2)))
-    if np.ndim(X) == 3:
-        for z in range(0, obj_shape[0]):
-            X_masked[z,:,:] = np.multiply(X[z,:,:], mask)
+    return np.multiply(X, circ_mask_init(objsize, diameter), dtype='float32')
+
+def circ_mask_cached(self, ndim, diameter):
+    # the circular mask cached on the class instance keyed by (ObjSize, diameter, ndim),
+    # for 3D it is shaped [1, ObjSize, ObjSize] to be broadcasted over the volume,
+    # apply it in place with np.multiply(X, mask, out=X)
+    key = (self.ObjSize, diameter, ndim)
+    if key not in self.mask_cache:
+        mask = circ_mask_init(self.ObjSize, diameter)
+        if ndim == 3:
+            mask = mask[np.newaxis,:,:]
+        mask.setflags(write=False)
+        self.mask_cache[key] = mask
+    return self.mask_cache[key]
+
+def swls_denominators(weights, beta_SWLS, angles_axis):
+    # the inverted SWLS denominators 1/(sum(wk) + beta_SWLS) over the angles
+    # dimension, computed once per subset since the raw data does not change
+    denom = np.sum(weights, axis=angles_axis, keepdims=True, dtype='float64') + beta_SWLS
+    return np.float32(1.0/denom)
+
+def swls_residual(res, weights, denom_inv, angles_axis, out=None):
+    # Stripe-Weighted Least-squares residual update for all detector columns at once:
+    # wk*res - (wk.res)/(sum(wk) + beta_SWLS)*wk
+    res_w = np.multiply(weights, res, out=out)
+    res_w -= np.sum(res_w, axis=angles_axis, keepdims=True)*denom_inv*weights
+    return res_w
+
+def workspace_buffer(workspace, name, shape, dtype='float32'):
+    # a buffer of the workspace dictionary, allocated on the first request
+    # of the given name and shape and reused in the following iterations
+    key = (name, tuple(shape))
+    if key not in workspace:
+        workspace[key] = np.empty(shape, dtype=dtype)
+    return workspace[key]
+
+def ring_weights_function(res, _data_, workspace):
+    # the Huber-type weights of the residual to supress the ring artifacts, computed
+    # in the workspace buffers (the returned weights are overwritten by the next call)
+    res = np.ascontiguousarray(res, dtype='float32')
+    ring_function_weight = workspace_buffer(workspace, 'ring_weights', np.shape(res))
+    ring_scratch = workspace_buffer(workspace, 'ring_scratch', (np.ndim(res)-1,) + np.shape(res))
+    outliers = workspace_buffer(workspace, 'ring_outliers', np.shape(res), dtype=bool)
+    RING_WEIGHTS(res, _data_['ring_tuple_halfsizes'][0], _data_['ring_tuple_halfsizes'][1], _data_['ring_tuple_halfsizes'][2], out=ring_function_weight, scratch=ring_scratch)
+    np.abs(ring_function_weight, out=ring_function_weight)
+    np.greater(ring_function_weight, _data_['ring_weights_threshold'], out=outliers)
+    np.power(ring_function_weight, _data_['ring_huber_power'], out=ring_function_weight, where=outliers)
+    np.divide(_data_['ring_weights_threshold'], ring_function_weight, out=ring_function_weight, where=outliers)
+    np.logical_not(outliers, out=outliers)
+    np.copyto(ring_function_weight, 1.0, where=outliers)
+    return ring_function_weight
+
+def os_tools_init(self, OS_number):
+    # initialise OS ASTRA-related modules, the existing ones are reused if
+    # the number of subsets has not changed
+    if getattr(self, 'AtoolsOS', None) is not None:
+        if self.AtoolsOS.OS == OS_number:
+            return
+        self.AtoolsOS.close()
+    if self.geom == '2D':
+        from tomobar.supp.astraOP import AstraToolsOS
+        self.AtoolsOS = AstraToolsOS(self.DetectorsDimH, self.AnglesVec, self.CenterRotOffset, self.ObjSize, OS_number, self.device_projector) # initiate 2D ASTRA class OS object
     else:
-        X_masked = np.multiply(X,mask)
-    return X_masked
+        from tomobar.supp.astraOP import AstraToolsOS3D
+        self.AtoolsOS = AstraToolsOS3D(self.DetectorsDimH, self.DetectorsDimV, self.AnglesVec, self.CenterRotOffset, self.ObjSize, OS_number, self.device_projector) # initiate 3D ASTRA class OS object
+
+def powermethod_algorithm(self, _data_, _algorithm_):
+    # the power method with the parameters of _algorithm_
+    return RecToolsIR.powermethod(self, _data_, tolerance=_algorithm_['powermethod_tolerance'], iterations=_algorithm_['powermethod_iterations'],
+                                  seed=_algorithm_['powermethod_seed'], x_init=_algorithm_['powermethod_init'])
+
+def lipschitz_const(self, _data_, _algorithm_):
+    # Lipschitz constant from the on-disk cache keyed by the hash of the geometry
+    # (and of the weights for PWLS), the power method runs only on a cache miss.
+    # A cache which cannot be read or written is skipped with a message
+    if (_algorithm_['lipschitz_cache'] != 'on'):
+        return powermethod_algorithm(self, _data_, _algorithm_)
+    if (self.datafidelity == 'PWLS'):
+        weights = _data_['projection_raw_data']
+    else:
+        weights = None
+    key = geometry_hash('lipschitz', self.DetectorsDimH, self.DetectorsDimV, self.AnglesVec, self.CenterRotOffset,
+                        self.ObjSize, _data_['OS_number'], self.device_projector, weights)
+    cache = DiskCache('lipschitz', 16*1024**2)
+    try:
+        L_const = cache.get(key)
+    except Exception as error:
+        print('____! Lipschitz constants cache is not readable:', error, '!____')
+        L_const = None
+    if L_const is None:
+        L_const = powermethod_algorithm(self, _data_, _algorithm_)
+        try:
+            cache.put(key, np.float64(L_const))
+        except Exception as error:
+            print('____! Lipschitz constants cache is not writable:', error, '!____')
+    return float(L_const)
+
+def batch_tools_init(self, batch, OS_number):
+    # initialise 3D ASTRA-related modules for a stack of 2D problems of the
+    # same geometry (every detector row holds a sinogram of its own slice),
+    # the existing ones are reused for the same batch size and subsets
+    from tomobar.supp.astraOP import AstraTools3D, AstraToolsOS3D
+    if np.ndim(self.CenterRotOffset) == 0:
+        CenterRotOffset = self.CenterRotOffset
+    else:
+        # a CoR value per angle, the vertical offsets are zero
+        CenterRotOffset = np.zeros((self.angles_number, 2))
+        CenterRotOffset[:,1] = self.CenterRotOffset
+    if (self.Atools_batch is None) or (self.Atools_batch.DetectorsDimV != batch):
+        if self.Atools_batch is not None:
+            self.Atools_batch.close()
+        self.Atools_batch = AstraTools3D(self.DetectorsDimH, batch, self.AnglesVec, CenterRotOffset, self.ObjSize, self.device_projector) # initiate 3D ASTRA class object
+    if (OS_number == 1):
+        return
+    if (self.AtoolsOS_batch is None) or (self.AtoolsOS_batch.DetectorsDimV != batch) or (self.AtoolsOS_batch.OS != OS_number):
+        if self.AtoolsOS_batch is not None:
+            self.AtoolsOS_batch.close()
+        self.AtoolsOS_batch = AstraToolsOS3D(self.DetectorsDimH, batch, self.AnglesVec, CenterRotOffset, self.ObjSize, OS_number, self.device_projector) # initiate 3D ASTRA class OS object
+
+def admm_precond_init(self, rec_shape, rho):
+    # Fourier-domain (ramp-filter) preconditioner for the ADMM system (A'A + rho*I),
+    # the frequency response of A'A is measured once from the point spread function
+    # of a centred impulse (per slice in 3D) and the preconditioner is 1/(|response| + rho)
+    impulse = np.zeros(rec_shape, 'float32')
+    impulse[..., self.ObjSize//2, self.ObjSize//2] = 1.0
+    psf = self.Atools.backproj(self.Atools.forwproj(impulse))
+    if (self.geom == '3D'):
+        psf = np.mean(psf, axis=0)
+    response = np.abs(scipy.fft.rfft2(scipy.fft.ifftshift(psf)))
+    return np.float32(1.0/(response + rho))
+
+def admm_precond(res, precond):
+    # applies the Fourier-domain preconditioner (circular convolution over the last two axes)
+    res_f = scipy.fft.rfft2(res, workers=-1)
+    res_f *= precond
+    return scipy.fft.irfft2(res_f, s=res.shape[-2:], workers=-1)
+
+def pcg_solve(A_func, b, x, M_func, tolerance, iterations):
+    # preconditioned conjugate gradient for a symmetric positive-definite system
+    # A_func(x) = b, x is the initial guess (warm start) and it is updated in place,
+    # stops when ||b - A_func(x)|| <= tolerance*||b||, returns the iterations number
+    r = b - A_func(x)
+    b_norm = LA.norm(b.ravel())
+    if (b_norm == 0.0):
+        b_norm = 1.0
+    z = r if M_func is None else M_func(r)
+    p = z.copy()
+    rz = np.vdot(r, z)
+    for iter in range(0, iterations):
+        if (LA.norm(r.ravel()) <= tolerance*b_norm):
+            return iter
+        Ap = A_func(p)
+        alpha = rz/np.vdot(p, Ap)
+        x += alpha*p
+        r -= alpha*Ap
+        z = r if M_func is None else M_func(r)
+        rz_new = np.vdot(r, z)
+        if (rz_new == 0.0):
+            return iter + 1
+        p *= rz_new/rz
+        p += z
+        rz = rz_new
+    return iterations
+
+def admm_solver_tolerance(solver_tolerance, iter, iterations):
+    # the inner (CG) tolerance for the given outer ADMM iteration: a constant or
+    # a (start, end) tuple decreasing geometrically over the outer iterations
+    if (np.ndim(solver_tolerance) == 0):
+        return solver_tolerance
+    (tol_start, tol_end) = solver_tolerance
+    return tol_start*(tol_end/tol_start)**(iter/max(iterations - 1, 1))
+
+def pdhg_dual_prox(datafidelity, v, sigma, data, weights):
+    # the proximal operator of the convex conjugate of the data fidelity
+    # (the dual update of PDHG), sigma is the (diagonal) dual step
+    if (datafidelity == 'LS'):
+        # F(z) = 0.5*||z - b||^2
+        return (v - sigma*data)/(1.0 + sigma)
+    if (datafidelity == 'PWLS'):
+        # F(z) = 0.5*||z - b||^2_W
+        return np.multiply(weights, v - sigma*data)/(weights + sigma)
+    if (datafidelity == 'KL'):
+        # F(z) = sum((z + 1) - (b + 1)*log(z + 1)), the same model as in FISTA
+        v = v + sigma
+        return 0.5*(1.0 + v - np.sqrt(np.maximum((v - 1.0)**2 + 4.0*sigma*(data + 1.0), 0.0)))
 
 def dict_check(self, _data_, _algorithm_, _regularisation_):
     # checking and initialising all required parameters here:
@@ -92,12 +273,7 @@ def dict_check(self, _data_, _algorithm_, _regularisation_):
         _data_['OS_number'] = 1
     else:
         #initialise OS ASTRA-related modules
-        if self.geom == '2D':
-            from tomobar.supp.astraOP import AstraToolsOS
-            self.AtoolsOS = AstraToolsOS(self.DetectorsDimH, self.AnglesVec, self.CenterRotOffset, self.ObjSize, _data_['OS_number'], self.device_projector) # initiate 2D ASTRA class OS object
-        else:
-            from tomobar.supp.astraOP import AstraToolsOS3D
-            self.AtoolsOS = AstraToolsOS3D(self.DetectorsDimH, self.DetectorsDimV, self.AnglesVec, self.CenterRotOffset, self.ObjSize, _data_['OS_number']) # initiate 3D ASTRA class OS object
+        os_tools_init(self, _data_['OS_number'])
     # SWLS related parameter (ring supression)
     if (('beta_SWLS' not in _data_) and (self.datafidelity == 'SWLS')):
         _data_['beta_SWLS'] = 0.1*np.ones(self.DetectorsDimH)
@@ -122,10 +298,28 @@ def dict_check(self, _data_, _algorithm_, _regularisation_):
     # Group-Huber data model acceleration factor (use carefully to avoid divergence)
     if ('ringGH_accelerate' not in _data_):
         _data_['ringGH_accelerate'] = 50
+    # OS ring models (ring_weights_threshold, ringGH_lambda) from the subsets residuals of the previous iteration
+    if ('ring_residual_lagged' not in _data_):
+        _data_['ring_residual_lagged'] = 'off'
     # ----------  deal with _algorithm_  --------------
+    # store/reuse the calculated Lipschitz constants in the on-disk cache (opt-in)
+    if ('lipschitz_cache' not in _algorithm_):
+        _algorithm_['lipschitz_cache'] = 'off'
+    # the power method (Lipschitz constant) relative tolerance to stop earlier (0.0 - all iterations)
+    if ('powermethod_tolerance' not in _algorithm_):
+        _algorithm_['powermethod_tolerance'] = 0.0
+    # the power method maximum iterations number
+    if ('powermethod_iterations' not in _algorithm_):
+        _algorithm_['powermethod_iterations'] = 15
+    # the seed of the power method random initial vector (None for a non-reproducible vector)
+    if ('powermethod_seed' not in _algorithm_):
+        _algorithm_['powermethod_seed'] = None
+    # the power method initial vector (warm start), None for a random vector
+    if ('powermethod_init' not in _algorithm_):
+        _algorithm_['powermethod_init'] = None
     if ('lipschitz_const' not in _algorithm_):
         # if not provided calculate Lipschitz constant automatically
-        _algorithm_['lipschitz_const'] = RecToolsIR.powermethod(self, _data_)
+        _algorithm_['lipschitz_const'] = lipschitz_const(self, _data_, _algorithm_)
     # iterations number for the selected reconstruction algorithm
     if ('iterations' not in _algorithm_):
         if (_data_['OS_number'] == 1):
@@ -138,6 +332,24 @@ def dict_check(self, _data_, _algorithm_, _regularisation_):
     # ADMM over-relaxation parameter to accelerate convergence
     if ('ADMM_relax_par' not in _algorithm_):
         _algorithm_['ADMM_relax_par'] = 1.0
+    # PDHG ratio of the dual and primal steps (> 1.0 larger dual steps, < 1.0 larger primal steps)
+    if ('PDHG_gamma' not in _algorithm_):
+        _algorithm_['PDHG_gamma'] = 10.0
+    # the order of the subsets in every iteration: 'interleaved', 'bit-reversal', 'golden-angle' or 'random'
+    if ('OS_ordering' not in _algorithm_):
+        _algorithm_['OS_ordering'] = 'interleaved'
+    # the seed of the 'random' subsets ordering (None for a non-reproducible ordering)
+    if ('OS_seed' not in _algorithm_):
+        _algorithm_['OS_seed'] = None
+    # ADMM inner (CG) solver tolerance: a constant or a (start, end) tuple decreasing over the outer iterations
+    if ('ADMM_solver_tolerance' not in _algorithm_):
+        _algorithm_['ADMM_solver_tolerance'] = 1e-05
+    # ADMM inner (CG) solver maximum iterations number
+    if ('ADMM_solver_iterations' not in _algorithm_):
+        _algorithm_['ADMM_solver_iterations'] = 15
+    # ADMM Fourier-domain (ramp-filter) preconditioner for the inner solver
+    if ('ADMM_precondition' not in _algorithm_):
+        _algorithm_['ADMM_precondition'] = 'off'
     # initialise an algorithm with an array
     if ('initialise' not in _algorithm_):
         _algorithm_['initialise'] = None
@@ -256,7 +468,7 @@ def prox_regul(self, X, _regularisation_):
 class RecToolsIR:
     """
     ----------------------------------------------------------------------------------------------------------
-    A class for iterative reconstruction algorithms (FISTA and ADMM) using ASTRA toolbox and CCPi-RGL toolkit
+    A class for iterative reconstruction algorithms (FISTA, ADMM and PDHG) using ASTRA toolbox and CCPi-RGL toolkit
     ----------------------------------------------------------------------------------------------------------
     Parameters of the class function main specifying the projection geometry:
       *DetectorsDimH,     # Horizontal detector dimension
@@ -265,7 +477,7 @@ class RecToolsIR:
       *AnglesVec,         # A vector of projection angles in radians
       *ObjSize,           # Reconstructed object dimensions (a scalar)
       *datafidelity,      # Data fidelity, choose from LS, KL, PWLS or SWLS
-      *device_projector   # choose projector between 'cpu' and 'gpu'
+      *device_projector   # choose projector between 'cpu', 'gpu' and 'cpu_matrix' (2D CPU with the cached sparse system matrix)
 
     Parameters for reconstruction algorithms are extracted from 3 dictionaries:
       _data_ :
@@ -279,6 +491,7 @@ class RecToolsIR:
             --ring_tuple_halfsizes # a tuple for half window sizes as [detector, angles, num of projections]
             --ringGH_lambda # a parameter for Group-Huber data model to supress full rings of the same intensity
             --ringGH_accelerate # Group-Huber data model acceleration factor (use carefully to avoid divergence, 50 default)
+            --ring_residual_lagged # 'on' for the OS ring models (ring_weights_threshold, ringGH_lambda) computed from the subsets residuals of the previous iteration instead of the additional projection of all angles, 'off' (default)
             --beta_SWLS # a regularisation parameter for stripe-weighted LS model (given as a vector size of DetectorsDimH)
      _algorithm_ :
             --iterations # the number of the reconstruction algorithm iterations
@@ -286,8 +499,19 @@ class RecToolsIR:
             --nonnegativity # ENABLE (default) or DISABLE the nonnegativity for algorithms
             --mask_diameter # set to 1.0 to enable a circular mask diameter, < 1.0 to shrink the mask
             --lipschitz_const # Lipschitz constant for FISTA algorithm, if not given will be calculated for each call
+            --powermethod_tolerance # the relative tolerance to stop the power method (Lipschitz constant) earlier, 0.0 (default) runs all iterations
+            --powermethod_iterations # the maximum number of the power method iterations (15)
+            --powermethod_seed # the seed of the power method random initial vector (None default)
+            --powermethod_init # the power method initial vector (warm start), None (default) for a random vector
+            --lipschitz_cache # 'on' to reuse calculated Lipschitz constants of the same geometry from the disk cache (TOMOBAR_CACHE_DIR or ~/.cache/tomobar), 'off' (default)
             --ADMM_rho_const # only for ADMM algorithm augmented Lagrangian parameter
             --ADMM_relax_par # ADMM-specific over relaxation parameter for convergence speed
+            --PDHG_gamma # PDHG ratio of the dual and primal step sizes (10.0 default)
+            --OS_ordering # the order of the subsets: 'interleaved' (default), 'bit-reversal', 'golden-angle' or 'random' (new every iteration)
+            --OS_seed # the seed for the 'random' OS_ordering (None default)
+            --ADMM_solver_tolerance # ADMM inner CG tolerance, a constant (1e-05) or a (start, end) tuple decreasing over the outer iterations
+            --ADMM_solver_iterations # ADMM inner CG maximum iterations number (15)
+            --ADMM_precondition # 'on' to precondition the ADMM inner CG in the Fourier domain (ramp filter), 'off' (default)
             --tolerance # tolerance to terminate reconstruction algorithm iterations earlier, default 0.0
             --verbose # mode to print iterations number and other messages ('on' by default, 'off' to suppress)
      _regularisation_ :
@@ -320,7 +544,7 @@ class RecToolsIR:
               AnglesVec,         # Array of projection angles in radians
               ObjSize,           # Reconstructed object dimensions (scalar)
               datafidelity,      # Data fidelity, choose from LS, KL, PWLS
-              device_projector   # choose projector between 'cpu' and 'gpu'
+              device_projector   # choose projector between 'cpu', 'gpu' and 'cpu_matrix'
               ):
         if ObjSize is tuple:
             raise (" Reconstruction is currently available for square or cubic objects only, please provide a scalar ")
@@ -356,9 +580,30 @@ class RecToolsIR:
             self.geom = '3D'
             # classical approach
             from tomobar.supp.astraOP import AstraTools3D
-            self.Atools = AstraTools3D(self.DetectorsDimH, self.DetectorsDimV, self.AnglesVec, self.CenterRotOffset, self.ObjSize) # initiate 3D ASTRA class object
+            self.Atools = AstraTools3D(self.DetectorsDimH, self.DetectorsDimV, self.AnglesVec, self.CenterRotOffset, self.ObjSize, self.device_projector) # initiate 3D ASTRA class object
+        self.AtoolsOS = None
+        self.Atools_batch = None
+        self.AtoolsOS_batch = None
+        self.mask_cache = {}
         return None
 
+    def __enter__(self):
+        return self
+    def __exit__(self, *args):
+        self.close()
+    def close(self):
+        # release ASTRA objects held by the projection classes (the projection
+        # classes also release them when the instance is garbage collected)
+        self.Atools.close()
+        if self.AtoolsOS is not None:
+            self.AtoolsOS.close()
+            self.AtoolsOS = None
+        if self.Atools_batch is not None:
+            self.Atools_batch.close()
+            self.Atools_batch = None
+        if self.AtoolsOS_batch is not None:
+            self.AtoolsOS_batch.close()
+            self.AtoolsOS_batch = None
 
     def SIRT(self, _data_, _algorithm_):
         ######################################################################
@@ -384,60 +629,65 @@ class RecToolsIR:
             CGLS_rec = self.Atools.cgls3D(_data_['projection_norm_data'], _algorithm_['iterations'])
         return CGLS_rec
 
-    def powermethod(self, _data_):
-        # power iteration algorithm to  calculate the eigenvalue of the operator (projection matrix)
-        # projection_raw_data is required for PWLS fidelity (self.datafidelity = PWLS), otherwise will be ignored
+    def powermethod(self, _data_, tolerance=0.0, iterations=15, seed=None, x_init=None, return_info=False):
+        """
+        power iteration algorithm to calculate the eigenvalue of the operator (projection matrix)
+        projection_raw_data is required for PWLS fidelity (self.datafidelity = PWLS), otherwise will be ignored
+            tolerance - stop when the relative change of the eigenvalue estimate is below it (0.0 - run all iterations)
+            iterations - the maximum number of iterations
+            seed - the seed of the random initial vector (for reproducible estimates)
+            x_init - the initial vector (warm start), e.g. the eigenvector of a similar geometry
+            return_info - return (eigenvalue, iterations used, eigenvector) instead of the eigenvalue only
+        """
         if (('OS_number' not in _data_) or (_data_['OS_number'] is None)):
             # Ordered Subsets OR classical approach (default)
             _data_['OS_number'] = 1
         else:
             #initialise OS ASTRA-related modules
-            if self.geom == '2D':
-                from tomobar.supp.astraOP import AstraToolsOS
-                self.AtoolsOS = AstraToolsOS(self.DetectorsDimH, self.AnglesVec, self.CenterRotOffset, self.ObjSize, _data_['OS_number'], self.device_projector) # initiate 2D ASTRA class OS object
-            else:
-                from tomobar.supp.astraOP import AstraToolsOS3D
-                self.AtoolsOS = AstraToolsOS3D(self.DetectorsDimH, self.DetectorsDimV, self.AnglesVec, self.CenterRotOffset, self.ObjSize, _data_['OS_number']) # initiate 3D ASTRA class OS object
-        niter = 15 # number of power method iterations
+            os_tools_init(self, _data_['OS_number'])
         s = 1.0
 
-        # classical approach
-        if (self.geom == '2D'):
-            x1 = np.float32(np.random.randn(self.Atools.ObjSize,self.Atools.ObjSize))
+        if x_init is not None:
+            x1 = np.float32(x_init)
         else:
-            x1 = np.float32(np.random.randn(self.Atools.DetectorsDimV,self.Atools.ObjSize,self.Atools.ObjSize))
-        if (self.datafidelity == 'PWLS'):
-                sqweight = _data_['projection_raw_data']
+            rng = np.random.default_rng(seed)
+            if (self.geom == '2D'):
+                x1 = np.float32(rng.standard_normal((self.Atools.ObjSize,self.Atools.ObjSize)))
+            else:
+                x1 = np.float32(rng.standard_normal((self.Atools.DetectorsDimV,self.Atools.ObjSize,self.Atools.ObjSize)))
+        sqweight = None
         if (_data_['OS_number'] == 1):
             # non-OS approach
-            y = self.Atools.forwproj(x1)
+            forwproj = self.Atools.forwproj
+            backproj = self.Atools.backproj
             if (self.datafidelity == 'PWLS'):
-                y = np.multiply(sqweight, y)
-            for iter in range(0,niter):
-                x1 = self.Atools.backproj(y)
-                s = LA.norm(x1)
-                x1 = x1/s
-                y = self.Atools.forwproj(x1)
-                if (self.datafidelity == 'PWLS'):
-                    y = np.multiply(sqweight, y)
+                sqweight = _data_['projection_raw_data']
         else:
-            # OS approach
-            y = self.AtoolsOS.forwprojOS(x1,0)
+            # OS approach (the first subset)
+            forwproj = lambda x: self.AtoolsOS.forwprojOS(x,0)
+            backproj = lambda y: self.AtoolsOS.backprojOS(y,0)
             if (self.datafidelity == 'PWLS'):
                 if (self.geom == '2D'):
-                    y = np.multiply(sqweight[self.AtoolsOS.newInd_Vec[0,:],:], y)
+                    sqweight = _data_['projection_raw_data'][self.AtoolsOS.subsets[0],:]
                 else:
-                    y = np.multiply(sqweight[:,self.AtoolsOS.newInd_Vec[0,:],:], y)
-            for iter in range(0,niter):
-                x1 = self.AtoolsOS.backprojOS(y,0)
-                s = LA.norm(x1)
-                x1 = x1/s
-                y = self.AtoolsOS.forwprojOS(x1,0)
-                if (self.datafidelity == 'PWLS'):
-                    if (self.geom == '2D'):
-                        y = np.multiply(sqweight[self.AtoolsOS.newInd_Vec[0,:],:], y)
-                    else:
-                        y = np.multiply(sqweight[:,self.AtoolsOS.newInd_Vec[0,:],:], y)
+                    sqweight = _data_['projection_raw_data'][:,self.AtoolsOS.subsets[0],:]
+        y = forwproj(x1)
+        if sqweight is not None:
+            y = np.multiply(sqweight, y)
+        iterations_used = 0
+        for iter in range(0,iterations):
+            s_old = s
+            x1 = backproj(y)
+            s = LA.norm(x1)
+            x1 = x1/s
+            iterations_used = iter + 1
+            if ((iter > 0) and (np.abs(s - s_old) < tolerance*s)):
+                break
+            y = forwproj(x1)
+            if sqweight is not None:
+                y = np.multiply(sqweight, y)
+        if return_info:
+            return (s, iterations_used, x1)
         return s
 
     def FISTA(self, _data_, _algorithm_, _regularisation_):
@@ -449,196 +699,158 @@ class RecToolsIR:
         L_const_inv = 1.0/_algorithm_['lipschitz_const'] # inverted Lipschitz constant
         if (self.geom == '2D'):
             # 2D reconstruction
-            # initialise the solution
-            if (np.size(_algorithm_['initialise']) == self.ObjSize**2):
-                # the object has been initialised with an array
-                X = _algorithm_['initialise']
-            else:
-                X = np.zeros((self.ObjSize,self.ObjSize), 'float32') # initialise with zeros
+            rec_shape = (self.ObjSize, self.ObjSize)
+            angles_axis = 0
             r = np.zeros((self.DetectorsDimH,1),'float32') # 1D array of sparse "ring" variables (GH)
         if (self.geom == '3D'):
-            # initialise the solution
-            if (np.size(_algorithm_['initialise']) == self.ObjSize**3):
-                # the object has been initialised with an array
-                X = _algorithm_['initialise']
-            else:
-                X = np.zeros((self.DetectorsDimV,self.ObjSize,self.ObjSize), 'float32') # initialise with zeros
+            rec_shape = (self.DetectorsDimV, self.ObjSize, self.ObjSize)
+            angles_axis = 1
             r = np.zeros((self.DetectorsDimV,self.DetectorsDimH), 'float32') # 2D array of sparse "ring" variables (GH)
+        # initialise the solution, the solution buffers (X, X_old, X_t) are updated in place
+        if (np.size(_algorithm_['initialise']) == np.prod(rec_shape)):
+            # the object has been initialised with an array
+            X = np.array(_algorithm_['initialise'], dtype='float32').reshape(rec_shape)
+        else:
+            X = np.zeros(rec_shape, 'float32') # initialise with zeros
+        X_old = np.empty(rec_shape, 'float32')
+        # the preallocated residual-sized buffers of the penalties and the ring weights
+        # (the projections and the regulariser still return new arrays every update)
+        workspace = {}
         info_vec = (0,1)
+        if _algorithm_['mask_diameter'] is not None:
+            mask = circ_mask_cached(self, np.ndim(X), _algorithm_['mask_diameter'])
+        if (_data_['OS_number'] != 1):
+            subsets = self.AtoolsOS.subsets
+            forwproj = self.AtoolsOS.forwprojOS
+            backproj = self.AtoolsOS.backprojOS
+        else:
+            subsets = [None] # the full data
+            forwproj = lambda x, sub_ind: self.Atools.forwproj(x)
+            backproj = lambda y, sub_ind: self.Atools.backproj(y)
+        # the data (and the weights) of every subset in the contiguous arrays
+        norm_subsets = subsets_data(_data_['projection_norm_data'], subsets, angles_axis)
+        if (self.datafidelity in ['PWLS', 'SWLS']):
+            raw_subsets = subsets_data(_data_['projection_raw_data'], subsets, angles_axis)
+        if (self.datafidelity == 'SWLS'):
+            # precompute SWLS denominators for every subset (or the full data)
+            swls_denom = [swls_denominators(raw_subset, _data_['beta_SWLS'], angles_axis) for raw_subset in raw_subsets]
+        ring_subsets = None
         #****************************************************************************#
         # FISTA (model-based modification) algorithm begins here:
         t = 1.0
         denomN = 1.0/np.size(X)
         X_t = np.copy(X)
         r_x = r.copy()
+        res_lagged = None
+        if ((_data_['OS_number'] != 1) and (_data_['ring_residual_lagged'] == 'on') and
+            ((_data_['ringGH_lambda'] is not None) or (_data_['ring_weights_threshold'] is not None))):
+            # the full residual assembled from the subsets residuals during the subsets loop
+            res_lagged = np.zeros(np.shape(_data_['projection_norm_data']), 'float32')
         # Outer FISTA iterations
         for iter in range(0,_algorithm_['iterations']):
             r_old = r
             # Do GH fidelity pre-calculations using the full projections dataset for OS version
             if ((_data_['OS_number'] != 1) and (_data_['ringGH_lambda'] is not None) and (iter > 0)):
-                if (self.geom == '2D'):
-                    vec = np.zeros((self.DetectorsDimH))
+                # the sum of the full residual over the angles
+                if res_lagged is not None:
+                    # the residuals of the subsets from the previous iteration
+                    res_sum = res_lagged.sum(axis = angles_axis)
                 else:
-                    vec = np.zeros((self.DetectorsDimV, self.DetectorsDimH))
-                for sub_ind in range(_data_['OS_number']):
-                    #select a specific set of indeces for the subset (OS)
-                    indVec = self.AtoolsOS.newInd_Vec[sub_ind,:]
-                    if (indVec[self.AtoolsOS.NumbProjBins-1] == 0):
-                        indVec = indVec[:-1] #shrink vector size
-                    if (self.geom == '2D'):
-                         res = self.AtoolsOS.forwprojOS(X_t,sub_ind) - _data_['projection_norm_data'][indVec,:]
-                         res[:,0:None] = res[:,0:None] + _data_['ringGH_accelerate']*r_x[:,0]
-                         vec = vec + (1.0/(_data_['OS_number']))*res.sum(axis = 0)
-                    else:
-                        res = self.AtoolsOS.forwprojOS(X_t,sub_ind) - _data_['projection_norm_data'][:,indVec,:]
-                        for ang_index in range(len(indVec)):
-                            res[:,ang_index,:] = res[:,ang_index,:] + _data_['ringGH_accelerate']*r_x
-                        vec = res.sum(axis = 1)
+                    res_sum = np.zeros(np.shape(r_x[:,0]) if (self.geom == '2D') else np.shape(r_x), 'float32')
+                    for sub_ind in range(_data_['OS_number']):
+                        res = forwproj(X_t,sub_ind)
+                        res -= norm_subsets[sub_ind]
+                        res_sum += res.sum(axis = angles_axis)
+                # the same (1/OS) normalisation of the ring term in 2D and 3D
                 if (self.geom == '2D'):
+                    vec = (1.0/(_data_['OS_number']))*(res_sum + self.angles_number*_data_['ringGH_accelerate']*r_x[:,0])
                     r[:,0] = r_x[:,0] - np.multiply(L_const_inv,vec)
                 else:
+                    vec = (1.0/(_data_['OS_number']))*(res_sum + self.angles_number*_data_['ringGH_accelerate']*r_x)
                     r = r_x - np.multiply(L_const_inv,vec)
 
             if ((_data_['OS_number'] != 1) and (_data_['ring_weights_threshold'] is not None) and (iter > 0)):
                 # Ordered subset approach for a better ring model
-                res_full = self.Atools.forwproj(X_t) - _data_['projection_norm_data']
-                rings_weights = RING_WEIGHTS(res_full, _data_['ring_tuple_halfsizes'][0], _data_['ring_tuple_halfsizes'][1], _data_['ring_tuple_halfsizes'][2])
-                ring_function_weight = np.ones(np.shape(res_full))
-                ring_function_weight[(np.where(np.abs(rings_weights) > _data_['ring_weights_threshold']))] = np.divide(_data_['ring_weights_threshold'], np.abs(rings_weights[(np.where(np.abs(rings_weights) > _data_['ring_weights_threshold']))])**_data_['ring_huber_power'])
-            # loop over subsets (OS)
-            for sub_ind in range(_data_['OS_number']):
-                X_old = X
+                if res_lagged is not None:
+                    res_full = res_lagged # the residuals of the subsets from the previous iteration
+                else:
+                    res_full = self.Atools.forwproj(X_t)
+                    res_full -= _data_['projection_norm_data']
+                # the weights in the layout of the subsets data
+                ring_subsets = subsets_data(ring_weights_function(res_full, _data_, workspace), subsets, angles_axis, out=ring_subsets)
+            # loop over subsets (OS) in the selected order (the full data for the classical approach)
+            for sub_ind in subsets_order(_data_['OS_number'], _algorithm_['OS_ordering'], iter, _algorithm_['OS_seed']):
+                X_old, X = X, X_old # keep the previous solution, X is overwritten below
                 t_old = t
-                if (_data_['OS_number'] > 1):
-                    #select a specific set of indeces for the subset (OS)
-                    indVec = self.AtoolsOS.newInd_Vec[sub_ind,:]
-                    if (indVec[self.AtoolsOS.NumbProjBins-1] == 0):
-                        indVec = indVec[:-1] #shrink vector size
-                    if (_data_['OS_number'] != 1):
-                        # OS-reduced residuals
+                indVec = subsets[sub_ind] #select a specific set of indeces for the subset (OS)
+                res = forwproj(X_t,sub_ind)
+                if (self.datafidelity == 'KL'):
+                    res_denom = workspace_buffer(workspace, 'scratch', np.shape(res))
+                    np.add(res, 1.0, out=res_denom)
+                res -= norm_subsets[sub_ind]
+                if res_lagged is not None:
+                    # kept for the next iteration ring models
+                    if (self.geom == '2D'):
+                        res_lagged[indVec,:] = res
+                    else:
+                        res_lagged[:,indVec,:] = res
+                if (self.datafidelity == 'PWLS'):
+                    # Penalised Weighted Least-squares data fidelity (approximately linear)
+                    res *= raw_subsets[sub_ind]
+                if (self.datafidelity == 'SWLS'):
+                    # Stripe-Weighted Least-squares data fidelity (helps to minimise stripe arifacts)
+                    res = swls_residual(res, raw_subsets[sub_ind], swls_denom[sub_ind], angles_axis, out=res)
+                if (self.datafidelity == 'KL'):
+                    # Kullback-Leibler (KL) data fidelity
+                    res /= res_denom
+                if ((_data_['ringGH_lambda'] is not None) and (iter > 0)):
+                    # ring removal part for Group-Huber (GH) fidelity
+                    if (self.geom == '2D'):
+                        res += _data_['ringGH_accelerate']*r_x[:,0]
+                    else:
+                        res += _data_['ringGH_accelerate']*r_x[:,np.newaxis,:]
+                    if (_data_['OS_number'] == 1):
+                        # the ring variables from the full residual
                         if (self.geom == '2D'):
-                            if (self.datafidelity == 'LS'):
-                                # 2D Least-squares (LS) data fidelity - OS (linear)
-                                res = self.AtoolsOS.forwprojOS(X_t,sub_ind) - _data_['projection_norm_data'][indVec,:]
-                            if (self.datafidelity == 'PWLS'):
-                                # 2D Penalised Weighted Least-squares - OS data fidelity (approximately linear)
-                                res = np.multiply(_data_['projection_raw_data'][indVec,:], (self.AtoolsOS.forwprojOS(X_t,sub_ind) - _data_['projection_norm_data'][indVec,:]))
-                            if (self.datafidelity == 'SWLS'):
-                                # 2D Stripe-Weighted Least-squares - OS data fidelity (helps to minimise stripe arifacts)
-                                res = self.AtoolsOS.forwprojOS(X_t,sub_ind) - _data_['projection_norm_data'][indVec,:]
-                                for det_index in range(self.DetectorsDimH):
-                                    wk = _data_['projection_raw_data'][indVec, det_index]
-                                    res[:,det_index] = np.multiply(wk, res[:,det_index]) - 1.0/(np.sum(wk) + _data_['beta_SWLS'][det_index])*(wk.dot(res[:,det_index]))*wk
-                            if (self.datafidelity == 'KL'):
-                                # 2D Kullback-Leibler (KL) data fidelity - OS
-                                tmp = self.AtoolsOS.forwprojOS(X_t,sub_ind)
-                                res = np.divide(tmp - _data_['projection_norm_data'][indVec,:], tmp + 1.0)
-                            # ring removal part for Group-Huber (GH) fidelity (2D)
-                            if ((_data_['ringGH_lambda'] is not None) and (iter > 0)):
-                                res[:,0:None] = res[:,0:None] + _data_['ringGH_accelerate']*r_x[:,0]
-                            if ((_data_['ring_weights_threshold'] is not None) and (iter > 0)):
-                                res = np.multiply(ring_function_weight[indVec,:],res)
-                        else: # 3D
-                            if (self.datafidelity == 'LS'):
-                                # 3D Least-squares (LS) data fidelity - OS (linear)
-                                res = self.AtoolsOS.forwprojOS(X_t,sub_ind) - _data_['projection_norm_data'][:,indVec,:]
-                            if (self.datafidelity == 'PWLS'):
-                                # 3D Penalised Weighted Least-squares - OS data fidelity (approximately linear)
-                                res = np.multiply(_data_['projection_raw_data'][:,indVec,:], (self.AtoolsOS.forwprojOS(X_t,sub_ind) - _data_['projection_norm_data'][:,indVec,:]))
-                            if (self.datafidelity == 'SWLS'):
-                                # 3D Stripe-Weighted Least-squares - OS data fidelity (helps to minimise stripe arifacts)
-                                res = self.AtoolsOS.forwprojOS(X_t,sub_ind) - _data_['projection_norm_data'][:,indVec,:]
-                                for detVert_index in range(self.DetectorsDimV):
-                                    for detHorz_index in range(self.DetectorsDimH):
-                                        wk = _data_['projection_raw_data'][detVert_index,indVec,detHorz_index]
-                                        res[detVert_index,:,detHorz_index] = np.multiply(wk, res[detVert_index,:,detHorz_index]) - 1.0/(np.sum(wk) + _data_['beta_SWLS'][detHorz_index])*(wk.dot(res[detVert_index,:,detHorz_index]))*wk
-                            if (self.datafidelity == 'KL'):
-                                # 3D Kullback-Leibler (KL) data fidelity - OS
-                                tmp = self.AtoolsOS.forwprojOS(X_t,sub_ind)
-                                res = np.divide(tmp - _data_['projection_norm_data'][:,indVec,:], tmp + 1.0)
-                            # GH - fidelity part (3D)
-                            if ((_data_['ringGH_lambda'] is not None) and (iter > 0)):
-                                for ang_index in range(len(indVec)):
-                                    res[:,ang_index,:] = res[:,ang_index,:] + _data_['ringGH_accelerate']*r_x
-                            if ((_data_['ring_weights_threshold'] is not None) and (iter > 0)):
-                                res = np.multiply(ring_function_weight[:,indVec,:],res)
-                else: # CLASSICAL all-data approach
-                        if (self.datafidelity == 'LS'):
-                            # full residual for LS fidelity
-                            res = self.Atools.forwproj(X_t) - _data_['projection_norm_data']
-                        if (self.datafidelity == 'PWLS'):
-                            # full gradient for the PWLS fidelity
-                            res = np.multiply(_data_['projection_raw_data'], (self.Atools.forwproj(X_t) - _data_['projection_norm_data']))
-                        if (self.datafidelity == 'KL'):
-                            # Kullback-Leibler (KL) data fidelity
-                            tmp = self.Atools.forwproj(X_t)
-                            res = np.divide(tmp - _data_['projection_norm_data'], tmp + 1.0)
-                        if (_data_['ringGH_lambda'] is not None) and (iter > 0):
-                            if (self.geom == '2D'):
-                                res[0:None,:] = res[0:None,:] + _data_['ringGH_accelerate']*r_x[:,0]
-                                vec = res.sum(axis = 0)
-                                r[:,0] = r_x[:,0] - np.multiply(L_const_inv,vec)
-                            else: # 3D case
-                                for ang_index in range(self.angles_number):
-                                    res[:,ang_index,:] = res[:,ang_index,:] + _data_['ringGH_accelerate']*r_x
-                                    vec = res.sum(axis = 1)
-                                    r = r_x - np.multiply(L_const_inv,vec)
-                        if ((_data_['ring_weights_threshold'] is not None) and (iter > 0)):
-                            # Approach for a better ring model
-                            rings_weights = RING_WEIGHTS(res, _data_['ring_tuple_halfsizes'][0], _data_['ring_tuple_halfsizes'][1], _data_['ring_tuple_halfsizes'][2])
-                            ring_function_weight = np.ones(np.shape(res))
-                            ring_function_weight[(np.where(np.abs(rings_weights) > _data_['ring_weights_threshold']))] = np.divide(_data_['ring_weights_threshold'], np.abs(rings_weights[(np.where(np.abs(rings_weights) > _data_['ring_weights_threshold']))])**_data_['ring_huber_power'])
-                            res = np.multiply(ring_function_weight,res)
-                        if (self.datafidelity == 'SWLS'):
-                            res = self.Atools.forwproj(X_t) - _data_['projection_norm_data']
-                            if (self.geom == '2D'):
-                                for det_index in range(self.DetectorsDimH):
-                                    wk = _data_['projection_raw_data'][:,det_index]
-                                    res[:,det_index] = np.multiply(wk, res[:,det_index]) - 1.0/(np.sum(wk) + _data_['beta_SWLS'][det_index])*(wk.dot(res[:,det_index]))*wk
-                            else: # 3D case
-                                for detVert_index in range(self.DetectorsDimV):
-                                    for detHorz_index in range(self.DetectorsDimH):
-                                        wk = _data_['projection_raw_data'][detVert_index,:,detHorz_index]
-                                        res[detVert_index,:,detHorz_index] = np.multiply(wk, res[detVert_index,:,detHorz_index]) - 1.0/(np.sum(wk) + _data_['beta_SWLS'][detHorz_index])*(wk.dot(res[detVert_index,:,detHorz_index]))*wk
-                if (_data_['huber_threshold'] is not None):
-                    # apply Huber penalty
-                    multHuber = np.ones(np.shape(res))
-                    multHuber[(np.where(np.abs(res) > _data_['huber_threshold']))] = np.divide(_data_['huber_threshold'], np.abs(res[(np.where(np.abs(res) > _data_['huber_threshold']))]))
-                    if (_data_['OS_number'] != 1):
-                        # OS-Huber-gradient
-                        grad_fidelity = self.AtoolsOS.backprojOS(np.multiply(multHuber,res), sub_ind)
+                            vec = res.sum(axis = 0)
+                            r[:,0] = r_x[:,0] - np.multiply(L_const_inv,vec)
+                        else:
+                            vec = res.sum(axis = 1)
+                            r = r_x - np.multiply(L_const_inv,vec)
+                if ((_data_['ring_weights_threshold'] is not None) and (iter > 0)):
+                    if (_data_['OS_number'] == 1):
+                        # Approach for a better ring model
+                        ring_function_weight = ring_weights_function(res, _data_, workspace)
+                        res *= ring_function_weight
                     else:
-                        # full Huber gradient
-                        grad_fidelity = self.Atools.backproj(np.multiply(multHuber,res))
+                        res *= ring_subsets[sub_ind]
+                if (_data_['huber_threshold'] is not None):
+                    # apply Huber penalty (the Huber-weighted residual is the clipped residual)
+                    np.clip(res, -_data_['huber_threshold'], _data_['huber_threshold'], out=res)
                 elif (_data_['studentst_threshold'] is not None):
                     # apply Students't penalty
-                    multStudent = np.ones(np.shape(res))
-                    multStudent = np.divide(2.0, _data_['studentst_threshold']**2 + res**2)
-                    if (_data_['OS_number'] != 1):
-                        # OS-Students't-gradient
-                        grad_fidelity = self.AtoolsOS.backprojOS(np.multiply(multStudent,res), sub_ind)
-                    else:
-                        # full Students't gradient
-                        grad_fidelity = self.Atools.backproj(np.multiply(multStudent,res))
-                else:
-                    if (_data_['OS_number'] != 1):
-                        # OS reduced gradient
-                        grad_fidelity = self.AtoolsOS.backprojOS(res, sub_ind)
-                    else:
-                        # full gradient
-                        grad_fidelity = self.Atools.backproj(res)
+                    multStudent = workspace_buffer(workspace, 'scratch', np.shape(res))
+                    np.multiply(res, res, out=multStudent)
+                    multStudent += _data_['studentst_threshold']**2
+                    np.divide(2.0, multStudent, out=multStudent)
+                    res *= multStudent
+                # OS reduced gradient (or the full gradient)
+                grad_fidelity = backproj(res, sub_ind)
 
-                X = X_t - L_const_inv*grad_fidelity
+                np.multiply(grad_fidelity, -L_const_inv, out=X)
+                X += X_t # X = X_t - L_const_inv*grad_fidelity
                 if (_algorithm_['nonnegativity'] == 'ENABLE'):
-                    X[X < 0.0] = 0.0
+                    np.maximum(X, 0.0, out=X)
                 if _algorithm_['mask_diameter'] is not None:
-                    X = circ_mask(X, _algorithm_['mask_diameter']) # applying a circular mask
+                    np.multiply(X, mask, out=X) # applying a circular mask
                 if _regularisation_['method'] is not None:
                     ##### The proximal operator of the chosen regulariser #####
                     (X,info_vec) = prox_regul(self, X, _regularisation_)
                     ###########################################################
                 t = (1.0 + np.sqrt(1.0 + 4.0*t**2))*0.5; # updating t variable
-                X_t = X + ((t_old - 1.0)/t)*(X - X_old) # updating X
+                np.subtract(X, X_old, out=X_t)
+                X_t *= (t_old - 1.0)/t
+                X_t += X # X_t = X + ((t_old - 1.0)/t)*(X - X_old)
             if ((_data_['ringGH_lambda'] is not None) and (iter > 0)):
                 r = np.maximum((np.abs(r) - _data_['ringGH_lambda']), 0.0)*np.sign(r) # soft-thresholding operator for ring vector
                 r_x = r + ((t_old - 1.0)/t)*(r - r_old) # updating r
@@ -649,7 +861,8 @@ class RecToolsIR:
                     print('FISTA stopped at iteration (', iter+1, ')')
             # stopping criteria (checked only after a reasonable number of iterations)
             if (((iter > 10) and (_data_['OS_number'] > 1)) or ((iter > 150) and (_data_['OS_number'] == 1))):
-                nrm = LA.norm(X - X_old)*denomN
+                np.subtract(X, X_old, out=X_old) # X_old is overwritten in the next update
+                nrm = LA.norm(X_old)*denomN
                 if (nrm < _algorithm_['tolerance']):
                     if (_algorithm_['verbose'] == 'on'):
                         print('FISTA stopped at iteration (', iter+1, ')')
@@ -657,6 +870,252 @@ class RecToolsIR:
         return X
 #*****************************FISTA ends here*********************************#
 
+#*****************************FISTA batch*************************************#
+    def FISTA_batch(self, _data_, _algorithm_, _regularisation_):
+        """
+        FISTA reconstruction of a batch of independent 2D sinograms of the same
+        (2D) geometry given as 'projection_norm_data' of the shape
+        [batch, Angles, DetectorsDimH] (and 'projection_raw_data' for PWLS/SWLS).
+        The slices are projected together in one ASTRA call per (sub)iteration
+        using the 3D parallel geometry, the t/momentum variables and the stopping
+        criteria are kept per slice and the regulariser is applied to every
+        slice in 2D. Supported data models: LS, PWLS, SWLS, KL with optional
+        Huber or Student's t penalties and ordered subsets (the ring models
+        ringGH_lambda and ring_weights_threshold are not supported).
+        Returns the reconstructed stack [batch, ObjSize, ObjSize]
+        """
+        import time
+        time_start = time.time()
+        if (self.geom != '2D'):
+            raise ValueError('FISTA_batch requires a 2D geometry (DetectorsDimV = None)')
+        batch = np.shape(_data_['projection_norm_data'])[0]
+        ######################################################################
+        # parameters check and initialisation on a single 2D slice, for PWLS
+        # the maximum weights across the batch give the upper bound of the Lipschitz constants
+        data2D = dict(_data_)
+        data2D['projection_norm_data'] = _data_['projection_norm_data'][0]
+        if ('projection_raw_data' in _data_):
+            if (self.datafidelity == 'PWLS'):
+                data2D['projection_raw_data'] = np.max(_data_['projection_raw_data'], axis=0)
+            else:
+                data2D['projection_raw_data'] = _data_['projection_raw_data'][0]
+        dict_check(self, data2D, _algorithm_, _regularisation_)
+        if ((data2D['ringGH_lambda'] is not None) or (data2D['ring_weights_threshold'] is not None)):
+            raise ValueError('Ring models (ringGH_lambda, ring_weights_threshold) are not supported in FISTA_batch')
+        data = dict(data2D)
+        data['projection_norm_data'] = _data_['projection_norm_data']
+        if ('projection_raw_data' in _data_):
+            data['projection_raw_data'] = _data_['projection_raw_data']
+        OS_number = data['OS_number']
+        batch_tools_init(self, batch, OS_number)
+        ######################################################################
+
+        L_const_inv = 1.0/_algorithm_['lipschitz_const'] # inverted Lipschitz constant
+        if (np.size(_algorithm_['initialise']) == batch*self.ObjSize**2):
+            # the object has been initialised with an array
+            # the y-axis of the 3D ASTRA volume is opposite to the 2D one, the slices are flipped
+            X = np.float32(np.reshape(_algorithm_['initialise'], (batch,self.ObjSize,self.ObjSize))[:,::-1,:])
+        else:
+            X = np.zeros((batch,self.ObjSize,self.ObjSize), 'float32') # initialise with zeros
+        if _algorithm_['mask_diameter'] is not None:
+            mask = circ_mask_cached(self, 3, _algorithm_['mask_diameter'])
+        # the data per subset
+        if (OS_number != 1):
+            subsets = self.AtoolsOS_batch.subsets
+        else:
+            subsets = [None]
+        norm_subsets = subsets_data(data['projection_norm_data'], subsets, 1)
+        if (self.datafidelity in ['PWLS', 'SWLS']):
+            raw_subsets = subsets_data(data['projection_raw_data'], subsets, 1)
+        if (self.datafidelity == 'SWLS'):
+            swls_denom = [swls_denominators(raw_subset, data['beta_SWLS'], 1) for raw_subset in raw_subsets]
+        info_vec = (0,1)
+        #****************************************************************************#
+        t = np.ones((batch,1,1), 'float32') # t variables of every slice
+        active = np.ones(batch, dtype=bool) # slices which have not converged yet
+        denomN = 1.0/(self.ObjSize**2)
+        # the solution buffers (X, X_old, X_t) are updated in place as in FISTA
+        X_old = np.empty(np.shape(X), 'float32')
+        X_t = np.copy(X)
+        workspace = {} # the preallocated residual-sized buffers
+        if (OS_number != 1):
+            forwproj = self.AtoolsOS_batch.forwprojOS
+            backproj = self.AtoolsOS_batch.backprojOS
+        else:
+            forwproj = lambda x, sub_ind: self.Atools_batch.forwproj(x)
+            backproj = lambda y, sub_ind: self.Atools_batch.backproj(y)
+        for iter in range(0,_algorithm_['iterations']):
+            for sub_ind in subsets_order(OS_number, _algorithm_['OS_ordering'], iter, _algorithm_['OS_seed']):
+                X_old, X = X, X_old # keep the previous solution, X is overwritten below
+                t_old = t
+                res = forwproj(X_t, sub_ind)
+                if (self.datafidelity == 'KL'):
+                    res_denom = workspace_buffer(workspace, 'scratch', np.shape(res))
+                    np.add(res, 1.0, out=res_denom)
+                res -= norm_subsets[sub_ind]
+                if (self.datafidelity == 'PWLS'):
+                    # Penalised Weighted Least-squares
+                    res *= raw_subsets[sub_ind]
+                if (self.datafidelity == 'SWLS'):
+                    # Stripe-Weighted Least-squares
+                    res = swls_residual(res, raw_subsets[sub_ind], swls_denom[sub_ind], 1, out=res)
+                if (self.datafidelity == 'KL'):
+                    # Kullback-Leibler (KL) data fidelity
+                    res /= res_denom
+                if (data['huber_threshold'] is not None):
+                    # apply Huber penalty (the Huber-weighted residual is the clipped residual)
+                    np.clip(res, -data['huber_threshold'], data['huber_threshold'], out=res)
+                elif (data['studentst_threshold'] is not None):
+                    # apply Students't penalty
+                    multStudent = workspace_buffer(workspace, 'scratch', np.shape(res))
+                    np.multiply(res, res, out=multStudent)
+                    multStudent += data['studentst_threshold']**2
+                    np.divide(2.0, multStudent, out=multStudent)
+                    res *= multStudent
+                grad_fidelity = backproj(res, sub_ind)
+
+                np.multiply(grad_fidelity, -L_const_inv, out=X)
+                X += X_t # X = X_t - L_const_inv*grad_fidelity
+                if (_algorithm_['nonnegativity'] == 'ENABLE'):
+                    np.maximum(X, 0.0, out=X)
+                if _algorithm_['mask_diameter'] is not None:
+                    np.multiply(X, mask, out=X) # applying a circular mask
+                if _regularisation_['method'] is not None:
+                    ##### The proximal operator of the chosen regulariser (2D, slice by slice) #####
+                    # a 3D regulariser would couple the independent slices of the batch
+                    for slice_ind in np.flatnonzero(active):
+                        (X[slice_ind],info_vec) = prox_regul(self, np.ascontiguousarray(X[slice_ind]), _regularisation_)
+                    ###########################################################
+                t = (1.0 + np.sqrt(1.0 + 4.0*t**2))*0.5; # updating t variables
+                np.subtract(X, X_old, out=X_t)
+                X_t *= (t_old - 1.0)/t
+                X_t += X # X_t = X + ((t_old - 1.0)/t)*(X - X_old)
+                if not active.all():
+                    # the converged slices are kept unchanged
+                    X[~active] = X_old[~active]
+                    X_t[~active] = X_old[~active]
+                    t[~active] = t_old[~active]
+            if (_algorithm_['verbose'] == 'on'):
+                if (np.mod(iter,(round)(_algorithm_['iterations']/5)+1) == 0):
+                    print('FISTA batch iteration (',iter+1,') using', _regularisation_['method'], 'regularisation for (',(int)(info_vec[0]),') iterations,', np.count_nonzero(active), 'slices active')
+            # stopping criteria for every slice (checked only after a reasonable number of iterations)
+            if (((iter > 10) and (OS_number > 1)) or ((iter > 150) and (OS_number == 1))):
+                np.subtract(X, X_old, out=X_old) # X_old is overwritten in the next update
+                nrm = LA.norm(X_old.reshape(batch, -1), axis=1)*denomN
+                active = np.logical_and(active, nrm >= _algorithm_['tolerance'])
+                if not active.any():
+                    break
+        if (_algorithm_['verbose'] == 'on'):
+            time_total = time.time() - time_start
+            print('FISTA batch stopped at iteration (', iter+1, '),', batch, 'slices in', round(time_total,2), 'seconds (', round(batch/time_total,2), 'slices/s )')
+        return np.ascontiguousarray(X[:,::-1,:]) # the orientation of the 2D geometry
+#*****************************FISTA batch ends here**************************#
+
+#**********************************PDHG***************************************#
+    def PDHG(self, _data_, _algorithm_, _regularisation_):
+        """
+        Primal-dual hybrid gradient (Chambolle-Pock) reconstruction with one
+        forward and one backward projection per (sub)iteration. The steps are
+        diagonally preconditioned (Pock and Chambolle, ICCV 2011): the dual step
+        is 1/(A 1) per ray and the primal step is the scalar 1/max(A' 1). With
+        ordered subsets the stochastic PDHG (Chambolle et al., SIAM J. Optim.
+        2018) is used, the subsets are visited in OS_ordering. The regularisation
+        parameter has the same meaning as in FISTA. Supported data models: LS,
+        PWLS and KL (the same models as in FISTA)
+        """
+        ######################################################################
+        # parameters check and initialisation
+        dict_check(self, _data_, _algorithm_, _regularisation_)
+        ######################################################################
+        if (self.datafidelity not in ['LS', 'PWLS', 'KL']):
+            raise ValueError('PDHG supports LS, PWLS and KL data fidelities')
+        if ((_data_['huber_threshold'] is not None) or (_data_['studentst_threshold'] is not None) or
+            (_data_['ringGH_lambda'] is not None) or (_data_['ring_weights_threshold'] is not None)):
+            raise ValueError('Huber, Students t and ring models are not supported in PDHG')
+        if (self.geom == '2D'):
+            rec_shape = (self.ObjSize, self.ObjSize)
+            angles_axis = 0
+        if (self.geom == '3D'):
+            rec_shape = (self.DetectorsDimV, self.ObjSize, self.ObjSize)
+            angles_axis = 1
+        if (np.size(_algorithm_['initialise']) == np.prod(rec_shape)):
+            # the object has been initialised with an array
+            X = np.float32(_algorithm_['initialise']).reshape(rec_shape)
+        else:
+            X = np.zeros(rec_shape, 'float32') # initialise with zeros
+        if _algorithm_['mask_diameter'] is not None:
+            mask = circ_mask_cached(self, np.ndim(X), _algorithm_['mask_diameter'])
+        OS_number = _data_['OS_number']
+        if (OS_number != 1):
+            forwproj = self.AtoolsOS.forwprojOS
+            backproj = self.AtoolsOS.backprojOS
+            subsets = self.AtoolsOS.subsets
+        else:
+            forwproj = lambda x, sub_ind: self.Atools.forwproj(x)
+            backproj = lambda y, sub_ind: self.Atools.backproj(y)
+            subsets = [None] # the full data
+        # the data, the diagonal dual steps and the dual variables of every subset
+        gamma = _algorithm_['PDHG_gamma']
+        rho = 0.99 # < 1 for the convergence
+        data = subsets_data(_data_['projection_norm_data'], subsets, angles_axis)
+        if (self.datafidelity == 'PWLS'):
+            weights = subsets_data(_data_['projection_raw_data'], subsets, angles_axis)
+        else:
+            weights = [None]*OS_number
+        sigma = []
+        y = []
+        colsum_max = 0.0
+        ones = np.ones(rec_shape, 'float32')
+        for sub_ind in range(OS_number):
+            rowsum = forwproj(ones, sub_ind)
+            colsum_max = max(colsum_max, np.max(backproj(np.ones(np.shape(rowsum), 'float32'), sub_ind)))
+            sigma.append(np.float32(np.divide(gamma*rho, rowsum, out=np.zeros(np.shape(rowsum)), where=(rowsum > 0.0))))
+            y.append(np.zeros(np.shape(rowsum), 'float32'))
+        tau = np.float32(rho/(gamma*OS_number*colsum_max))
+        # the primal step scales the regulariser relatively to FISTA with the step 1/L
+        regularisation_PDHG = dict(_regularisation_)
+        regularisation_PDHG['regul_param'] = _regularisation_['regul_param']*tau*OS_number*_algorithm_['lipschitz_const']
+        regularisation_PDHG['regul_param2'] = _regularisation_['regul_param2']*tau*OS_number*_algorithm_['lipschitz_const']
+        info_vec = (0,1)
+        #****************************************************************************#
+        # PDHG algorithm begins here:
+        denomN = 1.0/np.size(X)
+        Z = np.zeros(rec_shape, 'float32') # the sum of the backprojected dual variables
+        Z_bar = np.zeros(rec_shape, 'float32') # the extrapolated Z
+        for iter in range(0,_algorithm_['iterations']):
+            for sub_ind in subsets_order(OS_number, _algorithm_['OS_ordering'], iter, _algorithm_['OS_seed']):
+                X_old = X
+                # the primal update
+                X = X - tau*Z_bar
+                if (_algorithm_['nonnegativity'] == 'ENABLE'):
+                    X[X < 0.0] = 0.0
+                if _algorithm_['mask_diameter'] is not None:
+                    np.multiply(X, mask, out=X) # applying a circular mask
+                if _regularisation_['method'] is not None:
+                    ##### The proximal operator of the chosen regulariser #####
+                    (X,info_vec) = prox_regul(self, X, regularisation_PDHG)
+                    ###########################################################
+                # the dual update of the subset
+                y_new = pdhg_dual_prox(self.datafidelity, y[sub_ind] + sigma[sub_ind]*forwproj(X, sub_ind), sigma[sub_ind], data[sub_ind], weights[sub_ind])
+                delta = backproj(y_new - y[sub_ind], sub_ind)
+                y[sub_ind] = y_new
+                Z += delta
+                Z_bar = Z + OS_number*delta # extrapolation
+            if (_algorithm_['verbose'] == 'on'):
+                if (np.mod(iter,(round)(_algorithm_['iterations']/5)+1) == 0):
+                    print('PDHG iteration (',iter+1,') using', _regularisation_['method'], 'regularisation for (',(int)(info_vec[0]),') iterations')
+                if (iter == _algorithm_['iterations']-1):
+                    print('PDHG stopped at iteration (', iter+1, ')')
+            # stopping criteria (checked only after a reasonable number of iterations)
+            if (((iter > 10) and (OS_number > 1)) or ((iter > 150) and (OS_number == 1))):
+                nrm = LA.norm(X - X_old)*denomN
+                if (nrm < _algorithm_['tolerance']):
+                    if (_algorithm_['verbose'] == 'on'):
+                        print('PDHG stopped at iteration (', iter+1, ')')
+                    break
+        return X
+#*****************************PDHG ends here*********************************#
+
 #**********************************ADMM***************************************#
     def ADMM(self, _data_, _algorithm_, _regularisation_):
         ######################################################################
@@ -664,67 +1123,67 @@ class RecToolsIR:
         dict_check(self, _data_, _algorithm_, _regularisation_)
         ######################################################################
 
+        if (self.geom == '2D'):
+            rec_shape = (self.ObjSize, self.ObjSize)
+        if (self.geom == '3D'):
+            rec_shape = (self.DetectorsDimV, self.ObjSize, self.ObjSize)
+        rho = _algorithm_['ADMM_rho_const']
         def ADMM_Ax(x):
-            data_upd = self.Atools.A_optomo(x)
-            x_temp = self.Atools.A_optomo.transposeOpTomo(data_upd)
-            x_upd = x_temp + _algorithm_['ADMM_rho_const']*x
+            x_upd = self.Atools.backproj(self.Atools.forwproj(x))
+            x_upd += rho*x
             return x_upd
-        def ADMM_Atb(b):
-            b = self.Atools.A_optomo.transposeOpTomo(b)
-            return b
-        (data_dim,rec_dim) = np.shape(self.Atools.A_optomo)
+        if (_algorithm_['ADMM_precondition'] == 'on'):
+            precond = admm_precond_init(self, rec_shape, rho)
+            ADMM_M = lambda res: admm_precond(res, precond)
+        else:
+            ADMM_M = None
 
         # initialise the solution and other ADMM variables
-        if (np.size(_algorithm_['initialise']) == rec_dim):
+        if (np.size(_algorithm_['initialise']) == np.prod(rec_shape)):
             # the object has been initialised with an array
-            X = _algorithm_['initialise'].ravel()
+            X = np.float32(_algorithm_['initialise']).reshape(rec_shape)
         else:
-            X = np.zeros(rec_dim, 'float32')
+            X = np.zeros(rec_shape, 'float32')
 
         info_vec = (0,2)
         denomN = 1.0/np.size(X)
-        z = np.zeros(rec_dim, 'float32')
-        u = np.zeros(rec_dim, 'float32')
-        b_to_solver_const = self.Atools.A_optomo.transposeOpTomo(_data_['projection_norm_data'].ravel())
+        z = np.zeros(rec_shape, 'float32')
+        u = np.zeros(rec_shape, 'float32')
+        b_to_solver_const = self.Atools.backproj(_data_['projection_norm_data'])
 
         # Outer ADMM iterations
         for iter in range(0,_algorithm_['iterations']):
-            X_old = X
-            # solving quadratic problem using linalg solver
-            A_to_solver = scipy.sparse.linalg.LinearOperator((rec_dim,rec_dim), matvec=ADMM_Ax, rmatvec=ADMM_Atb)
-            b_to_solver = b_to_solver_const + _algorithm_['ADMM_rho_const']*(z-u)
-            outputSolver = scipy.sparse.linalg.gmres(A_to_solver, b_to_solver, tol = 1e-05, maxiter = 15)
-            X = np.float32(outputSolver[0]) # get gmres solution
+            X_old = X.copy()
+            # solving quadratic problem with the conjugate gradient warm-started from the previous X
+            b_to_solver = b_to_solver_const + rho*(z-u)
+            solver_tolerance = admm_solver_tolerance(_algorithm_['ADMM_solver_tolerance'], iter, _algorithm_['iterations'])
+            solver_iterations = pcg_solve(ADMM_Ax, b_to_solver, X, ADMM_M, solver_tolerance, _algorithm_['ADMM_solver_iterations'])
             if (_algorithm_['nonnegativity'] == 'ENABLE'):
                 X[X < 0.0] = 0.0
             # z-update with relaxation
             zold = z.copy();
             x_hat = _algorithm_['ADMM_relax_par']*X + (1.0 - _algorithm_['ADMM_relax_par'])*zold;
-            if (self.geom == '2D'):
-                x_prox_reg = (x_hat + u).reshape([self.ObjSize, self.ObjSize])
-            if (self.geom == '3D'):
-                x_prox_reg = (x_hat + u).reshape([self.DetectorsDimV, self.ObjSize, self.ObjSize])
+            x_prox_reg = x_hat + u
             # Apply regularisation using CCPi-RGL toolkit. The proximal operator of the chosen regulariser
             if (_regularisation_['method'] is not None):
                 # The proximal operator of the chosen regulariser
                 (z,info_vec) = prox_regul(self, x_prox_reg, _regularisation_)
-            z = z.ravel()
+            else:
+                z = x_prox_reg
             # update u variable
             u = u + (x_hat - z)
             if (_algorithm_['verbose'] == 'on'):
                 if (np.mod(iter,(round)(_algorithm_['iterations']/5)+1) == 0):
-                    print('ADMM iteration (',iter+1,') using', _regularisation_['method'], 'regularisation for (',(int)(info_vec[0]),') iterations')
-            if (iter == _algorithm_['iterations']-1):
-                print('ADMM stopped at iteration (', iter+1, ')')
+                    print('ADMM iteration (',iter+1,') using', _regularisation_['method'], 'regularisation for (',(int)(info_vec[0]),') iterations, CG iterations (',solver_iterations,')')
+                if (iter == _algorithm_['iterations']-1):
+                    print('ADMM stopped at iteration (', iter+1, ')')
 
             # stopping criteria (checked after reasonable number of iterations)
             if (iter > 5):
                 nrm = LA.norm(X - X_old)*denomN
                 if nrm < _algorithm_['tolerance']:
-                    print('ADMM stopped at iteration (', iter, ')')
+                    if (_algorithm_['verbose'] == 'on'):
+                        print('ADMM stopped at iteration (', iter+1, ')')
                     break
-        if (self.geom == '2D'):
-            return X.reshape([self.ObjSize, self.ObjSize])
-        if (self.geom == '3D'):
-            return X.reshape([self.DetectorsDimV, self.ObjSize, self.ObjSize])
+        return X
 #*****************************ADMM ends here*********************************#
@@ -6,10 +6,20 @@ data using parallel beam geometry
 - SIRT algorithm from ASTRA
 - CGLS algorithm from ASTRA
 
+Select device 'cpu_matrix' to project on the CPU with a precomputed sparse system
+matrix of the ASTRA 'line' projector (2D only) instead of tracing the rays in every
+call, with TOMOBAR_CACHE_DIR set the matrix is kept in the on-disk cache (see
+tomobar.supp.cacheTools) and read by the following reconstructions of the same geometry.
+The 3D classes run on the CPU with device 'cpu' or 'cpu_matrix' as stacks of 2D
+projections of the slices (see SlabProjector3D)
+
 GPLv3 license (ASTRA toolbox)
 @author: Daniil Kazantsev: https://github.com/dkazanc
 """
+import weakref
 import numpy as np
+from tomobar.supp.cacheTools import DiskCache, cache_dir_explicit, geometry_hash
+from tomobar.supp.subsets import subsets_partition
 
 try:
     import astra
@@ -27,51 +37,174 @@ def rotation_matrix3D(theta):
                      [np.sin(theta), np.cos(theta), 0.0],
                      [0.0 , 0.0 , 1.0]])
 
+# the memoized geometry vectors (the last geometries used)
+vec_geom_cache = {}
+vec_geom_cache_size = 16
+
+def vec_geom_cached(key, init_func):
+    # returns the (read-only) vectors of the key, computed with init_func once
+    if key not in vec_geom_cache:
+        if len(vec_geom_cache) >= vec_geom_cache_size:
+            vec_geom_cache.pop(next(iter(vec_geom_cache)))
+        vectors = init_func()
+        vectors.setflags(write=False)
+        vec_geom_cache[key] = vectors
+    return vec_geom_cache[key]
+
 #define 2D vector geometry
 def vec_geom_init2D(angles_rad, DetectorSpacingX, CenterRotOffset):
-    s0 = [0.0, -1.0] # source
-    u0 = [DetectorSpacingX, 0.0] # detector coordinates
-    vectors = np.zeros([angles_rad.size, 6])
-    for i in range(0,angles_rad.size):
-        if np.ndim(CenterRotOffset) == 0:
-            d0 = [CenterRotOffset, 0.0] # detector
-        else:
-            d0 = [CenterRotOffset[i], 0.0] # detector
-        theta = angles_rad[i]
-        vec_temp = np.dot(rotation_matrix2D(theta),s0)
-        vectors[i,0:2] = vec_temp[:] # ray position
-        vec_temp = np.dot(rotation_matrix2D(theta),d0)
-        vectors[i,2:4] = vec_temp[:] # center of detector position
-        vec_temp = np.dot(rotation_matrix2D(theta),u0)
-        vectors[i,4:6] = vec_temp[:] # detector pixel (0,0) to (0,1).
-    return vectors
+    # the rotated source s0 = [0,-1], detector d0 = [CoR,0] and pixel u0 = [DetectorSpacingX,0]
+    # vectors for all angles at once, the vectors of a subset of angles are the rows of the array
+    def init_func():
+        theta = np.asarray(angles_rad, dtype=np.float64)
+        cos_theta = np.cos(theta)
+        sin_theta = np.sin(theta)
+        CoR = np.asarray(CenterRotOffset, dtype=np.float64)
+        vectors = np.zeros([theta.size, 6])
+        vectors[:,0] = sin_theta # ray position
+        vectors[:,1] = -cos_theta
+        vectors[:,2] = CoR*cos_theta # center of detector position
+        vectors[:,3] = CoR*sin_theta
+        vectors[:,4] = DetectorSpacingX*cos_theta # detector pixel (0,0) to (0,1).
+        vectors[:,5] = DetectorSpacingX*sin_theta
+        return vectors
+    return vec_geom_cached(geometry_hash('vec_geom_init2D', angles_rad, DetectorSpacingX, CenterRotOffset), init_func)
 
 #define 3D vector geometry
 def vec_geom_init3D(angles_rad, DetectorSpacingX, DetectorSpacingY, CenterRotOffset):
-    s0 = [0.0, -1.0, 0.0] # source
-    u0 = [DetectorSpacingX, 0.0, 0.0] # detector coordinates
-    v0 = [0.0, 0.0, DetectorSpacingY] # detector coordinates
-
-    vectors = np.zeros([angles_rad.size,12])
-    for i in range(0,angles_rad.size):
+    # the rotated source s0 = [0,-1,0], detector d0 = [CoR[:,1],0,CoR[:,0]] and pixels
+    # u0 = [DetectorSpacingX,0,0], v0 = [0,0,DetectorSpacingY] vectors for all angles at once
+    def init_func():
+        theta = np.asarray(angles_rad, dtype=np.float64)
+        cos_theta = np.cos(theta)
+        sin_theta = np.sin(theta)
         if np.ndim(CenterRotOffset) == 0:
-            d0 = [CenterRotOffset, 0.0, 0.0] # detector
+            CoR_H = float(CenterRotOffset)
+            CoR_V = 0.0
         else:
-            d0 = [CenterRotOffset[i,1], 0.0, CenterRotOffset[i,0]] # detector
-        theta = angles_rad[i]
-        vec_temp = np.dot(rotation_matrix3D(theta),s0)
-        vectors[i,0:3] = vec_temp[:] # ray position
-        vec_temp = np.dot(rotation_matrix3D(theta),d0)
-        vectors[i,3:6] = vec_temp[:] # center of detector position
-        vec_temp = np.dot(rotation_matrix3D(theta),u0)
-        vectors[i,6:9] = vec_temp[:] # detector pixel (0,0) to (0,1).
-        vec_temp = np.dot(rotation_matrix3D(theta),v0)
-        vectors[i,9:12] = vec_temp[:] # Vector from detector pixel (0,0) to (1,0)
-    return vectors
+            CoR_H = np.asarray(CenterRotOffset[:,1], dtype=np.float64)
+            CoR_V = np.asarray(CenterRotOffset[:,0], dtype=np.float64)
+        vectors = np.zeros([theta.size,12])
+        vectors[:,0] = sin_theta # ray position
+        vectors[:,1] = -cos_theta
+        vectors[:,3] = CoR_H*cos_theta # center of detector position
+        vectors[:,4] = CoR_H*sin_theta
+        vectors[:,5] = CoR_V
+        vectors[:,6] = DetectorSpacingX*cos_theta # detector pixel (0,0) to (0,1).
+        vectors[:,7] = DetectorSpacingX*sin_theta
+        vectors[:,11] = DetectorSpacingY # Vector from detector pixel (0,0) to (1,0)
+        return vectors
+    return vec_geom_cached(geometry_hash('vec_geom_init3D', angles_rad, DetectorSpacingX, DetectorSpacingY, CenterRotOffset), init_func)
+
+def _astra_algorithm2D(alg_type, proj_id, sino_id, vol_id):
+    """create a persistent 2D forward ('FP') or backprojection ('BP') ASTRA algorithm object"""
+    cfg = astra.astra_dict(alg_type)
+    cfg['ProjectorId'] = proj_id
+    cfg['ProjectionDataId'] = sino_id
+    if alg_type.startswith('FP'):
+        cfg['VolumeDataId'] = vol_id
+    else:
+        cfg['ReconstructionDataId'] = vol_id
+    return astra.algorithm.create(cfg)
+
+def _astra_release2D(algorithms, data2d, projectors):
+    """delete the ASTRA algorithms, 2D data objects and projectors (a finalizer of the classes)"""
+    astra.algorithm.delete(algorithms)
+    astra.data2d.delete(data2d)
+    for proj_id in projectors:
+        astra.projector.delete(proj_id)
+
+def system_matrix2D(proj_geom, vol_geom, key):
+    """
+    the system matrix of the ASTRA 'line' projector for the given geometry as
+    a CSR matrix (float32 values). With TOMOBAR_CACHE_DIR set the matrix is read
+    from the on-disk cache when the key (a hash of the geometry) is found,
+    otherwise it is built and cached (one .npz entry), without TOMOBAR_CACHE_DIR
+    it is built in memory
+    """
+    import scipy.sparse
+    cache = DiskCache('system_matrix', 32*1024**3, suffix='.npz') if cache_dir_explicit() else None
+    arrays = None if cache is None else cache.get(key)
+    if arrays is None:
+        proj_id = astra.create_projector('line', proj_geom, vol_geom)
+        matrix_id = astra.projector.matrix(proj_id)
+        matrix = astra.matrix.get(matrix_id)
+        astra.matrix.delete(matrix_id)
+        astra.projector.delete(proj_id)
+        arrays = {'data' : np.float32(matrix.data), 'indices' : matrix.indices, 'indptr' : matrix.indptr, 'shape' : np.array(matrix.shape)}
+        if cache is not None:
+            cache.put(key, arrays)
+    return scipy.sparse.csr_matrix((arrays['data'], arrays['indices'], arrays['indptr']), shape=tuple(arrays['shape']), copy=False)
+
+class SparseMatrixOP:
+    """
+    Forward/backprojection with a CSR system matrix for the blocks of its rows
+    (the whole matrix or a subset of the angles). Every block is split into
+    row chunks (views of the matrix arrays) which are multiplied concurrently
+    by the thread pool, the backprojection sums the chunks' contributions
+    """
+    def __init__(self, matrix, DetectorsDim, blocks, workers=None):
+        import os
+        import scipy.sparse
+        from concurrent.futures import ThreadPoolExecutor
+        self.DetectorsDim = DetectorsDim
+        self.ObjSize = int(np.sqrt(matrix.shape[1]))
+        if workers is None:
+            workers = os.cpu_count()
+        self.workers = workers
+        self.pool = ThreadPoolExecutor(workers) if (workers > 1) else None
+        self.chunks = {}
+        # blocks: {block index: (the first angle, the last angle + 1)} of the matrix rows
+        for (block, (angle_start, angle_end)) in blocks.items():
+            rows = np.linspace(angle_start*DetectorsDim, angle_end*DetectorsDim, min(workers, angle_end - angle_start) + 1).astype(np.int64)
+            self.chunks[block] = []
+            for (row_start, row_end) in zip(rows[:-1], rows[1:]):
+                ptr_start = matrix.indptr[row_start]
+                ptr_end = matrix.indptr[row_end]
+                chunk = scipy.sparse.csr_matrix((matrix.data[ptr_start:ptr_end], matrix.indices[ptr_start:ptr_end],
+                                                 matrix.indptr[row_start:row_end+1] - ptr_start),
+                                                shape=(row_end - row_start, matrix.shape[1]), copy=False)
+                self.chunks[block].append((row_start - angle_start*DetectorsDim, row_end - angle_start*DetectorsDim, chunk))
+    def _map(self, func, chunks):
+        if self.pool is None:
+            return [func(chunk) for chunk in chunks]
+        return list(self.pool.map(func, chunks))
+    def close(self):
+        if self.pool is not None:
+            self.pool.shutdown()
+            self.pool = None
+    def forwproj(self, image, block):
+        """Applying forward projection with the rows of the block"""
+        x = np.ravel(np.asarray(image, dtype=np.float32))
+        chunks = self.chunks[block]
+        sinogram = np.empty(chunks[-1][1], dtype=np.float32)
+        def forw_chunk(chunk):
+            (row_start, row_end, matrix) = chunk
+            sinogram[row_start:row_end] = matrix.dot(x)
+        self._map(forw_chunk, chunks)
+        return sinogram.reshape(-1, self.DetectorsDim)
+    def backproj(self, sinogram, block):
+        """Applying backprojection with the rows of the block"""
+        y = np.ravel(np.asarray(sinogram, dtype=np.float32))
+        def back_chunk(chunk):
+            (row_start, row_end, matrix) = chunk
+            return matrix.T.dot(y[row_start:row_end])
+        image = np.sum(self._map(back_chunk, self.chunks[block]), axis=0, dtype=np.float32)
+        return image.reshape(self.ObjSize, self.ObjSize)
 
 class AstraTools:
-    """2D parallel beam projection/backprojection class based on ASTRA toolbox"""
-    def __init__(self, DetectorsDim, AnglesVec, CenterRotOffset, ObjSize, device):
+    """
+    2D parallel beam projection/backprojection class based on ASTRA toolbox
+
+    The projector, the sinogram/volume data objects and the forward/backprojection
+    algorithms are created once and reused by every call, the data is moved in
+    and out of ASTRA with astra.data2d.store/get. Release the ASTRA objects with
+    close() or use the class as a context manager, otherwise they are released
+    when the instance is garbage collected. With device 'cpu_matrix' the system
+    matrix operator (a SparseMatrixOP with matrix_workers threads) can be shared
+    by the instances of the same geometry by passing it as matrix.
+    """
+    def __init__(self, DetectorsDim, AnglesVec, CenterRotOffset, ObjSize, device, matrix_workers=None, matrix=None):
         self.DetectorsDim = DetectorsDim
         self.AnglesVec = AnglesVec
         self.ObjSize = ObjSize
@@ -83,191 +216,363 @@ class AstraTools:
             vectors = vec_geom_init2D(AnglesVec, 1.0, CenterRotOffset)
             self.proj_geom = astra.create_proj_geom('parallel_vec', DetectorsDim, vectors)
         self.vol_geom = astra.create_vol_geom(ObjSize, ObjSize)
-        if device == 'cpu':
+        self.matrix = None
+        if device in ['cpu', 'cpu_matrix']:
             self.proj_id = astra.create_projector('line', self.proj_geom, self.vol_geom) # for CPU
             self.device = 1
+            alg_suffix = ''
         elif device == 'gpu':
             self.proj_id = astra.create_projector('cuda', self.proj_geom, self.vol_geom) # for GPU
             self.device = 0
+            alg_suffix = '_CUDA'
         else:
-            print ("Select between 'cpu' or 'gpu' for device")
+            raise ValueError("Select between 'cpu', 'cpu_matrix' or 'gpu' for device")
+        if (device == 'cpu_matrix') and (matrix is not None):
+            self.matrix = matrix
+        elif device == 'cpu_matrix':
+            # CPU projection with the precomputed sparse system matrix
+            key = geometry_hash('system_matrix2D', DetectorsDim, AnglesVec, CenterRotOffset, ObjSize)
+            self.matrix = SparseMatrixOP(system_matrix2D(self.proj_geom, self.vol_geom, key), DetectorsDim, {0: (0, np.size(AnglesVec))}, matrix_workers)
         # add optomo operator
         self.A_optomo = astra.OpTomo(self.proj_id)
+        # persistent data objects and projection algorithms
+        self.sino_id = astra.data2d.create('-sino', self.proj_geom, 0.0)
+        self.vol_id = astra.data2d.create('-vol', self.vol_geom, 0.0)
+        self.fp_id = _astra_algorithm2D('FP' + alg_suffix, self.proj_id, self.sino_id, self.vol_id)
+        self.bp_id = _astra_algorithm2D('BP' + alg_suffix, self.proj_id, self.sino_id, self.vol_id)
+        self._finalizer = weakref.finalize(self, _astra_release2D, [self.fp_id, self.bp_id], [self.sino_id, self.vol_id], [self.proj_id])
+
+    def __enter__(self):
+        return self
+    def __exit__(self, *args):
+        self.close()
+    def close(self):
+        """Release all ASTRA objects owned by the class"""
+        if self.proj_id is None:
+            return
+        self._finalizer()
+        self.proj_id = None
+        if self.matrix is not None:
+            self.matrix.close()
 
     def forwproj(self, image):
         """Applying forward projection"""
-        sinogram_id, sinogram = astra.create_sino(image, self.proj_id)
-        astra.data2d.delete(sinogram_id)
-        astra.data2d.delete(self.proj_id)
-        return sinogram
+        if self.matrix is not None:
+            return self.matrix.forwproj(image, 0)
+        astra.data2d.store(self.vol_id, image)
+        astra.algorithm.run(self.fp_id)
+        return astra.data2d.get(self.sino_id)
     def backproj(self, sinogram):
         """Applying backprojection"""
-        rec_id, image = astra.create_backprojection(sinogram, self.proj_id)
-        astra.data2d.delete(self.proj_id)
-        astra.data2d.delete(rec_id)
-        return image
-    def fbp2D(self, sinogram):
-        """perform FBP reconstruction"""
-        rec_id = astra.data2d.create( '-vol', self.vol_geom)
-        # Create a data object to hold the sinogram data
-        sinogram_id = astra.data2d.create('-sino', self.proj_geom, sinogram)
-
+        if self.matrix is not None:
+            return self.matrix.backproj(sinogram, 0)
+        astra.data2d.store(self.sino_id, sinogram)
+        astra.algorithm.run(self.bp_id)
+        return astra.data2d.get(self.vol_id)
+    def _run2D(self, alg_type, sinogram, iterations, FilterType=None):
+        """run an ASTRA reconstruction algorithm on the persistent data objects"""
+        astra.data2d.store(self.sino_id, sinogram)
+        astra.data2d.store(self.vol_id, 0.0)
         if self.device == 1:
-            cfg = astra.astra_dict('FBP')
+            cfg = astra.astra_dict(alg_type)
             cfg['ProjectorId'] = self.proj_id
         else:
-            cfg = astra.astra_dict('FBP_CUDA')
-        cfg['ReconstructionDataId'] = rec_id
-        cfg['ProjectionDataId'] = sinogram_id
-        cfg['FilterType'] = 'Ram-Lak'
-
+            cfg = astra.astra_dict(alg_type + '_CUDA')
+        cfg['ReconstructionDataId'] = self.vol_id
+        cfg['ProjectionDataId'] = self.sino_id
+        if FilterType is not None:
+            cfg['FilterType'] = FilterType
         # Create and run the algorithm object from the configuration structure
         alg_id = astra.algorithm.create(cfg)
-        astra.algorithm.run(alg_id)
-        # Get the result
-        recFBP = astra.data2d.get(rec_id)
-
+        astra.algorithm.run(alg_id, iterations)
         astra.algorithm.delete(alg_id)
-        astra.data2d.delete(rec_id)
-        astra.data2d.delete(sinogram_id)
-        astra.data2d.delete(self.proj_id)
-        return recFBP
+        # Get the result
+        return astra.data2d.get(self.vol_id)
+    def fbp2D(self, sinogram):
+        """perform FBP reconstruction"""
+        return self._run2D('FBP', sinogram, 1, FilterType='Ram-Lak')
     def sirt2D(self, sinogram, iterations):
         """perform SIRT reconstruction"""
-        rec_id = astra.data2d.create( '-vol', self.vol_geom)
-        # Create a data object to hold the sinogram data
-        sinogram_id = astra.data2d.create('-sino', self.proj_geom, sinogram)
-
-        if self.device == 1:
-            cfg = astra.astra_dict('SIRT')
-            cfg['ProjectorId'] = self.proj_id
-        else:
-            cfg = astra.astra_dict('SIRT_CUDA')
-        cfg['ReconstructionDataId'] = rec_id
-        cfg['ProjectionDataId'] = sinogram_id
-
-        # Create and run the algorithm object from the configuration structure
-        alg_id = astra.algorithm.create(cfg)
-        astra.algorithm.run(alg_id, iterations)
-        # Get the result
-        recSIRT = astra.data2d.get(rec_id)
-
-        astra.algorithm.delete(alg_id)
-        astra.data2d.delete(rec_id)
-        astra.data2d.delete(sinogram_id)
-        astra.data2d.delete(self.proj_id)
-        return recSIRT
+        return self._run2D('SIRT', sinogram, iterations)
     def cgls2D(self, sinogram, iterations):
         """perform CGLS reconstruction"""
-        rec_id = astra.data2d.create( '-vol', self.vol_geom)
-        # Create a data object to hold the sinogram data
-        sinogram_id = astra.data2d.create('-sino', self.proj_geom, sinogram)
-
-        if self.device == 1:
-            cfg = astra.astra_dict('CGLS')
-            cfg['ProjectorId'] = self.proj_id
-        else:
-            cfg = astra.astra_dict('CGLS_CUDA')
-        cfg['ReconstructionDataId'] = rec_id
-        cfg['ProjectionDataId'] = sinogram_id
-
-        # Create and run the algorithm object from the configuration structure
-        alg_id = astra.algorithm.create(cfg)
-        astra.algorithm.run(alg_id, iterations)
-        # Get the result
-        recCGLS = astra.data2d.get(rec_id)
-
-        astra.algorithm.delete(alg_id)
-        astra.data2d.delete(rec_id)
-        astra.data2d.delete(sinogram_id)
-        astra.data2d.delete(self.proj_id)
-        return recCGLS
+        return self._run2D('CGLS', sinogram, iterations)
 
 class AstraToolsOS:
     """
     2D ordered subset parallel beam projection/backprojection class based
     on ASTRA toolbox
+
+    The ASTRA objects for the full geometry and for every subset are created
+    once and reused, release them with close() or use the class as a
+    context manager, otherwise they are released when the instance is
+    garbage collected. With device 'cpu_matrix' the system matrix operator can
+    be shared by the instances of the same geometry as in AstraTools.
     """
-    def __init__(self, DetectorsDim, AnglesVec, CenterRotOffset, ObjSize, OS, device):
+    def __init__(self, DetectorsDim, AnglesVec, CenterRotOffset, ObjSize, OS, device, matrix_workers=None, matrix=None):
         self.DetectorsDim = DetectorsDim
         self.AnglesVec = AnglesVec
         self.ObjSize = ObjSize
+        self.OS = OS
 
         ################ arrange ordered-subsets ################
-        import numpy as np
         AnglesTot = np.size(AnglesVec) # total number of angles
         self.NumbProjBins = (int)(np.ceil(float(AnglesTot)/float(OS))) # get the number of projections per bin (subset)
-        self.newInd_Vec = np.zeros([OS,self.NumbProjBins],dtype='int') # 2D array of OS-sorted indeces
-        for sub_ind in range(OS):
-            ind_sel = 0
-            for proj_ind in range(self.NumbProjBins):
-                indexS = ind_sel + sub_ind
-                if (indexS < AnglesTot):
-                    self.newInd_Vec[sub_ind,proj_ind] = indexS
-                    ind_sel += OS
+        self.subsets = subsets_partition(AnglesTot, OS) # the angles indices of every subset
 
         # create full ASTRA geometry (to calculate Lipshitz constant)
         vectors = vec_geom_init2D(AnglesVec, 1.0, CenterRotOffset)
         self.proj_geom = astra.create_proj_geom('parallel_vec', DetectorsDim, vectors)
         self.vol_geom = astra.create_vol_geom(ObjSize, ObjSize)
-        if device == 'cpu':
+        self.matrix = None
+        if device in ['cpu', 'cpu_matrix']:
             self.proj_id = astra.create_projector('line', self.proj_geom, self.vol_geom) # for CPU
             self.device = 1
+            alg_suffix = ''
         elif device == 'gpu':
             self.proj_id = astra.create_projector('cuda', self.proj_geom, self.vol_geom) # for GPU
             self.device = 0
+            alg_suffix = '_CUDA'
         else:
-            print ("Select between 'cpu' or 'gpu' for device")
+            raise ValueError("Select between 'cpu', 'cpu_matrix' or 'gpu' for device")
+        self.vol_id = astra.data2d.create('-vol', self.vol_geom, 0.0)
+        self.sino_id = astra.data2d.create('-sino', self.proj_geom, 0.0)
+        self.fp_id = _astra_algorithm2D('FP' + alg_suffix, self.proj_id, self.sino_id, self.vol_id)
+        self.bp_id = _astra_algorithm2D('BP' + alg_suffix, self.proj_id, self.sino_id, self.vol_id)
         # create OS-specific ASTRA geometry
         self.proj_geom_OS = {}
         self.proj_id_OS = {}
+        self.sino_id_OS = {}
+        self.fp_id_OS = {}
+        self.bp_id_OS = {}
         for sub_ind in range(OS):
-            self.indVec = self.newInd_Vec[sub_ind,:] # OS-specific indices
-            if (self.indVec[self.NumbProjBins-1] == 0):
-                self.indVec = self.indVec[:-1] #shrink vector size
-            anglesOS = self.AnglesVec[self.indVec] # OS-specific angles
-
-            if np.ndim(CenterRotOffset) == 0: # CenterRotOffset is a _scalar_
-                    vectorsOS = vec_geom_init2D(anglesOS, 1.0, CenterRotOffset)
-                    #self.proj_geom_OS[sub_ind] = astra.create_proj_geom('parallel', 1.0, DetectorsDim, anglesOS)
-            else: # CenterRotOffset is a _vector_
-                vectorsOS = vec_geom_init2D(anglesOS, 1.0, CenterRotOffset[self.indVec])
+            vectorsOS = vectors[self.subsets[sub_ind]] # OS-specific rows of the full geometry
             self.proj_geom_OS[sub_ind] = astra.create_proj_geom('parallel_vec', DetectorsDim, vectorsOS)
             if self.device == 1:
                 self.proj_id_OS[sub_ind] = astra.create_projector('line', self.proj_geom_OS[sub_ind], self.vol_geom) # for CPU
             if self.device == 0:
                 self.proj_id_OS[sub_ind] = astra.create_projector('cuda', self.proj_geom_OS[sub_ind], self.vol_geom) # for GPU
+            self.sino_id_OS[sub_ind] = astra.data2d.create('-sino', self.proj_geom_OS[sub_ind], 0.0)
+            self.fp_id_OS[sub_ind] = _astra_algorithm2D('FP' + alg_suffix, self.proj_id_OS[sub_ind], self.sino_id_OS[sub_ind], self.vol_id)
+            self.bp_id_OS[sub_ind] = _astra_algorithm2D('BP' + alg_suffix, self.proj_id_OS[sub_ind], self.sino_id_OS[sub_ind], self.vol_id)
+        self._finalizer = weakref.finalize(self, _astra_release2D,
+                                           [self.fp_id, self.bp_id] + list(self.fp_id_OS.values()) + list(self.bp_id_OS.values()),
+                                           [self.sino_id, self.vol_id] + list(self.sino_id_OS.values()),
+                                           [self.proj_id] + list(self.proj_id_OS.values()))
+        if device == 'cpu_matrix':
+            # CPU projection with the precomputed sparse system matrix, the rows are
+            # sorted by subsets so that every subset is a contiguous block of rows
+            self.angles_order = np.concatenate(self.subsets)
+        if (device == 'cpu_matrix') and (matrix is not None):
+            self.matrix = matrix
+        elif device == 'cpu_matrix':
+            proj_geom_order = astra.create_proj_geom('parallel_vec', DetectorsDim, vectors[self.angles_order])
+            key = geometry_hash('system_matrix2D', DetectorsDim, AnglesVec, CenterRotOffset, ObjSize, self.angles_order)
+            blocks = {'full': (0, AnglesTot)}
+            angle_start = 0
+            for sub_ind in range(OS):
+                blocks[sub_ind] = (angle_start, angle_start + np.size(self.subsets[sub_ind]))
+                angle_start += np.size(self.subsets[sub_ind])
+            self.matrix = SparseMatrixOP(system_matrix2D(proj_geom_order, self.vol_geom, key), DetectorsDim, blocks, matrix_workers)
+
+    def __enter__(self):
+        return self
+    def __exit__(self, *args):
+        self.close()
+    def close(self):
+        """Release all ASTRA objects owned by the class"""
+        if self.proj_id is None:
+            return
+        self._finalizer()
+        self.proj_id = None
+        if self.matrix is not None:
+            self.matrix.close()
 
     def forwprojOS(self, image, no_os):
         """Applying forward projection for a specific subset"""
-        sinogram_id, sinogram = astra.create_sino(image, self.proj_id_OS[no_os])
-        astra.data2d.delete(sinogram_id)
-        astra.data2d.delete(self.proj_id_OS[no_os])
-        return sinogram
+        if self.matrix is not None:
+            return self.matrix.forwproj(image, no_os)
+        astra.data2d.store(self.vol_id, image)
+        astra.algorithm.run(self.fp_id_OS[no_os])
+        return astra.data2d.get(self.sino_id_OS[no_os])
     def backprojOS(self, sinogram, no_os):
         """Applying backprojection for a specific subset"""
-        rec_id, image = astra.create_backprojection(sinogram, self.proj_id_OS[no_os])
-        astra.data2d.delete(rec_id)
-        astra.data2d.delete(self.proj_id_OS[no_os])
-        return image
+        if self.matrix is not None:
+            return self.matrix.backproj(sinogram, no_os)
+        astra.data2d.store(self.sino_id_OS[no_os], sinogram)
+        astra.algorithm.run(self.bp_id_OS[no_os])
+        return astra.data2d.get(self.vol_id)
     def forwproj(self, image):
         """Applying forward projection"""
-        sinogram_id, sinogram = astra.create_sino(image, self.proj_id)
-        astra.data2d.delete(sinogram_id)
-        astra.data2d.delete(self.proj_id)
-        return sinogram
+        if self.matrix is not None:
+            sinogram = np.empty((np.size(self.AnglesVec), self.DetectorsDim), dtype=np.float32)
+            sinogram[self.angles_order] = self.matrix.forwproj(image, 'full')
+            return sinogram
+        astra.data2d.store(self.vol_id, image)
+        astra.algorithm.run(self.fp_id)
+        return astra.data2d.get(self.sino_id)
     def backproj(self, sinogram):
         """Applying backprojection"""
-        rec_id, image = astra.create_backprojection(sinogram, self.proj_id)
-        astra.data2d.delete(self.proj_id)
-        astra.data2d.delete(rec_id)
-        return image
+        if self.matrix is not None:
+            return self.matrix.backproj(np.asarray(sinogram)[self.angles_order], 'full')
+        astra.data2d.store(self.sino_id, sinogram)
+        astra.algorithm.run(self.bp_id)
+        return astra.data2d.get(self.vol_id)
+
+class SlabProjector3D:
+    """
+    CPU 3D parallel beam projection/backprojection as a stack of 2D projections
+    of the volume slices, computed concurrently for the slabs of slices (every
+    worker owns its 2D AstraTools/AstraToolsOS object, with device 'cpu_matrix'
+    they share one single-threaded system matrix operator). The vertical detector
+    offsets of the parallel3d_vec geometry (CenterRotOffset[:,0]) and a different
+    number of the slices and detector rows are applied by the linear
+    interpolation along the detector rows for every angle. The y-axis of the 2D
+    ASTRA volume is opposite to the 3D one, hence the slices are flipped
+    vertically for the 2D projection
+    """
+    def __init__(self, DetColumnCount, DetRowCount, AnglesVec, CenterRotOffset, ObjSize, OS, device, workers=None):
+        import os
+        from concurrent.futures import ThreadPoolExecutor
+        if type(ObjSize) == tuple:
+            Y,X,Z = [int(i) for i in ObjSize]
+        else:
+            Y=X=ObjSize
+            Z=DetRowCount
+        if (Y != X):
+            raise ValueError("The CPU 3D projection requires the square slices of the object")
+        self.DetectorsDimV = DetRowCount
+        self.slices = Z
+        self.ObjSize = X
+        if np.ndim(CenterRotOffset) == 0:
+            CenterRotOffset_H = CenterRotOffset
+            shifts = np.zeros(np.size(AnglesVec))
+        else:
+            CenterRotOffset_H = CenterRotOffset[:,1]
+            shifts = np.float64(CenterRotOffset[:,0])
+        # the (fractional) slice index of the detector row 0 for every angle
+        shifts = shifts + 0.5*(Z - DetRowCount)
+        if workers is None:
+            workers = os.cpu_count()
+        self.workers = max(min(workers, Z), 1)
+        # the slabs are already projected concurrently, the system matrix (device 'cpu_matrix')
+        # is built once by the first worker and multiplied by a single thread in every worker
+        if OS is None:
+            self.tools = [AstraTools(DetColumnCount, AnglesVec, CenterRotOffset_H, X, device, 1)]
+            self.tools += [AstraTools(DetColumnCount, AnglesVec, CenterRotOffset_H, X, device, 1, self.tools[0].matrix) for i in range(1, self.workers)]
+            self.shifts = {None: shifts}
+        else:
+            self.tools = [AstraToolsOS(DetColumnCount, AnglesVec, CenterRotOffset_H, X, OS, device, 1)]
+            self.tools += [AstraToolsOS(DetColumnCount, AnglesVec, CenterRotOffset_H, X, OS, device, 1, self.tools[0].matrix) for i in range(1, self.workers)]
+            self.shifts = {None: shifts}
+            for sub_ind in range(OS):
+                self.shifts[sub_ind] = shifts[self.tools[0].subsets[sub_ind]]
+        self.slabs = np.array_split(np.arange(Z), self.workers)
+        self.pool = ThreadPoolExecutor(self.workers) if (self.workers > 1) else None
+
+    def close(self):
+        for tools in self.tools:
+            tools.close()
+        if self.pool is not None:
+            self.pool.shutdown()
+            self.pool = None
+    def _map(self, func):
+        # runs func(tools, slab) for every worker (ASTRA releases the GIL while projecting)
+        if self.pool is None:
+            func(self.tools[0], self.slabs[0])
+        else:
+            list(self.pool.map(func, self.tools, self.slabs))
+    def _rows_interpolation(self, data, shifts, adjoint):
+        # maps the projections of the slices [slices, angles, detectors] to the detector
+        # rows [DetectorsDimV, angles, detectors] (adjoint=False) or back (adjoint=True)
+        if not np.any(shifts) and (self.slices == self.DetectorsDimV):
+            return data
+        if adjoint:
+            result = np.zeros((self.slices,) + np.shape(data)[1:], dtype=np.float32)
+        else:
+            result = np.zeros((self.DetectorsDimV,) + np.shape(data)[1:], dtype=np.float32)
+        (shifts_unique, shifts_inverse) = np.unique(shifts, return_inverse=True)
+        for (i, shift) in enumerate(shifts_unique):
+            angles = slice(None) if (np.size(shifts_unique) == 1) else np.flatnonzero(shifts_inverse == i)
+            shift_int = int(np.floor(shift))
+            for (slice_offset, weight) in [(shift_int, 1.0 - (shift - shift_int)), (shift_int + 1, shift - shift_int)]:
+                # the detector row r sees the slice r + slice_offset
+                row_start = max(0, -slice_offset)
+                row_end = min(self.DetectorsDimV, self.slices - slice_offset)
+                if (weight == 0.0) or (row_end <= row_start):
+                    continue
+                rows = slice(row_start, row_end)
+                slices = slice(row_start + slice_offset, row_end + slice_offset)
+                if adjoint:
+                    result[slices, angles, :] += np.float32(weight)*data[rows, angles, :]
+                else:
+                    result[rows, angles, :] += np.float32(weight)*data[slices, angles, :]
+        return result
+    def forwproj(self, object3D, no_os=None):
+        """Applying forward projection (to the subset no_os)"""
+        proj_slices = [None]*self.slices
+        def forw_slab(tools, slab):
+            for i in slab:
+                if no_os is None:
+                    proj_slices[i] = tools.forwproj(object3D[i,::-1,:])
+                else:
+                    proj_slices[i] = tools.forwprojOS(object3D[i,::-1,:], no_os)
+        self._map(forw_slab)
+        return self._rows_interpolation(np.stack(proj_slices), self.shifts[no_os], False)
+    def backproj(self, proj_data, no_os=None):
+        """Applying backprojection (of the subset no_os)"""
+        proj_slices = self._rows_interpolation(proj_data, self.shifts[no_os], True)
+        object3D = np.empty((self.slices, self.ObjSize, self.ObjSize), dtype=np.float32)
+        def back_slab(tools, slab):
+            for i in slab:
+                if no_os is None:
+                    object3D[i,::-1,:] = tools.backproj(proj_slices[i])
+                else:
+                    object3D[i,::-1,:] = tools.backprojOS(proj_slices[i], no_os)
+        self._map(back_slab)
+        return object3D
+    def sirt3D(self, sinogram, iterations):
+        """SIRT reconstruction (the same update as the ASTRA SIRT algorithm)"""
+        ones = np.ones((self.slices, self.ObjSize, self.ObjSize), dtype=np.float32)
+        row_sums = self.forwproj(ones)
+        R = np.divide(1.0, row_sums, out=np.zeros(np.shape(row_sums), dtype=np.float32), where=(row_sums > 0.0))
+        col_sums = self.backproj(np.ones(np.shape(sinogram), dtype=np.float32))
+        C = np.divide(1.0, col_sums, out=np.zeros(np.shape(col_sums), dtype=np.float32), where=(col_sums > 0.0))
+        X = np.zeros(np.shape(ones), dtype=np.float32)
+        for iter in range(0, iterations):
+            X += C*self.backproj(R*(sinogram - self.forwproj(X)))
+        return X
+    def cgls3D(self, sinogram, iterations):
+        """CGLS reconstruction"""
+        X = np.zeros((self.slices, self.ObjSize, self.ObjSize), dtype=np.float32)
+        r = np.float32(sinogram).copy()
+        p = self.backproj(r)
+        gamma = np.vdot(p, p)
+        for iter in range(0, iterations):
+            if (gamma == 0.0):
+                break
+            q = self.forwproj(p)
+            alpha = gamma/np.vdot(q, q)
+            X += alpha*p
+            r -= alpha*q
+            z = self.backproj(r)
+            gamma_new = np.vdot(z, z)
+            p = z + (gamma_new/gamma)*p
+            gamma = gamma_new
+        return X
 
 class AstraTools3D:
-    """3D parallel beam projection/backprojection class based on ASTRA toolbox"""
-    def __init__(self, DetColumnCount, DetRowCount, AnglesVec, CenterRotOffset, ObjSize):
+    """
+    3D parallel beam projection/backprojection class based on ASTRA toolbox,
+    device 'gpu' (default) or 'cpu'/'cpu_matrix' (see SlabProjector3D)
+    """
+    def __init__(self, DetColumnCount, DetRowCount, AnglesVec, CenterRotOffset, ObjSize, device='gpu'):
         self.ObjSize = ObjSize
         self.DetectorsDimV = DetRowCount
+        if CenterRotOffset is None:
+            CenterRotOffset = 0.0
+        if device not in ['cpu', 'cpu_matrix', 'gpu']:
+            raise ValueError("Select between 'cpu', 'cpu_matrix' or 'gpu' for device")
         # define astra type geometry (scalar)
         # self.proj_geom = astra.create_proj_geom('parallel3d', 1.0, 1.0, DetRowCount, DetColumnCount, AnglesVec):
         # define astra vector geometry
@@ -279,21 +584,46 @@ class AstraTools3D:
             Y=X=ObjSize
             Z=DetRowCount
         self.vol_geom = astra.create_vol_geom(Y,X,Z)
+        self.slab = None
+        if device in ['cpu', 'cpu_matrix']:
+            self.slab = SlabProjector3D(DetColumnCount, DetRowCount, AnglesVec, CenterRotOffset, ObjSize, None, device)
+            self.proj_id = None
+            return
         self.proj_id = astra.create_projector('cuda3d', self.proj_geom, self.vol_geom) # for GPU
         self.A_optomo = astra.OpTomo(self.proj_id)
+        self._finalizer = weakref.finalize(self, astra.projector3d.delete, self.proj_id)
+
+    def __enter__(self):
+        return self
+    def __exit__(self, *args):
+        self.close()
+    def close(self):
+        """Release all ASTRA objects owned by the class"""
+        if self.slab is not None:
+            self.slab.close()
+        if self.proj_id is None:
+            return
+        self._finalizer()
+        self.proj_id = None
 
     def forwproj(self, object3D):
         """Applying forward projection"""
+        if self.slab is not None:
+            return self.slab.forwproj(object3D)
         proj_id, proj_data = astra.create_sino3d_gpu(object3D, self.proj_geom, self.vol_geom)
         astra.data3d.delete(proj_id)
         return proj_data
     def backproj(self, proj_data):
         """Applying backprojection"""
+        if self.slab is not None:
+            return self.slab.backproj(proj_data)
         rec_id, object3D = astra.create_backprojection3d_gpu(proj_data, self.proj_geom, self.vol_geom)
         astra.data3d.delete(rec_id)
         return object3D
     def sirt3D(self, sinogram, iterations):
         """perform SIRT reconstruction"""
+        if self.slab is not None:
+            return self.slab.sirt3D(sinogram, iterations)
         sinogram_id = astra.data3d.create("-sino", self.proj_geom, sinogram)
         # Create a data object for the reconstruction
         rec_id = astra.data3d.create('-vol', self.vol_geom)
@@ -316,6 +646,8 @@ class AstraTools3D:
         return recSIRT
     def cgls3D(self, sinogram, iterations):
         """perform CGLS reconstruction"""
+        if self.slab is not None:
+            return self.slab.cgls3D(sinogram, iterations)
         sinogram_id = astra.data3d.create("-sino", self.proj_geom, sinogram)
         # Create a data object for the reconstruction
         rec_id = astra.data3d.create('-vol', self.vol_geom)
@@ -340,11 +672,16 @@ class AstraTools3D:
 class AstraToolsOS3D:
     """
     3D ordered subset parallel beam projection/backprojection class based
-    on ASTRA toolbox
+    on ASTRA toolbox, device 'gpu' (default) or 'cpu'/'cpu_matrix' (see SlabProjector3D)
     """
-    def __init__(self, DetColumnCount, DetRowCount, AnglesVec, CenterRotOffset, ObjSize, OS):
+    def __init__(self, DetColumnCount, DetRowCount, AnglesVec, CenterRotOffset, ObjSize, OS, device='gpu'):
         self.ObjSize = ObjSize
         self.DetectorsDimV = DetRowCount
+        self.OS = OS
+        if CenterRotOffset is None:
+            CenterRotOffset = 0.0
+        if device not in ['cpu', 'cpu_matrix', 'gpu']:
+            raise ValueError("Select between 'cpu', 'cpu_matrix' or 'gpu' for device")
         if type(ObjSize) == tuple:
             Y,X,Z = [int(i) for i in ObjSize]
         else:
@@ -353,17 +690,9 @@ class AstraToolsOS3D:
         self.vol_geom = astra.create_vol_geom(Y,X,Z)
 
         ################ arrange ordered-subsets ################
-        import numpy as np
         AnglesTot = np.size(AnglesVec) # total number of angles
         self.NumbProjBins = (int)(np.ceil(float(AnglesTot)/float(OS))) # get the number of projections per bin (subset)
-        self.newInd_Vec = np.zeros([OS,self.NumbProjBins],dtype='int') # 2D array of OS-sorted indeces
-        for sub_ind in range(OS):
-            ind_sel = 0
-            for proj_ind in range(self.NumbProjBins):
-                indexS = ind_sel + sub_ind
-                if (indexS < AnglesTot):
-                    self.newInd_Vec[sub_ind,proj_ind] = indexS
-                    ind_sel += OS
+        self.subsets = subsets_partition(AnglesTot, OS) # the angles indices of every subset
 
         # create full ASTRA geometry (to calculate Lipshitz constant)
         vectors = vec_geom_init3D(AnglesVec, 1.0, 1.0, CenterRotOffset)
@@ -371,33 +700,45 @@ class AstraToolsOS3D:
         # create OS-specific ASTRA geometry
         self.proj_geom_OS = {}
         for sub_ind in range(OS):
-            self.indVec = self.newInd_Vec[sub_ind,:]
-            if (self.indVec[self.NumbProjBins-1] == 0):
-                self.indVec = self.indVec[:-1] #shrink vector size
-            anglesOS = AnglesVec[self.indVec] # OS-specific angles
-
-            if np.ndim(CenterRotOffset) == 0: # CenterRotOffset is a _scalar_
-                vectors = vec_geom_init3D(anglesOS, 1.0, 1.0, CenterRotOffset)
-            else: # CenterRotOffset is a _vector_
-                vectors = vec_geom_init3D(anglesOS, 1.0, 1.0, CenterRotOffset[self.indVec])
-            self.proj_geom_OS[sub_ind] = astra.create_proj_geom('parallel3d_vec', DetRowCount, DetColumnCount, vectors)
+            vectorsOS = vectors[self.subsets[sub_ind]] # OS-specific rows of the full geometry
+            self.proj_geom_OS[sub_ind] = astra.create_proj_geom('parallel3d_vec', DetRowCount, DetColumnCount, vectorsOS)
+        self.slab = None
+        if device in ['cpu', 'cpu_matrix']:
+            self.slab = SlabProjector3D(DetColumnCount, DetRowCount, AnglesVec, CenterRotOffset, ObjSize, OS, device)
+
+    def __enter__(self):
+        return self
+    def __exit__(self, *args):
+        self.close()
+    def close(self):
+        """Release the CPU projectors (the GPU 3D data objects are created per call)"""
+        if self.slab is not None:
+            self.slab.close()
     def forwproj(self, object3D):
         """Applying forward projection"""
+        if self.slab is not None:
+            return self.slab.forwproj(object3D)
         proj_id, proj_data = astra.create_sino3d_gpu(object3D, self.proj_geom, self.vol_geom)
         astra.data3d.delete(proj_id)
         return proj_data
     def backproj(self, proj_data):
         """Applying backprojection"""
+        if self.slab is not None:
+            return self.slab.backproj(proj_data)
         rec_id, object3D = astra.create_backprojection3d_gpu(proj_data, self.proj_geom, self.vol_geom)
         astra.data3d.delete(rec_id)
         return object3D
     def forwprojOS(self, object3D, no_os):
         """Applying forward projection to a specific subset"""
+        if self.slab is not None:
+            return self.slab.forwproj(object3D, no_os)
         proj_id, proj_data = astra.create_sino3d_gpu(object3D, self.proj_geom_OS[no_os], self.vol_geom)
         astra.data3d.delete(proj_id)
         return proj_data
     def backprojOS(self, proj_data, no_os):
         """Applying back-projection to a specific subset"""
+        if self.slab is not None:
+            return self.slab.backproj(proj_data, no_os)
         rec_id, object3D = astra.create_backprojection3d_gpu(proj_data, self.proj_geom_OS[no_os], self.vol_geom)
         astra.data3d.delete(rec_id)
         return object3D
@@ -0,0 +1,119 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+On-disk cache for the quantities which depend only on the geometry of the
+reconstruction problem (e.g. Lipschitz constants), so that they can be reused
+between reconstructions and sessions.
+    geometry_hash - a hash key from scalars, strings, tuples and numpy arrays
+    DiskCache - a directory of .npy (arrays) or .npz (dictionaries of arrays)
+                files with size-bounded LRU eviction
+
+The cache directory is taken from the TOMOBAR_CACHE_DIR environment variable,
+otherwise ~/.cache/tomobar is used. The large entries (the system matrices) are
+cached only when TOMOBAR_CACHE_DIR is set explicitly (see cache_dir_explicit).
+
+@author: Daniil Kazantsev: https://github.com/dkazanc
+"""
+import os
+import hashlib
+import tempfile
+import zipfile
+import numpy as np
+
+def cache_dir():
+    # the root directory of the ToMoBAR cache
+    path = os.environ.get('TOMOBAR_CACHE_DIR')
+    if path is None:
+        path = os.path.join(os.path.expanduser('~'), '.cache', 'tomobar')
+    return path
+
+def cache_dir_explicit():
+    # True if the cache directory is set with TOMOBAR_CACHE_DIR by the user
+    return os.environ.get('TOMOBAR_CACHE_DIR') is not None
+
+def geometry_hash(*args):
+    # a hex key of the given scalars, strings, tuples/lists and numpy arrays
+    hasher = hashlib.sha1()
+    for item in args:
+        if item is None or np.ndim(item) == 0 and not isinstance(item, np.ndarray):
+            hasher.update(repr(item).encode())
+        elif isinstance(item, (tuple, list)):
+            hasher.update(geometry_hash(*item).encode())
+        else:
+            item = np.ascontiguousarray(item)
+            hasher.update((str(item.dtype) + str(item.shape)).encode())
+            hasher.update(memoryview(item).cast('B'))
+        hasher.update(b'|')
+    return hasher.hexdigest()
+
+class DiskCache:
+    """
+    A directory of numpy arrays stored as <key>.npy files or, with suffix='.npz',
+    of dictionaries of arrays stored together as <key>.npz files (the arrays of
+    an entry are evicted together). The least recently used files are removed
+    when the total size exceeds max_bytes
+    """
+    def __init__(self, name, max_bytes, suffix='.npy'):
+        self.path = os.path.join(cache_dir(), name)
+        self.max_bytes = max_bytes
+        self.suffix = suffix
+
+    def filename(self, key):
+        return os.path.join(self.path, key + self.suffix)
+
+    def get(self, key, mmap_mode=None):
+        """returns the cached array (the dictionary of arrays for .npz) or None"""
+        filename = self.filename(key)
+        try:
+            if (self.suffix == '.npz'):
+                with np.load(filename) as npz:
+                    value = {name : npz[name] for name in npz.files}
+            else:
+                value = np.load(filename, mmap_mode=mmap_mode)
+            os.utime(filename) # mark as recently used
+        except (OSError, ValueError, zipfile.BadZipFile):
+            return None
+        return value
+
+    def put(self, key, value):
+        """stores the array or the dictionary of arrays (written to a temporary
+        file first, then renamed), the temporary file is removed on failure"""
+        tmpname = None
+        try:
+            os.makedirs(self.path, exist_ok=True)
+            fd, tmpname = tempfile.mkstemp(dir=self.path, suffix='.tmp')
+            with os.fdopen(fd, 'wb') as tmpfile:
+                if (self.suffix == '.npz'):
+                    np.savez(tmpfile, **value)
+                else:
+                    np.save(tmpfile, value)
+            os.replace(tmpname, self.filename(key))
+        except OSError:
+            print('____! Failed to write to the cache directory', self.path, '!____')
+            if tmpname is not None:
+                try:
+                    os.remove(tmpname)
+                except OSError:
+                    pass
+            return
+        self.evict()
+
+    def evict(self):
+        """removes the least recently used files to keep the size under max_bytes"""
+        entries = []
+        for entry in os.scandir(self.path):
+            if entry.name.endswith(self.suffix):
+                try:
+                    stat = entry.stat()
+                except OSError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+        total = sum(size for (_, size, _) in entries)
+        for (_, size, filename) in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(filename)
+            except OSError:
+                pass
+            total -= size
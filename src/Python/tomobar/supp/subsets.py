@@ -0,0 +1,73 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Ordered subsets of the projection angles shared by the OS projection classes
+(AstraToolsOS, AstraToolsOS3D) and the OS reconstruction methods of RecToolsIR.
+    subsets_partition - the angles indices of every subset (interleaved subsets)
+    subsets_order - the order in which the subsets are visited in an epoch (an
+                    outer iteration): 'interleaved' (0,1,2,...), 'bit-reversal',
+                    'golden-angle' or 'random' (a new permutation every epoch)
+
+The subset sub_ind holds the angles sub_ind, sub_ind+OS, sub_ind+2*OS, ...
+hence the visiting order defines the angular distance between the consecutive
+subsets: the bit-reversal and the golden-angle orderings keep the consecutive
+subsets far apart, which often speeds up the OS convergence.
+
+@author: Daniil Kazantsev: https://github.com/dkazanc
+"""
+import numpy as np
+
+SUBSETS_ORDERINGS = ['interleaved', 'bit-reversal', 'golden-angle', 'random']
+
+def subsets_partition(AnglesTot, OS):
+    # a list of OS arrays with the angles indices of every subset (the last
+    # subsets are one angle shorter if AnglesTot is not divisible by OS)
+    if (OS < 1) or (OS > AnglesTot):
+        raise ValueError("The number of subsets must be between 1 and the number of angles")
+    indices = np.arange(AnglesTot)
+    angles_order = np.argsort(indices % OS, kind='stable')
+    bins = np.bincount(indices % OS, minlength=OS)
+    return np.split(angles_order, np.cumsum(bins)[:-1])
+
+def bit_reversal_order(OS):
+    # the bit-reversal permutation of range(OS), for OS other than a power of 2
+    # the permutation of the next power of 2 is truncated
+    bits = max(int(OS - 1).bit_length(), 1)
+    indices = np.arange(2**bits)
+    reversed_indices = np.zeros_like(indices)
+    for bit in range(bits):
+        reversed_indices |= ((indices >> bit) & 1) << (bits - 1 - bit)
+    return reversed_indices[reversed_indices < OS]
+
+def golden_angle_order(OS):
+    # the subsets visited with the golden ratio step along the [0,1) interval
+    # of the subset offsets: the k-th subset is the rank of frac(k/phi)
+    points = np.mod(np.arange(OS)*(0.5*(np.sqrt(5.0) - 1.0)), 1.0)
+    return np.argsort(np.argsort(points, kind='stable'), kind='stable')
+
+def subsets_order(OS, ordering='interleaved', epoch=0, seed=None):
+    # the order of the subsets in the given epoch (outer iteration)
+    if ordering == 'interleaved':
+        return np.arange(OS)
+    if ordering == 'bit-reversal':
+        return bit_reversal_order(OS)
+    if ordering == 'golden-angle':
+        return golden_angle_order(OS)
+    if ordering == 'random':
+        rng = np.random.default_rng(None if seed is None else [seed, epoch])
+        return rng.permutation(OS)
+    raise ValueError("Select OS ordering from " + ", ".join(SUBSETS_ORDERINGS))
+
+def subsets_data(data, subsets, angles_axis, out=None):
+    # the projection data (or the weights) split into the C-contiguous float32
+    # arrays of the subsets to be reused over the iterations instead of gathering
+    # the subsets from the data in every iteration. The arrays of the out list are
+    # refilled if given. For the classical approach (subsets [None]) the data is
+    # returned as it is in a list
+    if subsets[0] is None:
+        return [data]
+    if out is None:
+        return [np.ascontiguousarray(np.take(data, indVec, axis=angles_axis), dtype='float32') for indVec in subsets]
+    for (indVec, data_subset) in zip(subsets, out):
+        np.take(data, indVec, axis=angles_axis, out=data_subset)
+    return out
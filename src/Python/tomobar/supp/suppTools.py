@@ -4,13 +4,19 @@
 Supplementary data tools:
     normaliser - to normalise the raw data and take the negative log (if needed)
         have options: 'mean', 'median' and 'dynamic'
+    normaliser_stream - out-of-core normaliser of np.memmap/h5py datasets
+    dffc_coefficients - the eigen flat fields coefficients of the dynamic normaliser
     autocropper - automatically crops the 3D projection data to reduce its size
 
 @authors: Daniil Kazantsev: https://github.com/dkazanc
           Gerard Jover Pujol https://github.com/IararIV/
 """
+import os
+import atexit
+import multiprocessing.util
 import numpy as np
 import scipy
+from concurrent.futures import ThreadPoolExecutor
 from skimage.transform import downscale_local_mean
 from skimage.restoration import estimate_sigma
 
@@ -20,7 +26,7 @@ except:
     print('____! BM3D module is required to use for dynamic flat fields calculation !____')
 
 
-def DFFC(data, flats, darks, downsample, nrPArepetions):
+def DFFC(data, flats, darks, downsample, nrPArepetions, workers=1, progress=None, PAretries=3, seed=None):
     # Load frames
     meanDarkfield = np.mean(darks, axis=1, dtype=np.float64)
     whiteVect = np.zeros((flats.shape[1], flats.shape[0]*flats.shape[2]), dtype=np.float64)
@@ -32,58 +38,21 @@ def DFFC(data, flats, darks, downsample, nrPArepetions):
     M, N = whiteVect.shape
     Data = whiteVect - mn
 
-    # =============================================================================
-    # Parallel Analysis (EEFs selection):
-    #      Selection of the number of components for PCA using parallel Analysis.
-    #      Each flat field is a single row of the matrix flatFields, different
-    #      rows are different observations.
-    # =============================================================================
-
-    def cov(X):
-        one_vector = np.ones((1,X.shape[0]))
-        mu = np.dot(one_vector, X) / X.shape[0]
-        X_mean_subtract = X - mu
-        covA = np.dot(X_mean_subtract.T, X_mean_subtract) / (X.shape[0] - 1);
-        return covA
-
-    def parallelAnalysis(flatFields, repetitions):
-        stdEFF = np.std(flatFields, axis=0, ddof=1, dtype=np.float64)
-        H, W = flatFields.shape
-        keepTrack = np.zeros((H, repetitions), dtype=np.float64)
-        stdMatrix = np.tile(stdEFF, (H, 1))
-        for i in range(repetitions):
-            print(f"Parallel Analysis - repetition {i}")
-            sample = stdMatrix * np.random.randn(H, W)
-            D1, _ = np.linalg.eig(np.cov(sample))
-            keepTrack[:,i] = D1.copy()
-        mean_flat_fields_EFF = np.mean(flatFields, axis=0)
-        F = flatFields - mean_flat_fields_EFF
-        D1, V1 = np.linalg.eig(np.cov(F))
-        selection = np.zeros((1,H))
-        # mean + 2 * std
-        selection[:,D1>(np.mean(keepTrack, axis=1) + 2 * np.std(keepTrack, axis=1, ddof=1))] = 1
-        numberPC = np.sum(selection)
-        return V1, D1, int(numberPC)
-
-    # Parallel Analysis
-    nrEigenflatfields = 0
+    # Parallel Analysis (EEFs selection), see parallel_analysis
     print("Parallel Analysis:")
-    while (nrEigenflatfields <= 0):
-        V1, D1, nrEigenflatfields = parallelAnalysis(Data,nrPArepetions)
+    V1, D1, nrEigenflatfields = parallel_analysis(Data, nrPArepetions, np.random.default_rng(seed), PAretries)
+    if (nrEigenflatfields <= 0):
+        print("____! No eigen flat fields above the noise level, the first one is used !____")
+        nrEigenflatfields = 1
     print(f"{nrEigenflatfields} eigen flat fields selected!")
-    idx = D1.argsort()[::-1]
-    D1 = D1[idx]
-    V1 = V1[:,idx]
 
     # Calculation eigen flat fields
     H, C, W = data.shape
     eig0 = mn.reshape((H,W))
     EFF = np.zeros((nrEigenflatfields+1, H, W)) #n_EFF + 1 eig0
-    EFF_denoised = np.zeros((nrEigenflatfields+1, H, W)) #n_EFF + 1 eig0
     print("Calculating EFFs:")
     EFF[0] = eig0
-    for i in range(nrEigenflatfields):
-        EFF[i+1] = (np.matmul(Data.T, V1[i]).T).reshape((H,W))
+    np.matmul(V1[:,:nrEigenflatfields].T, Data, out=EFF[1:].reshape((nrEigenflatfields, H*W)))
 
     EFF_denoised = EFF.copy()
     # Denoise eigen flat fields
@@ -98,71 +67,355 @@ def DFFC(data, flats, darks, downsample, nrPArepetions):
         EFF_denoised[i,:,:] = (EFF_denoised[i,:,:] * (EFF_max - EFF_min)) + EFF_min
 
     print("Denoising completed.")
-    # =============================================================================
-    # cost_func: cost funcion used to estimate the weights using TV
-    # =============================================================================
-
-    def cost_func(x, *args):
-        (projections, meanFF, FF, DF) = args
-        FF_eff = np.zeros((FF.shape[1], FF.shape[2]))
-        for i in range(len(FF)):
-            FF_eff  = FF_eff + x[i] * FF[i]
-        logCorProj=(projections-DF)/(meanFF+FF_eff)*np.mean(meanFF.flatten()+FF_eff.flatten());
-        Gx, Gy = np.gradient(logCorProj)
-        mag = (Gx**2 + Gy**2)**(1/2)
-        cost = np.sum(mag.flatten())
-        return cost
-
-    # =============================================================================
-    # CondTVmean function: finds the optimal estimates  of the coefficients of the
-    # eigen flat fields.
-    # =============================================================================
-
-    def condTVmean(projection, meanFF, FF, DF, x, DS):
-        # Downsample image
-        projection = downscale_local_mean(projection, (DS, DS))
-        meanFF = downscale_local_mean(meanFF, (DS, DS))
-        FF2 = np.zeros((FF.shape[0], meanFF.shape[0], meanFF.shape[1]))
-        for i in range(len(FF)):
-            FF2[i] = downscale_local_mean(FF[i], (DS, DS))
-        FF = FF2
-        DF = downscale_local_mean(DF, (DS, DS))
-        # Optimize weights (x)
-        x = scipy.optimize.minimize(cost_func, 
-                                    x, 
-                                    args=(projection, meanFF, FF, DF), 
-                                    method='BFGS', 
-                                    tol=1e-8)
-        return x.x
-
     H, C, W = data.shape
     print("TV optimisation for DFF coefficients:")
+    weights = dffc_coefficients(data, EFF_denoised, meanDarkfield, downsample, workers, progress)
     clean_DFFC = np.zeros((H, C, W), dtype=np.float64)
     for i in range(C):
-        if i%5 == 0: print("Normalising projection", i)
         projection = data[:,i,:]
-        # Estimate weights for a single projection
-        meanFF = EFF_denoised[0]
-        FF = EFF_denoised[1:]
-        weights = np.zeros(nrEigenflatfields)
-        x=condTVmean(projection, meanFF, FF, meanDarkfield, weights, downsample)
+        x = weights[i]
         # Dynamic FFC
-        FFeff = np.zeros(meanDarkfield.shape)
-        for j in range(nrEigenflatfields):
-            FFeff = FFeff + x[j] * EFF_denoised[j+1]
+        FFeff = np.tensordot(x, EFF_denoised[1:], axes=1)
         tmp = np.divide((projection - meanDarkfield),(EFF_denoised[0] + FFeff))
         clean_DFFC[:,i,:] = tmp
 
     return [clean_DFFC, EFF, EFF_denoised]
 
-def normaliser(data, flats, darks, log, method, dyn_downsample=2, dyn_iterations=10):
+# =============================================================================
+# Parallel Analysis (EEFs selection):
+#      Selection of the number of components for PCA using parallel Analysis.
+#      Each flat field is a single row of the matrix flatFields, different
+#      rows are different observations.
+# =============================================================================
+
+def flats_covariance(flatFields, block_elements=2**24):
+    # np.cov of the rows of flatFields [M, N] (the M x M covariance of the flat
+    # fields) accumulated over the blocks of the pixels
+    (M, N) = flatFields.shape
+    columns = max(1, block_elements // M)
+    gram = np.zeros((M, M))
+    sums = np.zeros(M)
+    for j in range(0, N, columns):
+        block = flatFields[:,j:j+columns]
+        gram += block @ block.T
+        sums += np.sum(block, axis=1)
+    return (gram - np.outer(sums, sums)/N)/(N - 1)
+
+def wishart_factors(dof, M, repetitions, rng):
+    # the lower triangular factors L (L L^T ~ Wishart(dof, I_M)) of the Bartlett
+    # decomposition for the repetitions, dof >= M
+    factors = np.tril(rng.standard_normal((repetitions, M, M), dtype=np.float32), -1)
+    diagonal = np.arange(M)
+    factors[:,diagonal,diagonal] = np.sqrt(rng.chisquare(dof - diagonal, size=(repetitions, M)))
+    return factors
+
+def surrogates_eigenvalues(stdEFF, M, repetitions, rng, levels=128, block_elements=2**24):
+    # the eigenvalues (in the descending order) of np.cov of the repetitions of the
+    # random [M, N] matrices with the pixels' standard deviations stdEFF [N]. For
+    # N <= 2*levels*M the surrogates of all repetitions are generated together in
+    # float32 in the blocks of the pixels and only their covariances are kept.
+    # Otherwise the pixels are grouped into the levels quantiles of the variance:
+    # the n pixels of a group (of the mean variance v) add v*(W + u u^T/n) to the
+    # sum of the squares and sqrt(v)*u to the sums of the rows of the surrogate,
+    # W ~ Wishart(n - 1, I_M), u ~ N(0, n*I_M), i.e. O(levels*M^3) instead of O(N*M^2)
+    N = len(stdEFF)
+    gram = np.zeros((repetitions, M, M))
+    sums = np.zeros((repetitions, M))
+    if (N <= 2*levels*M):
+        columns = max(1, block_elements // (repetitions*M))
+        stdEFF = np.float32(stdEFF)
+        block = np.empty(repetitions*M*columns, dtype='float32')
+        for j in range(0, N, columns):
+            sample = block[:repetitions*M*min(columns, N - j)].reshape((repetitions, M, -1))
+            rng.standard_normal(dtype=np.float32, out=sample)
+            sample *= stdEFF[j:j+columns]
+            gram += np.matmul(sample, sample.transpose(0, 2, 1))
+            sums += np.sum(sample, axis=2)
+    else:
+        for group in np.array_split(np.sort(stdEFF**2), levels):
+            (n, variance) = (len(group), np.mean(group))
+            factors = wishart_factors(n - 1, M, repetitions, rng)
+            u = rng.standard_normal((repetitions, M))*np.sqrt(n)
+            gram += variance*(np.matmul(factors, factors.transpose(0, 2, 1)) + u[:,:,np.newaxis]*u[:,np.newaxis,:]/n)
+            sums += np.sqrt(variance)*u
+    covariances = (gram - sums[:,:,np.newaxis]*sums[:,np.newaxis,:]/N)/(N - 1)
+    return np.linalg.eigvalsh(covariances)[:,::-1]
+
+def parallel_analysis(flatFields, repetitions, rng, retries=3):
+    # the eigenvectors (columns) and the eigenvalues of the covariance of the flat
+    # fields in the descending order and the number of the eigenvalues above the
+    # mean + 2 * std of the eigenvalues of the random surrogates. The surrogates
+    # are regenerated (at most retries times) while no eigenvalue is selected
+    stdEFF = np.std(flatFields, axis=0, ddof=1, dtype=np.float64)
+    D1, V1 = np.linalg.eigh(flats_covariance(flatFields))
+    (D1, V1) = (D1[::-1], V1[:,::-1])
+    for attempt in range(retries):
+        keepTrack = surrogates_eigenvalues(stdEFF, flatFields.shape[0], repetitions, rng)
+        numberPC = np.sum(D1 > (np.mean(keepTrack, axis=0) + 2 * np.std(keepTrack, axis=0, ddof=1)))
+        if (numberPC > 0):
+            break
+    return V1, D1, int(numberPC)
+
+def gradient_axis(u, axis, out):
+    # np.gradient of the 2D u along the axis (unit spacing, edge_order=1) to out
+    u = np.moveaxis(u, axis, 0)
+    out_axis = np.moveaxis(out, axis, 0)
+    np.subtract(u[2:], u[:-2], out=out_axis[1:-1])
+    out_axis[1:-1] *= 0.5
+    np.subtract(u[1], u[0], out=out_axis[0])
+    np.subtract(u[-1], u[-2], out=out_axis[-1])
+    return out
+
+def gradient_axis_adjoint(v, axis, out):
+    # the adjoint of gradient_axis added to out
+    v = np.moveaxis(v, axis, 0)
+    out_axis = np.moveaxis(out, axis, 0)
+    out_axis[2:] += 0.5*v[1:-1]
+    out_axis[:-2] -= 0.5*v[1:-1]
+    out_axis[1] += v[0]
+    out_axis[0] -= v[0]
+    out_axis[-1] += v[-1]
+    out_axis[-2] -= v[-1]
+    return out
+
+class DFFCCost:
+    """
+    The (smoothed) TV cost used to estimate the coefficients x of the eigen flat
+    fields FF [n_EFF, H, W] of a projection and its analytic gradient:
+        L = (projection - DF)/(meanFF + FF_eff)*mean(meanFF + FF_eff),
+        FF_eff = sum_k x_k FF_k, cost = sum sqrt(Gx(L)^2 + Gy(L)^2 + eps^2)
+    with eps relative to the mean of meanFF. The (downsampled) fields are set
+    once and the buffers are reused for all projections (see set_projection)
+    """
+    def __init__(self, meanFF, FF, DF, eps=1e-6):
+        self.meanFF = meanFF
+        self.FF = FF.reshape(len(FF), -1) # the stack as a matrix for the tensordot
+        self.DF = DF
+        self.FF_means = np.mean(self.FF, axis=1)
+        self.meanFF_mean = np.mean(meanFF)
+        self.eps2 = (eps*self.meanFF_mean)**2
+        (self.nominator, self.denominator, self.corrected, self.Gx, self.Gy, self.magnitude, self.adjoint) = [np.zeros(np.shape(meanFF)) for _ in range(7)]
+
+    def set_projection(self, projection):
+        """the (downsampled) projection of the following evaluations"""
+        np.subtract(projection, self.DF, out=self.nominator)
+
+    def __call__(self, x):
+        """returns the cost and its gradient at x"""
+        denominator = self.denominator
+        np.dot(x, self.FF, out=denominator.reshape(-1)) # FF_eff
+        mean = self.meanFF_mean + np.dot(x, self.FF_means)
+        denominator += self.meanFF
+        corrected = np.divide(self.nominator, denominator, out=self.corrected)
+        corrected *= mean
+        (Gx, Gy, magnitude) = (gradient_axis(corrected, 0, self.Gx), gradient_axis(corrected, 1, self.Gy), self.magnitude)
+        adjoint = self.adjoint
+        np.multiply(Gx, Gx, out=magnitude)
+        magnitude += np.multiply(Gy, Gy, out=adjoint)
+        magnitude += self.eps2
+        np.sqrt(magnitude, out=magnitude)
+        cost = np.sum(magnitude)
+        # dL/dx_k = L*(mean(FF_k)/mean - FF_k/denominator), the adjoint of the
+        # gradients applied to the normalised gradients G/magnitude
+        Gx /= magnitude
+        Gy /= magnitude
+        adjoint.fill(0.0)
+        gradient_axis_adjoint(Gx, 0, adjoint)
+        gradient_axis_adjoint(Gy, 1, adjoint)
+        adjoint *= corrected
+        adjoint_sum = np.sum(adjoint)
+        adjoint /= denominator
+        gradient = self.FF_means*(adjoint_sum/mean) - np.dot(self.FF, adjoint.reshape(-1))
+        return (cost, gradient)
+
+# =============================================================================
+# condTVmean function: finds the optimal estimates  of the coefficients of the
+# eigen flat fields. The fields of the cost (DFFCCost) are downsampled once for
+# all projections
+# =============================================================================
+
+def condTVmean(projection, cost, x, DS):
+    # Downsample image
+    cost.set_projection(downscale_local_mean(projection, (DS, DS)))
+    # Optimize weights (x) with the analytic gradient
+    x = scipy.optimize.minimize(cost,
+                                x,
+                                jac=True,
+                                method='BFGS',
+                                tol=1e-8)
+    return x.x
+
+def dffc_downsample(EFF, DF, DS):
+    # the mean flat field, the eigen flat fields and the dark field downsampled
+    meanFF = downscale_local_mean(EFF[0], (DS, DS))
+    FF = np.zeros((EFF.shape[0] - 1, meanFF.shape[0], meanFF.shape[1]))
+    for i in range(1, len(EFF)):
+        FF[i-1] = downscale_local_mean(EFF[i], (DS, DS))
+    DF = downscale_local_mean(DF, (DS, DS))
+    return (meanFF, FF, DF)
+
+# the shared memory arrays of the DFFC pool workers (set by dffc_pool_init)
+dffc_worker = {}
+
+def dffc_shared(arrays):
+    # copies the arrays to the shared memory, returns the blocks and their
+    # (name, shape, dtype) descriptions to attach the arrays in the workers
+    from multiprocessing import shared_memory
+    blocks = []
+    descriptions = []
+    for array in arrays:
+        block = shared_memory.SharedMemory(create=True, size=max(1, array.nbytes))
+        blocks.append(block)
+        np.copyto(np.ndarray(array.shape, dtype=array.dtype, buffer=block.buf), array)
+        descriptions.append((block.name, array.shape, array.dtype.str))
+    return (blocks, descriptions)
+
+def dffc_pool_init(descriptions, DS):
+    # attaches the shared data [H, C, W], meanFF, FF and DF in the pool worker
+    from multiprocessing import shared_memory
+    blocks = [shared_memory.SharedMemory(name=name) for (name, _, _) in descriptions]
+    arrays = [np.ndarray(shape, dtype=dtype, buffer=block.buf) for (block, (_, shape, dtype)) in zip(blocks, descriptions)]
+    dffc_worker.update(blocks=blocks, data=arrays[0], cost=DFFCCost(*arrays[1:]), DS=DS)
+    atexit.register(dffc_pool_release)
+    # the forked workers end with os._exit (without the atexit handlers),
+    # multiprocessing runs its exit finalizers in the workers of all start methods
+    multiprocessing.util.Finalize(None, dffc_pool_release, exitpriority=0)
+
+def dffc_pool_release():
+    # closes the shared memory blocks of the pool worker, the arrays viewing
+    # them are dropped first (called once at the worker exit)
+    blocks = dffc_worker.pop('blocks', [])
+    dffc_worker.clear()
+    for block in blocks:
+        block.close()
+
+def dffc_pool_weights(indices):
+    # the coefficients of the projections of indices in the pool worker
+    (data, cost) = (dffc_worker['data'], dffc_worker['cost'])
+    return np.array([condTVmean(data[:,i,:], cost, np.zeros(len(cost.FF)), dffc_worker['DS']) for i in indices]).reshape(len(indices), len(cost.FF))
+
+def dffc_coefficients(data, EFF, DF, DS, workers=1, progress=None):
+    """
+    The coefficients of the eigen flat fields (EFF[1:], EFF[0] is the mean flat
+    field) for every projection of data [H, C, W] estimated by the TV minimisation
+    (condTVmean) on the downsampled (by DS) projections. The projections are
+    processed serially by default (workers=1), for workers > 1 (all cores if None)
+    they are distributed across the process pool with the data and the downsampled
+    fields in the shared memory. progress(done, C) is
+    called when the coefficients of a group of projections are estimated
+    """
+    from concurrent.futures import ProcessPoolExecutor, as_completed
+    (meanFF, FF, DF) = dffc_downsample(EFF, DF, DS)
+    C = data.shape[1]
+    weights = np.zeros((C, len(FF)))
+    if workers is None:
+        workers = os.cpu_count() or 1
+    workers = max(1, min(workers, C))
+    if (workers == 1):
+        cost = DFFCCost(meanFF, FF, DF)
+        for i in range(C):
+            weights[i] = condTVmean(data[:,i,:], cost, np.zeros(len(FF)), DS)
+            if progress is not None:
+                progress(i+1, C)
+        return weights
+    # a few groups of projections per worker to balance the load
+    groups = np.array_split(np.arange(C), min(C, 8*workers))
+    (blocks, descriptions) = dffc_shared([np.asarray(data), meanFF, FF, DF])
+    try:
+        with ProcessPoolExecutor(max_workers=workers, initializer=dffc_pool_init, initargs=(descriptions, DS)) as executor:
+            futures = {executor.submit(dffc_pool_weights, indices) : indices for indices in groups}
+            done = 0
+            for future in as_completed(futures):
+                indices = futures[future]
+                weights[indices] = future.result()
+                done += len(indices)
+                if progress is not None:
+                    progress(done, C)
+    finally:
+        for block in blocks:
+            block.close()
+            block.unlink()
+    return weights
+
+def normaliser_blocks(shape, block_elements, chunks=None):
+    # the blocks (the slices of the detector rows and of the projections) of about
+    # block_elements elements aligned to the chunks of the dataset (e.g. h5py). For
+    # the arrays and memmaps (chunks None) the blocks are contiguous: the groups of
+    # the detector rows or, if a single row is larger than the block, the groups of
+    # the projections of every row
+    if chunks is None:
+        chunks = (1, 1, shape[2])
+    (rows_chunk, projections_chunk) = (chunks[0], chunks[1])
+    projections_chunks = -(-shape[1] // projections_chunk) # the number of chunks along the projections
+    chunks_block = max(1, block_elements // (rows_chunk*projections_chunk*shape[2])) # the number of chunks in the block
+    if (chunks_block >= projections_chunks):
+        projections = shape[1]
+        rows = rows_chunk*max(1, chunks_block // projections_chunks)
+    else:
+        projections = projections_chunk*chunks_block
+        rows = rows_chunk
+    return [(slice(i, min(i + rows, shape[0])), slice(j, min(j + projections, shape[1])))
+            for i in range(0, shape[0], rows) for j in range(0, shape[1], projections)]
+
+def normaliser_map(func, blocks, workers):
+    # runs func for every block, concurrently for workers > 1 (NumPy releases the GIL)
+    if workers is None:
+        workers = os.cpu_count() or 1
+    workers = max(1, min(workers, len(blocks)))
+    if (workers == 1):
+        for block in blocks:
+            func(block)
+    else:
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            list(executor.map(func, blocks))
+
+def normalise_block(data, darks, denom, data_norm):
+    # flat/dark field normalisation of the block in float32 written to data_norm
+    np.subtract(data, darks, out=data_norm, dtype='float32') # get nominator
+    np.copyto(data_norm, 1.0, where=(data_norm < 0.0)) # remove negatives
+    np.divide(data_norm, denom, out=data_norm)
+
+def normalise_blocks(data, flats, darks, data_norm, log, blocks, workers):
+    # flat/dark field normalisation (and -log) of the blocks of data written to
+    # data_norm, flats/darks are the 2D statistics [detectorsX, detectorsY]. The
+    # arrays (or memmaps) are processed in place, other datasets (e.g. h5py) are
+    # read and written with a temporary array per block
+    darks = np.float32(darks)[:,np.newaxis,:]
+    denom = np.float32(flats)[:,np.newaxis,:] - darks
+    denom[denom <= 0.0] = 1.0 # remove zeros/negatives in the denominator if any
+    def normalise(block):
+        (rows, projections) = block
+        if isinstance(data_norm, np.ndarray):
+            data_norm_block = data_norm[rows, projections]
+        else:
+            data_norm_block = np.empty((rows.stop - rows.start, projections.stop - projections.start, np.shape(data_norm)[2]), dtype='float32')
+        normalise_block(data[rows, projections], darks[rows], denom[rows], data_norm_block)
+        if log is not None:
+            # calculate negative log (avoiding of log(0) (= inf) and > 1.0 (negative val))
+            neglog_block(data_norm_block)
+        if not isinstance(data_norm, np.ndarray):
+            data_norm[rows, projections] = data_norm_block
+    normaliser_map(normalise, blocks, workers)
+
+def neglog_block(data_norm):
+    # negative log of the block in place, log(0) (= inf) is avoided by keeping the
+    # zeros and the values > 1.0 (negative -log) are set to zero
+    np.clip(data_norm, 0.0, 1.0, out=data_norm)
+    np.log(data_norm, out=data_norm, where=(data_norm > 0.0))
+    np.subtract(0.0, data_norm, out=data_norm)
+
+def normaliser(data, flats, darks, log, method, dyn_downsample=2, dyn_iterations=10, workers=None, block_elements=2**18, dyn_progress=None, dyn_workers=1):
     """
     data normaliser which assumes data/flats/darks to be in the following format:
     [detectorsVertical, Projections, detectorsHoriz] or
     [detectorsHoriz, Projections, detectorsVertical]
+    The data is normalised in float32 in the contiguous blocks of about
+    block_elements elements (see normaliser_blocks) processed by the thread pool
+    of workers (all cores if None), no temporary arrays of the data size are created.
+    For the 'dynamic' method the coefficients of the eigen flat fields are estimated
+    serially or by the process pool of dyn_workers (1 by default, all cores if None),
+    dyn_progress(done, projections) is called to report the progress (see dffc_coefficients)
     """
-    data_norm = np.zeros(np.shape(data),dtype='float32')
-    [detectorsX, ProjectionsNum, detectorsY]= np.shape(data) # get the number of projection angles
     if darks is None:
         darks = np.zeros(np.shape(flats),dtype='float32')
     if method is None or method=='mean':
@@ -173,27 +426,57 @@ def normaliser(data, flats, darks, log, method, dyn_downsample=2, dyn_iterations
         darks = np.median(darks,1) # median across darks
     elif (method=='dynamic'):
         # dynamic flat field normalisation according to the paper of Vincent Van Nieuwenhove
-        [data_norm, EFF, EFF_filt] = DFFC(data, flats, darks, dyn_downsample, dyn_iterations)
+        [data_norm, EFF, EFF_filt] = DFFC(data, flats, darks, dyn_downsample, dyn_iterations, dyn_workers, dyn_progress)
     else:
         raise NameError('Please select an appropriate method for normalisation: mean, median or dynamic')
+    if (method!='dynamic'):
+        data_norm = np.empty(np.shape(data),dtype='float32')
+    blocks = normaliser_blocks(np.shape(data_norm), block_elements)
 
     if (method!='dynamic'):
-        denom = (flats-darks)
-        denom[(np.where(denom <= 0.0))] = 1.0 # remove zeros/negatives in the denominator if any
-        for i in range(0,ProjectionsNum):
-            projection2D = data[:,i,:]
-            nomin = projection2D - darks # get nominator
-            nomin[(np.where(nomin < 0.0))] = 1.0 # remove negatives
-            fraction = np.true_divide(nomin,denom)
-            data_norm[:,i,:] = fraction.astype(float)
-
-    if log is not None:
-        # calculate negative log (avoiding of log(0) (= inf) and > 1.0 (negative val))
-        data_norm[data_norm > 0.0] = -np.log(data_norm[data_norm > 0.0])
-        data_norm[data_norm < 0.0] = 0.0 # remove negative values
+        normalise_blocks(data, flats, darks, data_norm, log, blocks, workers)
+    elif log is not None:
+        normaliser_map(lambda block: neglog_block(data_norm[block]), blocks, workers)
     #return [data_norm, EFF, EFF_filt]
     return data_norm
 
+def normaliser_stream(data, flats, darks, data_norm, log, method, workers=None, block_elements=2**24, verbose='on'):
+    """
+    out-of-core data normaliser for the datasets larger than the memory: the data
+    is read from np.memmap or h5py dataset (or any array-like object supporting
+    the slicing) in the blocks aligned to the chunks of the dataset, normalised
+    and written to data_norm (float32 np.memmap or h5py dataset of the data shape).
+    The format of data/flats/darks is the same as for normaliser, flats/darks are
+    read in memory, methods: 'mean' or 'median'. Returns data_norm, the throughput
+    (read and written GB/s) is printed with verbose='on'
+    """
+    import time
+    time_start = time.time()
+    if tuple(np.shape(data_norm)) != tuple(np.shape(data)):
+        raise ValueError('The output data_norm must be of the data shape')
+    flats = np.asarray(flats[...])
+    if darks is None:
+        darks = np.zeros(np.shape(flats),dtype='float32')
+    else:
+        darks = np.asarray(darks[...])
+    if method is None or method=='mean':
+        flats = np.mean(flats,1) # mean across flats
+        darks = np.mean(darks,1) # mean across darks
+    elif (method=='median'):
+        flats = np.median(flats,1) # median across flats
+        darks = np.median(darks,1) # median across darks
+    else:
+        raise NameError('Please select an appropriate method for the out-of-core normalisation: mean or median')
+    blocks = normaliser_blocks(np.shape(data), block_elements, getattr(data, 'chunks', None))
+    normalise_blocks(data, flats, darks, data_norm, log, blocks, workers)
+    if hasattr(data_norm, 'flush'):
+        data_norm.flush()
+    if (verbose == 'on'):
+        time_total = time.time() - time_start
+        data_bytes = np.prod(np.shape(data))*(np.dtype(data.dtype).itemsize + 4)
+        print('Normalised', round(data_bytes/1e9, 2), 'GB (read and written) in', round(time_total, 2), 'seconds (', round(data_bytes/1e9/time_total, 2), 'GB/s )')
+    return data_norm
+
 def autocropper(data, addbox, backgr_pix1):
     """
     The method crops 3D projection data in order to reduce the total data size.
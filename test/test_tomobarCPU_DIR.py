@@ -1,7 +1,8 @@
 import unittest
 import numpy as np
-from tomobar.methodsDIR import RecToolsDIR
+from tomobar.methodsDIR import RecToolsDIR, filtersinc2D, filtersinc3D, slab_workers
 from tomobar.methodsIR import RecToolsIR
+from test_tomobarCPU_IR import astra_objects
 
 ###############################################################################
 class TestTomobar(unittest.TestCase):
@@ -34,6 +35,135 @@ class TestTomobar(unittest.TestCase):
         """
         RecFourier = RectoolsDirect.FOURIER(sino_num,'linear')
 
+    def test_filtersinc(self):
+        # batched rfft filtering against the full complex FFT of each row
+        a = 1.1
+        for DetectorsLengthH in (64, 65):
+            projection3D = np.float32(np.random.rand(3, 20, DetectorsLengthH))
+            w = np.linspace(-np.pi,np.pi-(2*np.pi)/DetectorsLengthH, DetectorsLengthH,dtype='float32')
+            rd = (a*w)/2.0
+            r = np.abs(2.0/a*np.sin(a*w/2.0))*(np.dot(np.sin(a*w/2.0), rd)/np.dot(rd, rd))**2
+            f = np.fft.fftshift(r)
+            reference = (1.0/20)*np.real(np.fft.ifft(np.fft.fft(projection3D, axis=-1)*f, axis=-1))
+            filtered = filtersinc3D(projection3D)
+            self.assertEqual(filtered.dtype, np.float32)
+            np.testing.assert_allclose(filtered, reference, atol=1e-6)
+            np.testing.assert_allclose(filtersinc2D(projection3D[1]), filtered[1], atol=1e-7)
+
+    def test_forwproj3D_cpu(self):
+        # the CPU 3D projection is the stack of 2D projections of the (vertically flipped) slices
+        N_size = 32
+        angles_rad = np.linspace(0.0, np.pi, 24, endpoint=False, dtype='float32')
+        P = int(np.sqrt(2)*N_size)
+        volume = np.float32(np.random.rand(5, N_size, N_size))
+        Rectools2D = RecToolsDIR(P, None, 0.0, angles_rad, N_size, 'cpu')
+        Rectools3D = RecToolsDIR(P, 5, 0.0, angles_rad, N_size, 'cpu')
+        projection3D = Rectools3D.FORWPROJ(volume)
+        self.assertEqual(projection3D.shape, (5, 24, P))
+        np.testing.assert_allclose(projection3D[2], Rectools2D.FORWPROJ(volume[2,::-1,:]), rtol=1e-5, atol=1e-4)
+        backprojection = Rectools3D.BACKPROJ(projection3D)
+        np.testing.assert_allclose(backprojection[2,::-1,:], Rectools2D.BACKPROJ(projection3D[2]), rtol=1e-5, atol=1e-3)
+
+    def test_forwproj3D_cpu_reference(self):
+        # the projections of a centred box at 0 and 90 degrees are the constant
+        # profiles of its lengths, the centre of rotation offsets shift them
+        N_size = 32
+        P = 46
+        angles_rad = np.float32([0.0, 0.5*np.pi])
+        volume = np.zeros((6, N_size, N_size), 'float32')
+        volume[2:4, 12:20, 10:22] = 1.0 # 2 slices x 8 (y) x 12 (x) voxels
+        CenterRotOffset = np.zeros((2, 2))
+        CenterRotOffset[:,0] = 1.0 # the vertical offset
+        CenterRotOffset[:,1] = 3.0 # the horizontal offset
+        for (offset, rows_shift, columns_shift) in [(0.0, 0, 0), (3.0, 0, 3), (CenterRotOffset, 1, 3)]:
+            expected = np.zeros((6, 2, P), 'float32')
+            expected[2-rows_shift:4-rows_shift, 0, P//2-6-columns_shift:P//2+6-columns_shift] = 8.0
+            expected[2-rows_shift:4-rows_shift, 1, P//2-4-columns_shift:P//2+4-columns_shift] = 12.0
+            with RecToolsDIR(P, 6, offset, angles_rad, N_size, 'cpu') as Rectools:
+                np.testing.assert_allclose(Rectools.FORWPROJ(volume), expected, atol=1e-4)
+
+    def test_backproj3D_cpu_adjoint(self):
+        # <A x, y> == <x, A^T y> including the fractional vertical and horizontal offsets
+        N_size = 32
+        P = 46
+        rng = np.random.default_rng(0)
+        angles_rad = np.float32(np.sort(rng.uniform(0.0, np.pi, 24)))
+        CenterRotOffset = np.zeros((24, 2))
+        CenterRotOffset[:,0] = np.linspace(-1.3, 1.3, 24)
+        CenterRotOffset[:,1] = 2.5
+        x = np.float32(rng.random((5, N_size, N_size)))
+        y = np.float32(rng.random((5, 24, P)))
+        for offset in [0.0, 2.5, CenterRotOffset]:
+            with RecToolsDIR(P, 5, offset, angles_rad, N_size, 'cpu') as Rectools:
+                Ax_y = np.vdot(np.float64(Rectools.FORWPROJ(x)), y)
+                x_ATy = np.vdot(x, np.float64(Rectools.BACKPROJ(y)))
+            self.assertAlmostEqual(Ax_y/x_ATy, 1.0, delta=1e-4)
+
+    def test_forwproj3D_cpu_matrix(self):
+        # the slab workers share one single-threaded system matrix operator and project as 'cpu'
+        from tomobar.supp.astraOP import SlabProjector3D
+        N_size = 32
+        P = 46
+        angles_rad = np.linspace(0.0, np.pi, 24, endpoint=False, dtype='float32')
+        volume = np.float32(np.random.rand(5, N_size, N_size))
+        for OS in [None, 4]:
+            slabs = [SlabProjector3D(P, 5, angles_rad, 1.5, N_size, OS, device, workers=3) for device in ['cpu', 'cpu_matrix']]
+            try:
+                self.assertEqual(len(set(id(tools.matrix) for tools in slabs[1].tools)), 1)
+                self.assertEqual(slabs[1].tools[0].matrix.workers, 1)
+                for no_os in ([None] if OS is None else [None, 2]):
+                    projection3D = slabs[0].forwproj(volume, no_os)
+                    np.testing.assert_allclose(slabs[1].forwproj(volume, no_os), projection3D, rtol=1e-5, atol=1e-4)
+                    np.testing.assert_allclose(slabs[1].backproj(projection3D, no_os), slabs[0].backproj(projection3D, no_os), rtol=1e-4, atol=1e-2)
+            finally:
+                for slab in slabs:
+                    slab.close()
+        with RecToolsDIR(P, 5, 1.5, angles_rad, N_size, 'cpu') as Rectools, RecToolsDIR(P, 5, 1.5, angles_rad, N_size, 'cpu_matrix') as Mtools:
+            np.testing.assert_allclose(Mtools.FORWPROJ(volume), Rectools.FORWPROJ(volume), rtol=1e-5, atol=1e-4)
+
+    def test_release(self):
+        # the projection classes are created once, reused by all methods and freed by release()
+        N_size = 32
+        P = 46
+        angles_rad = np.linspace(0.0, np.pi, 24, endpoint=False, dtype='float32')
+        image = np.float32(np.random.rand(N_size, N_size))
+        objects_start = astra_objects()
+        Rectools = RecToolsDIR(P, None, 0.0, angles_rad, N_size, 'cpu')
+        self.assertIsNone(Rectools.Atools)
+        sinogram = Rectools.FORWPROJ(image)
+        Atools = Rectools.Atools
+        objects_used = astra_objects()
+        self.assertGreater(objects_used, objects_start)
+        Rectools.BACKPROJ(sinogram)
+        Rectools.FBP(sinogram)
+        Rectools.FORWPROJ(image)
+        self.assertIs(Rectools.Atools, Atools)
+        self.assertEqual(astra_objects(), objects_used)
+        Rectools.release()
+        self.assertIsNone(Rectools.Atools)
+        self.assertEqual(astra_objects(), objects_start)
+
+    def test_fbp3D_slabs(self):
+        # the slab-wise FBP on the thread pool equals the single worker FBP
+        N_size = 32
+        angles_rad = np.linspace(0.0, np.pi, 24, endpoint=False, dtype='float32')
+        P = int(np.sqrt(2)*N_size)
+        projection3D = np.float32(np.random.rand(5, 24, P))
+        with RecToolsDIR(P, 5, None, angles_rad, N_size, 'cpu') as Rectools:
+            FBP_single = Rectools.FBP(projection3D, workers=1)
+            FBP_threads = Rectools.FBP(projection3D, workers=3)
+            self.assertEqual(len(Rectools.Atools_FBP_slabs), 3)
+        np.testing.assert_array_equal(FBP_single, FBP_threads)
+        # every worker needs 2*4 bytes per element of a slice
+        self.assertEqual(slab_workers(10, 2**20, 8, memory_budget_mb=16), 2)
+        self.assertEqual(slab_workers(10, 2**20, 8, memory_budget_mb=1), 1)
+        self.assertEqual(slab_workers(3, 2**20, 8), 3)
+        with RecToolsDIR(P, 5, None, angles_rad, N_size, 'cpu') as Rectools:
+            slice_mb = 2.0*4.0*(24*P + N_size**2)/1024**2
+            FBP_budget = Rectools.FBP(projection3D, workers=4, memory_budget_mb=2.5*slice_mb)
+            self.assertEqual(len(Rectools.Atools_FBP_slabs), 2)
+        np.testing.assert_array_equal(FBP_single, FBP_budget)
+
 ###############################################################################
 if __name__ == '__main__':
     unittest.main()
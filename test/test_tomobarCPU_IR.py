@@ -0,0 +1,322 @@
+import contextlib
+import gc
+import io
+import os
+import tempfile
+import unittest
+import numpy as np
+import astra
+from tomobar.methodsIR import RecToolsIR
+
+def astra_objects():
+    # the number of the ASTRA 2D data objects and projectors in memory (the
+    # indices of all ASTRA objects are given by the same counter)
+    probe = astra.data2d.create('-vol', astra.create_vol_geom(2, 2))
+    astra.data2d.delete(probe)
+    count = 0
+    for index in range(1, probe):
+        for get_geometry in [astra.data2d.get_geometry, astra.projector.volume_geometry]:
+            try:
+                get_geometry(index)
+                count += 1
+            except Exception:
+                pass
+    return count
+
+###############################################################################
+class TestTomobarIR(unittest.TestCase):
+
+    def test_release(self):
+        # the ASTRA objects of the dropped instances are released without close()
+        angles_rad = np.linspace(0.0, np.pi, 20, endpoint=False, dtype='float32')
+        objects_before = astra_objects()
+        for i in range(5):
+            Rectools = RecToolsIR(46, None, 0.0, angles_rad, 32, 'LS', 'cpu')
+            Rectools.powermethod({'OS_number' : 4}, seed=0) # creates the OS projection objects
+            self.assertGreater(astra_objects(), objects_before)
+            del Rectools
+            gc.collect()
+            self.assertEqual(astra_objects(), objects_before)
+        with RecToolsIR(46, None, 0.0, angles_rad, 32, 'LS', 'cpu') as Rectools:
+            Rectools.Atools.forwproj(np.zeros((32, 32), 'float32'))
+        self.assertEqual(astra_objects(), objects_before)
+        del Rectools
+
+    def test_circ_mask_cached(self):
+        from tomobar.methodsIR import circ_mask, circ_mask_init, circ_mask_cached
+        angles_rad = np.linspace(0.0, np.pi, 20, endpoint=False, dtype='float32')
+        with RecToolsIR(46, None, 0.0, angles_rad, 32, 'LS', 'cpu') as Rectools:
+            image = np.float32(np.random.rand(32, 32))
+            volume = np.float32(np.random.rand(3, 32, 32))
+            for diameter in [1.0, 0.8, 1.0]:
+                mask = circ_mask_cached(Rectools, 2, diameter)
+                np.testing.assert_array_equal(mask, circ_mask_init(32, diameter))
+                self.assertIs(circ_mask_cached(Rectools, 2, diameter), mask)
+                np.testing.assert_array_equal(np.multiply(image, mask), circ_mask(image, diameter))
+                mask3D = circ_mask_cached(Rectools, 3, diameter)
+                np.testing.assert_array_equal(np.multiply(volume, mask3D), circ_mask(volume, diameter))
+            self.assertFalse(np.array_equal(circ_mask_cached(Rectools, 2, 0.8), circ_mask_cached(Rectools, 2, 1.0)))
+
+    def test_swls_residual(self):
+        # the vectorised SWLS residual against the per-detector formula
+        from tomobar.methodsIR import swls_denominators, swls_residual
+        rng = np.random.default_rng(0)
+        beta_SWLS = 0.1*np.ones(12)
+        res = np.float32(rng.normal(size=(3, 10, 12)))
+        weights = np.float32(rng.random((3, 10, 12)))
+        reference = np.zeros(np.shape(res))
+        for detVert_index in range(3):
+            for detHorz_index in range(12):
+                wk = np.float64(weights[detVert_index,:,detHorz_index])
+                resk = np.float64(res[detVert_index,:,detHorz_index])
+                reference[detVert_index,:,detHorz_index] = np.multiply(wk, resk) - 1.0/(np.sum(wk) + beta_SWLS[detHorz_index])*(wk.dot(resk))*wk
+        residual3D = swls_residual(res, weights, swls_denominators(weights, beta_SWLS, 1), 1)
+        np.testing.assert_allclose(residual3D, reference, rtol=1e-5, atol=1e-6)
+        out = np.empty(np.shape(res[1]), 'float32')
+        residual2D = swls_residual(res[1], weights[1], swls_denominators(weights[1], beta_SWLS, 0), 0, out=out)
+        self.assertIs(residual2D, out)
+        np.testing.assert_allclose(residual2D, reference[1], rtol=1e-5, atol=1e-6)
+
+    def test_lipschitz_cache(self):
+        from tomobar.methodsIR import dict_check
+        angles_rad = np.linspace(0.0, np.pi, 20, endpoint=False, dtype='float32')
+        sinogram = np.zeros((20, 46), 'float32')
+        with tempfile.TemporaryDirectory() as tmpdir, RecToolsIR(46, None, 0.0, angles_rad, 32, 'LS', 'cpu') as Rectools:
+            os.environ['TOMOBAR_CACHE_DIR'] = os.path.join(tmpdir, 'cache')
+            try:
+                # off by default, nothing is written
+                _algorithm_ = {'verbose' : 'off'}
+                dict_check(Rectools, {'projection_norm_data' : sinogram}, _algorithm_, {})
+                self.assertEqual(_algorithm_['lipschitz_cache'], 'off')
+                self.assertFalse(os.path.exists(os.environ['TOMOBAR_CACHE_DIR']))
+                # the constant is stored on the first call and read by the following ones
+                _algorithm_ = {'verbose' : 'off', 'lipschitz_cache' : 'on'}
+                dict_check(Rectools, {'projection_norm_data' : sinogram}, _algorithm_, {})
+                files = os.listdir(os.path.join(os.environ['TOMOBAR_CACHE_DIR'], 'lipschitz'))
+                self.assertEqual(len(files), 1)
+                np.save(os.path.join(os.environ['TOMOBAR_CACHE_DIR'], 'lipschitz', files[0]), np.float64(123.0))
+                _algorithm_ = {'verbose' : 'off', 'lipschitz_cache' : 'on'}
+                dict_check(Rectools, {'projection_norm_data' : sinogram}, _algorithm_, {})
+                self.assertEqual(_algorithm_['lipschitz_const'], 123.0)
+                # a cache directory which cannot be created falls back to the power method
+                blocker = os.path.join(tmpdir, 'file')
+                open(blocker, 'w').close()
+                os.environ['TOMOBAR_CACHE_DIR'] = os.path.join(blocker, 'cache')
+                _algorithm_ = {'verbose' : 'off', 'lipschitz_cache' : 'on'}
+                dict_check(Rectools, {'projection_norm_data' : sinogram}, _algorithm_, {})
+                self.assertGreater(_algorithm_['lipschitz_const'], 0.0)
+            finally:
+                del os.environ['TOMOBAR_CACHE_DIR']
+
+    def test_powermethod(self):
+        from tomobar.methodsIR import dict_check
+        angles_rad = np.linspace(0.0, np.pi, 20, endpoint=False, dtype='float32')
+        sinogram = np.zeros((20, 46), 'float32')
+        with RecToolsIR(46, None, 0.0, angles_rad, 32, 'LS', 'cpu') as Rectools:
+            (s_full, iterations_full, x1) = Rectools.powermethod({}, iterations=50, seed=0, return_info=True)
+            self.assertEqual(iterations_full, 50)
+            (s_early, iterations_early, x1) = Rectools.powermethod({}, tolerance=1e-3, iterations=50, seed=0, return_info=True)
+            self.assertLess(iterations_early, 50)
+            self.assertAlmostEqual(s_early/s_full, 1.0, delta=1e-2)
+            # the parameters are passed from _algorithm_
+            constants = []
+            for i in range(2):
+                _algorithm_ = {'verbose' : 'off', 'powermethod_seed' : 1, 'powermethod_iterations' : 50, 'powermethod_tolerance' : 1e-3}
+                dict_check(Rectools, {'projection_norm_data' : sinogram}, _algorithm_, {})
+                constants.append(_algorithm_['lipschitz_const'])
+            self.assertEqual(constants[0], constants[1])
+            _algorithm_ = {'verbose' : 'off', 'powermethod_init' : x1, 'powermethod_iterations' : 1}
+            dict_check(Rectools, {'projection_norm_data' : sinogram}, _algorithm_, {})
+            self.assertAlmostEqual(_algorithm_['lipschitz_const']/s_early, 1.0, delta=1e-3)
+
+    def test_fista_batch(self):
+        angles_rad = np.linspace(0.0, np.pi, 30, endpoint=False, dtype='float32')
+        phantoms = np.zeros((3, 32, 32), 'float32')
+        phantoms[0, 8:20, 10:22] = 1.0
+        phantoms[1, 12:26, 6:14] = 0.5
+        phantoms[2, 5:12, 18:28] = 2.0
+        with RecToolsIR(46, None, 0.0, angles_rad, 32, 'LS', 'cpu') as Rectools:
+            sinograms = np.float32([Rectools.Atools.forwproj(phantom) for phantom in phantoms])
+            for OS_number in [None, 5]:
+                _algorithm_ = {'iterations' : 20, 'lipschitz_const' : 1000.0, 'verbose' : 'off'}
+                batch = Rectools.FISTA_batch({'projection_norm_data' : sinograms, 'OS_number' : OS_number}, dict(_algorithm_), {})
+                for i in range(3):
+                    slice_rec = Rectools.FISTA({'projection_norm_data' : sinograms[i], 'OS_number' : OS_number}, dict(_algorithm_), {})
+                    np.testing.assert_allclose(batch[i], slice_rec, atol=1e-3)
+
+    def test_pcg_solve(self):
+        from tomobar.methodsIR import pcg_solve
+        rng = np.random.default_rng(0)
+        B = rng.standard_normal((20, 20))
+        A = B.T.dot(B) + 0.5*np.eye(20) # symmetric positive-definite
+        b = rng.standard_normal(20)
+        x_ref = np.linalg.solve(A, b)
+        for M_func in [None, lambda r: r/np.diag(A)]:
+            x = np.zeros(20)
+            iterations_used = pcg_solve(lambda v: A.dot(v), b, x, M_func, 1e-10, 100)
+            self.assertLess(iterations_used, 100)
+            np.testing.assert_allclose(x, x_ref, rtol=1e-6, atol=1e-8)
+
+    def test_admm_precondition(self):
+        angles_rad = np.linspace(0.0, np.pi, 30, endpoint=False, dtype='float32')
+        phantom = np.zeros((32, 32), 'float32')
+        phantom[8:20, 10:22] = 1.0
+        with RecToolsIR(46, None, 0.0, angles_rad, 32, 'LS', 'cpu') as Rectools:
+            sinogram = Rectools.Atools.forwproj(phantom)
+            recs = []
+            for precondition in ['off', 'on']:
+                _algorithm_ = {'iterations' : 15, 'ADMM_rho_const' : 50.0, 'ADMM_solver_iterations' : 100, 'ADMM_solver_tolerance' : 1e-5,
+                               'ADMM_precondition' : precondition, 'lipschitz_const' : 1.0, 'tolerance' : 0.0, 'verbose' : 'off'}
+                output = io.StringIO()
+                with contextlib.redirect_stdout(output):
+                    recs.append(Rectools.ADMM({'projection_norm_data' : sinogram}, _algorithm_, {}))
+                self.assertEqual(output.getvalue(), '') # verbose 'off'
+        np.testing.assert_allclose(recs[1], recs[0], atol=2e-3)
+        self.assertLess(np.abs(recs[0] - phantom).max(), 0.2)
+
+    def test_pdhg_dual_prox(self):
+        from scipy.optimize import minimize_scalar
+        from tomobar.methodsIR import pdhg_dual_prox
+        rng = np.random.default_rng(0)
+        v = rng.uniform(-3.0, 3.0, 12)
+        sigma = rng.uniform(0.1, 2.0, 12)
+        data = rng.uniform(0.0, 2.0, 12)
+        weights = rng.uniform(0.5, 3.0, 12)
+        fidelities = {'LS' : lambda z, i: 0.5*(z - data[i])**2,
+                      'PWLS' : lambda z, i: 0.5*weights[i]*(z - data[i])**2,
+                      'KL' : lambda z, i: (z + 1.0) - (data[i] + 1.0)*np.log(z + 1.0)}
+        for datafidelity, F in fidelities.items():
+            # Moreau identity: prox_{sigma F*}(v) = v - sigma*prox_{F/sigma}(v/sigma)
+            prox = np.zeros(12)
+            for i in range(12):
+                w = v[i]/sigma[i]
+                cost = lambda z: F(z, i)/sigma[i] + 0.5*(z - w)**2
+                if (datafidelity == 'KL'):
+                    prox[i] = minimize_scalar(cost, bounds=(-1.0 + 1e-12, 1e3), method='bounded', options={'xatol' : 1e-10}).x
+                else:
+                    prox[i] = minimize_scalar(cost, method='brent', tol=1e-12).x
+            y = pdhg_dual_prox(datafidelity, v, sigma, data, weights)
+            np.testing.assert_allclose(y, v - sigma*prox, atol=1e-6)
+
+    def test_pdhg(self):
+        angles_rad = np.linspace(0.0, np.pi, 30, endpoint=False, dtype='float32')
+        phantom = np.zeros((32, 32), 'float32')
+        phantom[8:20, 10:22] = 1.0
+        phantom[14:18, 4:8] = 0.5
+        with RecToolsIR(46, None, 0.0, angles_rad, 32, 'LS', 'cpu') as Rectools:
+            sinogram = Rectools.Atools.forwproj(phantom)
+            _algorithm_ = {'iterations' : 300, 'lipschitz_const' : 1000.0, 'verbose' : 'off'}
+            rec_fista = Rectools.FISTA({'projection_norm_data' : sinogram}, dict(_algorithm_), {})
+            errors = []
+            for iterations in [50, 300]:
+                _algorithm_['iterations'] = iterations
+                rec_pdhg = Rectools.PDHG({'projection_norm_data' : sinogram}, dict(_algorithm_), {})
+                errors.append(np.abs(rec_pdhg - rec_fista).max())
+        self.assertLess(errors[1], 0.25*errors[0])
+        self.assertLess(errors[1], 1e-2)
+
+    def test_ringGH_lagged(self):
+        # the lagged and the recomputed full residuals of the OS Group-Huber ring
+        # model converge to the same 3D solution
+        angles_rad = np.linspace(0.0, np.pi, 40, endpoint=False, dtype='float32')
+        phantom = np.zeros((3, 32, 32), 'float32')
+        phantom[:, 8:22, 10:24] = 1.0
+        phantom[:, 12:16, 12:16] = 2.0
+        with RecToolsIR(46, 3, 0.0, angles_rad, 32, 'LS', 'cpu') as Rectools:
+            sinogram = Rectools.Atools.forwproj(phantom)
+            sinogram[:, :, [15, 20, 30]] += np.float32([0.5, -0.4, 0.6]) # the stripes (rings)
+            recs = []
+            for lagged in ['off', 'on']:
+                _data_ = {'projection_norm_data' : sinogram, 'OS_number' : 5, 'ringGH_lambda' : 0.001,
+                          'ringGH_accelerate' : 1.0, 'ring_residual_lagged' : lagged}
+                _algorithm_ = {'iterations' : 300, 'lipschitz_const' : 300.0, 'tolerance' : 0.0, 'verbose' : 'off'}
+                recs.append(Rectools.FISTA(_data_, _algorithm_, {}))
+        np.testing.assert_allclose(recs[1], recs[0], atol=0.025)
+
+    def test_ring_weights_function(self):
+        from tomobar.methodsIR import RING_WEIGHTS, ring_weights_function
+        rng = np.random.default_rng(0)
+        _data_ = {'ring_tuple_halfsizes' : (9, 5, 2), 'ring_weights_threshold' : 0.5, 'ring_huber_power' : 2.0}
+        workspace = {}
+        for shape in [(20, 30), (3, 20, 30)]:
+            for i in range(2):
+                res = np.float32(rng.standard_normal(shape))
+                # the previous formula
+                rings_weights = np.abs(RING_WEIGHTS(res, 9, 5, 2))
+                weights = np.ones(shape, 'float32')
+                outliers = rings_weights > 0.5
+                weights[outliers] = 0.5/rings_weights[outliers]**2.0
+                ring_function_weight = ring_weights_function(res, _data_, workspace)
+                np.testing.assert_allclose(ring_function_weight, weights, rtol=1e-6)
+                self.assertTrue(outliers.any() and not outliers.all())
+        self.assertEqual(len(workspace), 6) # the buffers are reused for the same shape
+
+    def test_swls_ring_models(self):
+        # the classical SWLS applies the ring models: with the large beta_SWLS
+        # it approaches LS with the same ring model (not LS without it)
+        angles_rad = np.linspace(0.0, np.pi, 30, endpoint=False, dtype='float32')
+        phantom = np.zeros((32, 32), 'float32')
+        phantom[8:22, 10:24] = 1.0
+        phantom[12:16, 12:16] = 2.0
+        ring_models = [{'ringGH_lambda' : 0.0001, 'ringGH_accelerate' : 1.0},
+                       {'ring_weights_threshold' : 0.2, 'ring_tuple_halfsizes' : (9, 5, 0)}]
+        for ring_model in ring_models:
+            recs = {}
+            for datafidelity in ['LS', 'SWLS']:
+                with RecToolsIR(46, None, 0.0, angles_rad, 32, datafidelity, 'cpu') as Rectools:
+                    sinogram = Rectools.Atools.forwproj(phantom)
+                    sinogram[:, [15, 20, 30]] += np.float32([0.5, -0.4, 0.6]) # the stripes (rings)
+                    _data_ = {'projection_norm_data' : sinogram, 'projection_raw_data' : np.ones_like(sinogram),
+                              'beta_SWLS' : np.full(46, 1e8, 'float32')}
+                    _algorithm_ = {'iterations' : 30, 'lipschitz_const' : 1000.0, 'verbose' : 'off'}
+                    recs[datafidelity, None] = Rectools.FISTA(dict(_data_), dict(_algorithm_), {})
+                    _data_.update(ring_model)
+                    recs[datafidelity, 'ring'] = Rectools.FISTA(_data_, dict(_algorithm_), {})
+            self.assertGreater(np.abs(recs['LS', 'ring'] - recs['LS', None]).max(), 0.1)
+            np.testing.assert_allclose(recs['SWLS', 'ring'], recs['LS', 'ring'], atol=1e-2)
+
+    def test_os_fista_subsets_data(self):
+        # OS-FISTA with the subsets data split once equals the previous gathering
+        # of the data with the zero-padded subsets indices in every iteration
+        from tomobar.supp.subsets import SUBSETS_ORDERINGS, subsets_order
+        angles_number, OS = 40, 6
+        angles_rad = np.linspace(0.0, np.pi, angles_number, endpoint=False, dtype='float32')
+        NumbProjBins = int(np.ceil(float(angles_number)/float(OS)))
+        newInd_Vec = np.zeros([OS, NumbProjBins], dtype='int')
+        for sub_ind in range(OS):
+            indices = np.arange(sub_ind, angles_number, OS)
+            newInd_Vec[sub_ind, :len(indices)] = indices
+        phantom = np.zeros((32, 32), 'float32')
+        phantom[8:20, 10:22] = 1.0
+        rng = np.random.default_rng(0)
+        for datafidelity in ['LS', 'PWLS']:
+            with RecToolsIR(46, None, 0.0, angles_rad, 32, datafidelity, 'cpu') as Rectools:
+                sinogram = Rectools.Atools.forwproj(phantom)
+                weights = np.float32(rng.uniform(0.5, 1.5, np.shape(sinogram)))
+                for ordering in SUBSETS_ORDERINGS:
+                    _data_ = {'projection_norm_data' : sinogram, 'projection_raw_data' : weights, 'OS_number' : OS}
+                    _algorithm_ = {'iterations' : 5, 'lipschitz_const' : 200.0, 'OS_ordering' : ordering, 'OS_seed' : 1,
+                                   'nonnegativity' : 'DISABLE', 'mask_diameter' : None, 'verbose' : 'off'}
+                    rec = Rectools.FISTA(_data_, _algorithm_, {})
+                    # the previous indexing
+                    X = np.zeros((32, 32), 'float32')
+                    X_t = X.copy()
+                    t = 1.0
+                    for iter in range(5):
+                        for sub_ind in subsets_order(OS, ordering, iter, 1):
+                            indVec = newInd_Vec[sub_ind,:]
+                            if (indVec[NumbProjBins-1] == 0):
+                                indVec = indVec[:-1]
+                            X_old = X
+                            t_old = t
+                            res = Rectools.AtoolsOS.forwprojOS(X_t, sub_ind) - sinogram[indVec,:]
+                            if (datafidelity == 'PWLS'):
+                                res = np.multiply(weights[indVec,:], res)
+                            X = X_t - (1.0/200.0)*Rectools.AtoolsOS.backprojOS(np.float32(res), sub_ind)
+                            t = (1.0 + np.sqrt(1.0 + 4.0*t**2))*0.5
+                            X_t = X + ((t_old - 1.0)/t)*(X - X_old)
+                    np.testing.assert_allclose(rec, X, rtol=1e-4, atol=1e-5)
+
+###############################################################################
+if __name__ == '__main__':
+    unittest.main()
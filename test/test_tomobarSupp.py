@@ -0,0 +1,279 @@
+import os
+import tempfile
+import unittest
+import numpy as np
+from tomobar.supp.cacheTools import DiskCache, geometry_hash
+
+class UnsaveableArray:
+    # an object whose serialisation fails as a full disk would do
+    def __array__(self, *args, **kwargs):
+        raise OSError(28, 'No space left on device')
+
+###############################################################################
+class TestTomobarSupp(unittest.TestCase):
+
+    def test_diskcache(self):
+        angles_rad = np.linspace(0.0, np.pi, 10, dtype='float32')
+        key = geometry_hash('lipschitz', 64, None, angles_rad, 0.0, 64, 1, 'cpu', None)
+        self.assertEqual(key, geometry_hash('lipschitz', 64, None, angles_rad.copy(), 0.0, 64, 1, 'cpu', None))
+        self.assertNotEqual(key, geometry_hash('lipschitz', 64, None, angles_rad, 0.5, 64, 1, 'cpu', None))
+        with tempfile.TemporaryDirectory() as tmpdir:
+            os.environ['TOMOBAR_CACHE_DIR'] = tmpdir
+            try:
+                cache = DiskCache('test', 2800)
+                self.assertIsNone(cache.get(key))
+                for i in range(3):
+                    cache.put('key%d' % i, np.zeros(100)) # 928 bytes each
+                    os.utime(cache.filename('key%d' % i), (i, i))
+                cache.get('key0') # the least recently used is key1 now
+                cache.put(key, np.float64(1.5))
+                self.assertEqual(float(cache.get(key)), 1.5)
+                self.assertIsNone(cache.get('key1'))
+                self.assertIsNotNone(cache.get('key0'))
+                # the dictionaries of arrays are stored as one entry
+                cache_npz = DiskCache('test_npz', 2**20, suffix='.npz')
+                cache_npz.put(key, {'data' : np.arange(5.0), 'shape' : np.array([2, 3])})
+                value = cache_npz.get(key)
+                self.assertEqual(sorted(value), ['data', 'shape'])
+                np.testing.assert_array_equal(value['data'], np.arange(5.0))
+                self.assertEqual(os.listdir(cache_npz.path), [key + '.npz'])
+                # a failed write leaves no temporary file behind
+                cache_npz.put('unsaveable', {'data' : UnsaveableArray()})
+                self.assertEqual(os.listdir(cache_npz.path), [key + '.npz'])
+            finally:
+                del os.environ['TOMOBAR_CACHE_DIR']
+
+    def test_subsets(self):
+        from tomobar.supp.subsets import subsets_partition, subsets_order, SUBSETS_ORDERINGS
+        subsets = subsets_partition(10, 4)
+        self.assertEqual([list(indVec) for indVec in subsets], [[0, 4, 8], [1, 5, 9], [2, 6], [3, 7]])
+        self.assertEqual(list(subsets_order(8, 'bit-reversal')), [0, 4, 2, 6, 1, 5, 3, 7])
+        for ordering in SUBSETS_ORDERINGS:
+            for OS in [1, 6, 12]:
+                self.assertEqual(sorted(subsets_order(OS, ordering, 3, 1)), list(range(OS)))
+        self.assertTrue(np.array_equal(subsets_order(12, 'random', 2, 1), subsets_order(12, 'random', 2, 1)))
+        self.assertFalse(np.array_equal(subsets_order(12, 'random', 2, 1), subsets_order(12, 'random', 3, 1)))
+
+    def test_normaliser(self):
+        from tomobar.supp.suppTools import normaliser, normaliser_stream
+        rng = np.random.default_rng(0)
+        data = np.uint16(rng.integers(0, 4000, (6, 20, 16)))
+        flats = np.uint16(rng.integers(3000, 4000, (6, 4, 16)))
+        darks = np.uint16(rng.integers(0, 200, (6, 3, 16)))
+        flats[0,:,0] = 0 # a zero denominator
+        denom = np.mean(flats, 1) - np.mean(darks, 1)
+        denom[denom <= 0.0] = 1.0
+        nomin = data - np.mean(darks, 1)[:,np.newaxis,:]
+        nomin[nomin < 0.0] = 1.0
+        reference = nomin/denom[:,np.newaxis,:]
+        reference_log = np.zeros(np.shape(reference))
+        reference_log[reference > 0.0] = np.maximum(-np.log(reference[reference > 0.0]), 0.0)
+        for (workers, block_elements) in [(1, 2**18), (2, 100), (3, 7)]:
+            data_norm = normaliser(data, flats, darks, None, 'mean', workers=workers, block_elements=block_elements)
+            self.assertEqual(data_norm.dtype, np.float32)
+            self.assertTrue(np.allclose(data_norm, reference, rtol=1e-5))
+            data_norm = normaliser(data, flats, darks, 'log', 'mean', workers=workers, block_elements=block_elements)
+            self.assertTrue(np.allclose(data_norm, reference_log, rtol=1e-4, atol=1e-6))
+        with tempfile.TemporaryDirectory() as tmpdir:
+            data_mmap = np.lib.format.open_memmap(os.path.join(tmpdir, 'data.npy'), mode='w+', dtype='uint16', shape=np.shape(data))
+            data_mmap[:] = data
+            data_norm = np.lib.format.open_memmap(os.path.join(tmpdir, 'data_norm.npy'), mode='w+', dtype='float32', shape=np.shape(data))
+            normaliser_stream(data_mmap, flats, darks, data_norm, 'log', 'mean', workers=2, block_elements=100, verbose='off')
+            self.assertTrue(np.allclose(np.load(os.path.join(tmpdir, 'data_norm.npy')), reference_log, rtol=1e-4, atol=1e-6))
+            del data_mmap, data_norm
+
+    def test_dffc_coefficients(self):
+        from tomobar.supp.suppTools import dffc_coefficients
+        rng = np.random.default_rng(0)
+        (yy, xx) = np.mgrid[0:64, 0:80]
+        EFF = np.array([1000 + 50*np.sin(xx/9.0), 20*np.cos(xx/4.0 + yy/5.0), 20*np.cos(xx/5.0 + yy/10.0)])
+        darks = 10 + rng.random((64, 80))
+        coefficients = rng.normal(size=(6, 2))
+        flats = EFF[0][:,np.newaxis,:] + np.einsum('ck,khw->hcw', coefficients, EFF[1:])
+        data = np.float32(darks[:,np.newaxis,:] + flats*np.exp(-np.exp(-((xx - 40)**2 + (yy - 32)**2)/300.0))[:,np.newaxis,:])
+        progress = []
+        weights = dffc_coefficients(data, EFF, darks, 2) # serial by default
+        self.assertTrue(np.allclose(weights, coefficients, atol=0.1))
+        self.assertTrue(np.array_equal(dffc_coefficients(data, EFF, darks, 2, workers=2, progress=lambda done, total: progress.append(done)), weights))
+        self.assertEqual(progress[-1], 6)
+
+    def test_dffc_pool_release(self):
+        # the pool worker closes its shared memory blocks at the exit
+        from tomobar.supp.suppTools import dffc_shared, dffc_pool_init, dffc_pool_release, dffc_worker
+        arrays = [np.ones((8, 3, 10), 'float32'), np.ones((4, 5)), np.ones((2, 4, 5)), np.zeros((4, 5))]
+        (blocks, descriptions) = dffc_shared(arrays)
+        try:
+            dffc_pool_init(descriptions, 2)
+            worker_blocks = dffc_worker['blocks']
+            np.testing.assert_array_equal(dffc_worker['data'], arrays[0])
+            dffc_pool_release()
+            self.assertEqual(dffc_worker, {})
+            self.assertTrue(all(block.buf is None for block in worker_blocks))
+            dffc_pool_release() # the second call (atexit after the finalizer) does nothing
+        finally:
+            for block in blocks:
+                block.close()
+                block.unlink()
+
+    def test_dffc_cost(self):
+        from tomobar.supp.suppTools import DFFCCost, gradient_axis, gradient_axis_adjoint
+        rng = np.random.default_rng(0)
+        u = rng.standard_normal((9, 12))
+        v = rng.standard_normal((9, 12))
+        for axis in [0, 1]:
+            grad_u = gradient_axis(u, axis, np.zeros((9, 12)))
+            np.testing.assert_allclose(grad_u, np.gradient(u, axis=axis))
+            # <grad u, v> == <u, grad^T v>
+            self.assertAlmostEqual(np.vdot(grad_u, v), np.vdot(u, gradient_axis_adjoint(v, axis, np.zeros((9, 12)))))
+        (yy, xx) = np.mgrid[0:16, 0:20]
+        meanFF = 1000 + 50*np.sin(xx/5.0)
+        FF = np.array([20*np.cos(xx/4.0 + yy/5.0), 20*np.cos(xx/5.0 + yy/3.0)])
+        DF = 10 + rng.random((16, 20))
+        projection = DF + (meanFF + 0.5*FF[0])*np.exp(-((xx - 10)**2 + (yy - 8)**2)/50.0)
+        cost = DFFCCost(meanFF, FF, DF)
+        cost.set_projection(projection)
+        for x in [np.zeros(2), np.array([0.3, -0.7])]:
+            (value, gradient) = cost(x)
+            # the cost of the definition
+            denominator = meanFF + np.tensordot(x, FF, axes=1)
+            L = (projection - DF)/denominator*np.mean(denominator)
+            self.assertAlmostEqual(value/np.sum(np.sqrt(np.gradient(L, axis=0)**2 + np.gradient(L, axis=1)**2 + cost.eps2)), 1.0)
+            # the central finite differences of the cost
+            h = 1e-5
+            gradient_fd = [(cost(x + h*e)[0] - cost(x - h*e)[0])/(2.0*h) for e in np.eye(2)]
+            np.testing.assert_allclose(gradient, gradient_fd, rtol=1e-5, atol=1e-6*np.abs(gradient).max())
+
+    def test_parallel_analysis(self):
+        from tomobar.supp.suppTools import parallel_analysis, surrogates_eigenvalues
+        rng = np.random.default_rng(0)
+        (yy, xx) = np.mgrid[0:48, 0:64]
+        modes = np.array([np.cos(xx/(4.0 + k) + yy/(6.0*(k + 1))).flatten() for k in range(3)])
+        flats = 1000 + (rng.normal(size=(30, 3))*[40, 30, 20]) @ modes + rng.normal(scale=10, size=(30, 48*64))
+        Data = flats - np.mean(flats, axis=0)
+        (V1, D1, numberPC) = parallel_analysis(Data, 10, np.random.default_rng(1))
+        self.assertEqual(numberPC, 3)
+        self.assertTrue(np.all(np.diff(D1) <= 0.0))
+        for k in range(3):
+            self.assertGreater(abs(np.corrcoef(Data.T @ V1[:,k], modes[k])[0,1]), 0.9)
+        # the grouped (Wishart) surrogates against the generated ones
+        stdEFF = 5 + 20*rng.random(48*64)
+        thresholds = [np.mean(eigenvalues, axis=0) + 2*np.std(eigenvalues, axis=0, ddof=1) for eigenvalues in
+                      [surrogates_eigenvalues(stdEFF, 10, 100, rng), surrogates_eigenvalues(stdEFF, 10, 100, rng, levels=16)]]
+        self.assertTrue(np.allclose(thresholds[0], thresholds[1], rtol=0.05))
+
+    def test_system_matrix(self):
+        from tomobar.supp.astraOP import AstraTools, AstraToolsOS
+        angles_rad = np.linspace(0.0, np.pi, 30, endpoint=False, dtype='float32')
+        image = np.float32(np.random.rand(32, 32))
+        with tempfile.TemporaryDirectory() as tmpdir:
+            os.environ['TOMOBAR_CACHE_DIR'] = tmpdir
+            try:
+                with AstraToolsOS(46, angles_rad, 0.0, 32, 4, 'cpu') as Atools, AstraToolsOS(46, angles_rad, 0.0, 32, 4, 'cpu_matrix') as Mtools:
+                    sinogram = Atools.forwproj(image)
+                    self.assertTrue(np.allclose(Mtools.forwproj(image), sinogram, rtol=1e-5, atol=1e-5))
+                    self.assertTrue(np.allclose(Mtools.backproj(sinogram), Atools.backproj(sinogram), rtol=1e-4, atol=1e-3))
+                    sinogram = Atools.forwprojOS(image, 3)
+                    self.assertTrue(np.allclose(Mtools.forwprojOS(image, 3), sinogram, rtol=1e-5, atol=1e-5))
+                    self.assertTrue(np.allclose(Mtools.backprojOS(sinogram, 3), Atools.backprojOS(sinogram, 3), rtol=1e-4, atol=1e-3))
+                # the second instance reads the cached matrix, one .npz entry per geometry
+                with AstraTools(46, angles_rad, None, 32, 'cpu') as Atools:
+                    sinogram = Atools.forwproj(image)
+                for i in range(2):
+                    with AstraTools(46, angles_rad, None, 32, 'cpu_matrix') as Mtools:
+                        self.assertTrue(np.allclose(Mtools.forwproj(image), sinogram, rtol=1e-5, atol=1e-5))
+                self.assertEqual(len(os.listdir(os.path.join(tmpdir, 'system_matrix'))), 2)
+                self.assertTrue(all(name.endswith('.npz') for name in os.listdir(os.path.join(tmpdir, 'system_matrix'))))
+            finally:
+                del os.environ['TOMOBAR_CACHE_DIR']
+        # without TOMOBAR_CACHE_DIR the matrix is built in memory, nothing is written to the home directory
+        with tempfile.TemporaryDirectory() as tmpdir:
+            home = os.environ.get('HOME')
+            os.environ['HOME'] = tmpdir
+            try:
+                with AstraTools(46, angles_rad, None, 32, 'cpu_matrix') as Mtools:
+                    self.assertTrue(np.allclose(Mtools.forwproj(image), sinogram, rtol=1e-5, atol=1e-5))
+                self.assertEqual(os.listdir(tmpdir), [])
+            finally:
+                if home is None:
+                    del os.environ['HOME']
+                else:
+                    os.environ['HOME'] = home
+
+    def test_vec_geom(self):
+        # the vectorised geometries equal the per-angle rotations of the source,
+        # detector and pixel vectors and the memoised arrays are read-only
+        from tomobar.supp.astraOP import rotation_matrix2D, rotation_matrix3D, vec_geom_init2D, vec_geom_init3D
+        angles_rad = np.linspace(0.0, np.pi, 17, dtype='float32')
+        CenterRotOffset = np.zeros((17, 2))
+        CenterRotOffset[:,0] = np.linspace(-2.0, 2.0, 17)
+        CenterRotOffset[:,1] = np.linspace(1.0, 3.0, 17)
+        for CoR in [0.0, 2.5, CenterRotOffset[:,1]]:
+            vectors_loop = np.zeros([17, 6])
+            for i in range(17):
+                d0 = [CoR if np.ndim(CoR) == 0 else CoR[i], 0.0]
+                vectors_loop[i,0:2] = np.dot(rotation_matrix2D(angles_rad[i]), [0.0, -1.0])
+                vectors_loop[i,2:4] = np.dot(rotation_matrix2D(angles_rad[i]), d0)
+                vectors_loop[i,4:6] = np.dot(rotation_matrix2D(angles_rad[i]), [1.5, 0.0])
+            vectors = vec_geom_init2D(angles_rad, 1.5, CoR)
+            np.testing.assert_allclose(vectors, vectors_loop, atol=1e-12)
+            with self.assertRaises(ValueError):
+                vectors[0,0] = 1.0
+            self.assertIs(vec_geom_init2D(angles_rad, 1.5, CoR), vectors)
+        for CoR in [0.0, 2.5, CenterRotOffset]:
+            vectors_loop = np.zeros([17, 12])
+            for i in range(17):
+                d0 = [CoR, 0.0, 0.0] if np.ndim(CoR) == 0 else [CoR[i,1], 0.0, CoR[i,0]]
+                vectors_loop[i,0:3] = np.dot(rotation_matrix3D(angles_rad[i]), [0.0, -1.0, 0.0])
+                vectors_loop[i,3:6] = np.dot(rotation_matrix3D(angles_rad[i]), d0)
+                vectors_loop[i,6:9] = np.dot(rotation_matrix3D(angles_rad[i]), [1.5, 0.0, 0.0])
+                vectors_loop[i,9:12] = np.dot(rotation_matrix3D(angles_rad[i]), [0.0, 0.0, 0.5])
+            vectors = vec_geom_init3D(angles_rad, 1.5, 0.5, CoR)
+            np.testing.assert_allclose(vectors, vectors_loop, atol=1e-12)
+            with self.assertRaises(ValueError):
+                vectors[0,0] = 1.0
+
+    def test_ring_weights(self):
+        # the sliding-window medians equal the per-line medians of the original
+        # kernels: the (halfsize-1)-th element of the sorted window of 2*halfsize+1
+        # values, the neighbours outside the line are replaced by the central value
+        from tomobar.supp.addmodules import RING_WEIGHTS
+        def median_lines(data, halfsize, axis):
+            lines = np.moveaxis(data, axis, -1)
+            length = lines.shape[-1]
+            indices = np.arange(length)[:,np.newaxis] + np.arange(-halfsize, halfsize+1)
+            inside = (indices >= 0) & (indices < length)
+            windows = np.where(inside, lines[..., np.clip(indices, 0, length-1)], lines[..., np.newaxis])
+            return np.moveaxis(np.sort(windows, axis=-1)[..., halfsize-1], -1, axis)
+        rng = np.random.default_rng(0)
+        residual2D = np.float32(rng.standard_normal((30, 40)))
+        for (h_det, h_ang) in [(1, 0), (4, 0), (5, 3), (2, 6)]:
+            if h_ang == 0:
+                reference = residual2D - median_lines(residual2D, h_det, 1)
+            else:
+                reference = median_lines(residual2D, h_ang, 0) - median_lines(residual2D, h_det, 1)
+            np.testing.assert_array_equal(RING_WEIGHTS(residual2D, h_det, h_ang, 0), reference)
+        residual3D = np.float32(rng.standard_normal((7, 30, 40)))
+        for (h_det, h_ang, h_proj) in [(3, 4, 2), (4, 0, 0), (0, 0, 2), (0, 5, 0), (3, 4, 0), (3, 0, 1), (0, 2, 3)]:
+            medians = {}
+            if h_det: medians['det'] = median_lines(residual3D, h_det, 2)
+            if h_ang: medians['ang'] = median_lines(residual3D, h_ang, 1)
+            if h_proj: medians['proj'] = median_lines(residual3D, h_proj, 0)
+            if len(medians) == 3:
+                reference = medians['ang'] - 0.5*(medians['proj'] + medians['det'])
+            elif list(medians) == ['ang']:
+                reference = np.zeros_like(residual3D) # no model for the angles window alone
+            elif len(medians) == 1:
+                reference = residual3D - list(medians.values())[0]
+            elif 'ang' in medians:
+                reference = medians['ang'] - medians['proj' if 'proj' in medians else 'det']
+            else:
+                reference = residual3D - 0.5*(medians['proj'] + medians['det'])
+            np.testing.assert_array_equal(RING_WEIGHTS(residual3D, h_det, h_ang, h_proj), np.float32(reference))
+        # the non-finite residuals are rejected
+        residual2D[3, 7] = np.nan
+        with self.assertRaises(ValueError):
+            RING_WEIGHTS(residual2D, 4, 0, 0)
+
+###############################################################################
+if __name__ == '__main__':
+    unittest.main()